@@ -1,14 +1,45 @@
 #ИИ модуль
 
-from typing import Any, Dict, List, Optional
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import httpx
-from openai import AsyncOpenAI, APIConnectionError, RateLimitError, APIStatusError
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    APIStatusError,
+    BadRequestError,
+    InternalServerError,
+    RateLimitError,
+)
 
-from config import CHAT_MODEL, EMBED_MODEL, OPENAI_API_KEY, OPENAI_TIMEOUT, logger
+from config import (
+    CHAT_MODEL,
+    EMBED_BATCH_CONCURRENCY,
+    EMBED_BATCH_MAX_ITEMS,
+    EMBED_BATCH_WINDOW_MS,
+    EMBED_MAX_RETRIES,
+    EMBED_MODEL,
+    OPENAI_API_KEY,
+    OPENAI_BACKGROUND_INFLIGHT,
+    OPENAI_BASE_URL,
+    OPENAI_CHAT_RETRIES,
+    OPENAI_INTERACTIVE_RESERVE,
+    OPENAI_MAX_INFLIGHT,
+    OPENAI_RATE_LIMITS,
+    OPENAI_TIMEOUT,
+    logger,
+)
+from embedding_cache import embedding_cache, normalize_text
+from metrics import OPENAI_ERRORS, OPENAI_RETRIES, OPENAI_SECONDS, OPENAI_TOKENS, OPENAI_WAIT_SECONDS, add_span
 
 _httpx_client: Optional[httpx.AsyncClient] = httpx.AsyncClient(timeout=OPENAI_TIMEOUT)
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=_httpx_client)
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL or None, http_client=_httpx_client)
 
 def cosine_similarity(a: List[float], b: List[float]) -> float:
     if not a or not b:
@@ -27,29 +58,368 @@ def cosine_similarity(a: List[float], b: List[float]) -> float:
     import math
     return dot / (math.sqrt(na) * math.sqrt(nb))
 
+def retry_delay(e: Exception, attempt: int) -> float:
+    # Пауза перед повтором: Retry-After от сервера, иначе экспонента с джиттером
+    response = getattr(e, "response", None)
+    header = response.headers.get("retry-after") if response is not None else None
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            pass
+    return min(30.0, 0.5 * (2 ** attempt)) * (0.5 + random.random())
+
+# Ошибки, после которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+PRIORITY_INTERACTIVE = 0  # ответы пользователю в чате
+PRIORITY_BACKGROUND = 1  # эмбеддинги анкет
+
+def estimate_tokens(texts: Sequence[str]) -> int:
+    # Грубая оценка до запроса; после ответа уточняется по usage
+    return sum(len(t) // 3 + 4 for t in texts)
+
+class TokenBucket:
+    # Квота «N в минуту», пополняется непрерывно; burst — ёмкость бака (по умолчанию
+    # минутная квота). Уровень может уйти в минус, если фактический расход оказался
+    # больше оценки.
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        self.capacity = float(burst or per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, reserve: float, now: float) -> float:
+        self._refill(now)
+        # Запрос крупнее всей квоты ждёт полного бака, а не вечно
+        need = min(amount + reserve, self.capacity)
+        return 0.0 if self.level >= need else (need - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.level -= amount
+
+    def give_back(self, amount: float) -> None:
+        self.level = min(self.capacity, self.level + amount)
+
+    def drain(self) -> None:
+        self.level = min(self.level, 0.0)
+
+class _ModelQuota:
+    __slots__ = ("requests", "tokens", "paused_until")
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+
+    def wait_time(self, tokens: int, background: bool, now: float) -> float:
+        share = OPENAI_INTERACTIVE_RESERVE if background else 0.0
+        return max(
+            self.paused_until - now,
+            self.requests.wait_time(1, self.requests.capacity * share, now),
+            self.tokens.wait_time(tokens, self.tokens.capacity * share, now),
+        )
+
+class _Grant:
+    __slots__ = ("model", "tokens", "priority", "future")
+
+    def __init__(self, model: str, tokens: int, priority: int, future: asyncio.Future):
+        self.model = model
+        self.tokens = tokens
+        self.priority = priority
+        self.future = future
+
+class OpenAIGovernor:
+    # Общий регулятор запросов к OpenAI: token bucket на запросы и токены в минуту
+    # для каждой модели, общий предел одновременных запросов и приоритеты —
+    # ожидающие запросы чата обслуживаются раньше фоновых эмбеддингов.
+    # После 429 модель ставится на паузу по Retry-After для всех вызывающих.
+
+    def __init__(
+        self,
+        limits: Dict[str, Tuple[int, int]] = OPENAI_RATE_LIMITS,
+        max_inflight: int = OPENAI_MAX_INFLIGHT,
+        background_inflight: int = OPENAI_BACKGROUND_INFLIGHT,
+    ):
+        self.limits = limits
+        self.max_inflight = max_inflight
+        self.background_inflight = background_inflight
+        self._quotas: Dict[str, _ModelQuota] = {}
+        self._waiting: List[Tuple[int, int, _Grant]] = []
+        self._order = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.in_flight = 0
+        self.background_in_flight = 0
+        self.granted = 0
+        self.rate_limited = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": self.in_flight,
+            "background_in_flight": self.background_in_flight,
+            "waiting": sum(1 for _, _, g in self._waiting if not g.future.done()),
+            "granted": self.granted,
+            "rate_limited": self.rate_limited,
+        }
+
+    def _quota(self, model: str) -> _ModelQuota:
+        quota = self._quotas.get(model)
+        if quota is None:
+            rpm, tpm = self.limits.get(model) or self.limits[CHAT_MODEL]
+            quota = self._quotas[model] = _ModelQuota(rpm, tpm)
+        return quota
+
+    def _pump(self) -> None:
+        # Выдаём слоты по приоритету; если головной запрос модели упёрся в квоту,
+        # остальные запросы этой модели ждут за ним, а другие модели идут дальше
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        blocked = set()
+        skipped = []
+        wake: Optional[float] = None
+        while self._waiting and self.in_flight < self.max_inflight:
+            item = heapq.heappop(self._waiting)
+            grant = item[2]
+            if grant.future.done():
+                continue
+            background = grant.priority > PRIORITY_INTERACTIVE
+            if grant.model in blocked or (background and self.background_in_flight >= self.background_inflight):
+                skipped.append(item)
+                continue
+            quota = self._quota(grant.model)
+            delay = quota.wait_time(grant.tokens, background, now)
+            if delay > 0:
+                blocked.add(grant.model)
+                skipped.append(item)
+                wake = delay if wake is None else min(wake, delay)
+                continue
+            quota.requests.take(1)
+            quota.tokens.take(grant.tokens)
+            self.in_flight += 1
+            if background:
+                self.background_in_flight += 1
+            self.granted += 1
+            grant.future.set_result(None)
+        for item in skipped:
+            heapq.heappush(self._waiting, item)
+        if wake is not None:
+            self._timer = asyncio.get_running_loop().call_later(wake, self._pump)
+
+    def _release(self, grant: _Grant) -> None:
+        self.in_flight -= 1
+        if grant.priority > PRIORITY_INTERACTIVE:
+            self.background_in_flight -= 1
+        self._pump()
+
+    def settle(self, grant: _Grant, used_tokens: int) -> None:
+        # Поправка квоты по фактическому расходу из usage
+        quota = self._quota(grant.model)
+        if used_tokens < grant.tokens:
+            quota.tokens.give_back(grant.tokens - used_tokens)
+        else:
+            quota.tokens.take(used_tokens - grant.tokens)
+        grant.tokens = used_tokens
+
+    def pause(self, model: str, seconds: float) -> None:
+        quota = self._quota(model)
+        quota.paused_until = max(quota.paused_until, time.monotonic() + seconds)
+        self.rate_limited += 1
+        self._pump()
+
+    @asynccontextmanager
+    async def slot(self, model: str, tokens: int, priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[_Grant]:
+        grant = _Grant(model, tokens, priority, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiting, (priority, next(self._order), grant))
+        self._pump()
+        waited = time.perf_counter()
+        try:
+            await grant.future
+        except asyncio.CancelledError:
+            # Отмена могла прийти уже после выдачи слота
+            if grant.future.done() and not grant.future.cancelled():
+                self._release(grant)
+            raise
+        started = time.perf_counter()
+        OPENAI_WAIT_SECONDS.observe(started - waited, model)
+        try:
+            yield grant
+        except Exception as e:
+            OPENAI_ERRORS.inc(model, type(e).__name__)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            OPENAI_SECONDS.observe(duration, model)
+            OPENAI_TOKENS.inc(model, amount=grant.tokens)
+            add_span(f"openai {model}", started, duration)
+            self._release(grant)
+
+    def backoff(self, model: str, e: Exception, attempt: int) -> float:
+        # Пауза перед повтором; при 429 на паузу ставится вся модель,
+        # и вызывающему остаётся только встать в очередь заново
+        delay = retry_delay(e, attempt)
+        OPENAI_RETRIES.inc(model)
+        if isinstance(e, RateLimitError):
+            self.pause(model, delay)
+            return 0.0
+        return delay
+
+    async def call(
+        self,
+        model: str,
+        tokens: int,
+        request: Callable[[], Awaitable[Any]],
+        priority: int = PRIORITY_INTERACTIVE,
+        retries: int = 0,
+    ) -> Any:
+        for attempt in range(retries + 1):
+            try:
+                async with self.slot(model, tokens, priority) as grant:
+                    resp = await request()
+                    usage = getattr(resp, "usage", None)
+                    if usage is not None and getattr(usage, "total_tokens", None):
+                        self.settle(grant, usage.total_tokens)
+                    return resp
+            except RETRYABLE_ERRORS as e:
+                if attempt >= retries:
+                    raise
+                delay = self.backoff(model, e, attempt)
+                logger.warning(f"OpenAI {model}: повтор #{attempt + 1} ({e})")
+                if delay:
+                    await asyncio.sleep(delay)
+        raise RuntimeError("unreachable")
+
+openai_governor = OpenAIGovernor()
+
+class EmbeddingBatcher:
+    # Микробатчинг: тексты от параллельных вызовов копятся EMBED_BATCH_WINDOW_MS
+    # (или до EMBED_BATCH_MAX_ITEMS штук) и уходят одним запросом input=[...].
+
+    def __init__(
+        self,
+        window_ms: float = EMBED_BATCH_WINDOW_MS,
+        max_items: int = EMBED_BATCH_MAX_ITEMS,
+        max_concurrency: int = EMBED_BATCH_CONCURRENCY,
+        max_retries: int = EMBED_MAX_RETRIES,
+    ):
+        self.window = window_ms / 1000.0
+        self.max_items = max_items
+        self.max_retries = max_retries
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._pending: Dict[str, List[asyncio.Future]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+        self.batches = 0
+        self.items = 0
+
+    async def embed(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        # Одинаковые тексты внутри окна отправляются один раз
+        self._pending.setdefault(text, []).append(fut)
+        if len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await fut
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _request(self, texts: Sequence[str]) -> List[List[float]]:
+        resp = await openai_governor.call(
+            EMBED_MODEL,
+            estimate_tokens(texts),
+            lambda: openai_client.embeddings.create(model=EMBED_MODEL, input=list(texts)),
+            priority=PRIORITY_BACKGROUND,
+            retries=self.max_retries,
+        )
+        data = sorted(resp.data, key=lambda d: d.index)
+        return [list(d.embedding) for d in data]
+
+    async def _request_isolated(self, texts: Sequence[str]) -> List[Union[List[float], Exception]]:
+        # Изоляция ошибок: пачку, отклонённую из-за содержимого (400), делим пополам,
+        # пока ошибка не останется только у «плохих» текстов. Остальные ошибки
+        # (авторизация, неизвестная модель, 5xx после повторов) от деления
+        # не исчезнут — вся пачка получает одну ошибку без лишних запросов
+        try:
+            return list(await self._request(texts))
+        except BadRequestError as e:
+            if len(texts) == 1:
+                return [e]
+            mid = len(texts) // 2
+            left, right = await asyncio.gather(
+                self._request_isolated(texts[:mid]),
+                self._request_isolated(texts[mid:]),
+            )
+            return left + right
+        except Exception as e:
+            return [e] * len(texts)
+
+    async def _send(self, batch: Dict[str, List[asyncio.Future]]) -> None:
+        texts = list(batch)
+        async with self._sem:
+            results = await self._request_isolated(texts)
+        self.batches += 1
+        self.items += len(texts)
+        for text, res in zip(texts, results):
+            for fut in batch[text]:
+                if fut.done():
+                    continue
+                if isinstance(res, Exception):
+                    fut.set_exception(res)
+                else:
+                    fut.set_result(res)
+
+embedding_batcher = EmbeddingBatcher()
+
 async def get_text_embedding(text: str) -> Optional[List[float]]:
-    text = (text or "").strip()
+    text = normalize_text(text)
     if not text:
         return None
     try:
-        resp = await openai_client.embeddings.create(
-            model=EMBED_MODEL,
-            input=text,
-        )
-        vec = resp.data[0].embedding
-        return list(vec)
+        cached = await embedding_cache.get(text)
+        if cached is not None:
+            return cached
+    except Exception as e:
+        logger.warning(f"Ошибка чтения кэша эмбеддингов: {e}")
+    try:
+        vec = await embedding_batcher.embed(text)
+        await embedding_cache.put(text, vec)
+        return vec
     except (APIConnectionError, RateLimitError, APIStatusError) as e:
         logger.warning(f"OpenAI embedding error: {e}")
     except Exception as e:
         logger.exception(f"OpenAI embedding unexpected error: {e}")
     return None
 
-async def virtual_reply(
+async def get_text_embeddings(texts: Sequence[str]) -> List[Optional[List[float]]]:
+    # Параллельные вызовы склеиваются батчером в общие запросы
+    return list(await asyncio.gather(*(get_text_embedding(t) for t in texts)))
+
+BUSY_REPLY = "Сейчас я немного занят(а). Попробуйте написать еще раз через минутку."
+ERROR_REPLY = "Упс, что-то пошло не так. Попробуйте еще раз."
+
+def virtual_messages(
     user_profile: Dict[str, Any],
     partner_gender: str,
     history: List[Dict[str, str]],
     user_message: str,
-) -> str:
+) -> List[Dict[str, str]]:
     hist = history[-10:] if history else []
     system_prompt = (
         f"Ты виртуальный собеседник для сервиса знакомств. Общайся дружелюбно, мило и чуть флиртующе. "
@@ -62,21 +432,117 @@ async def virtual_reply(
     for m in hist:
         messages.append({"role": m["role"], "content": m["content"]})
     messages.append({"role": "user", "content": user_message})
+    return messages
+
+async def virtual_reply(
+    user_profile: Dict[str, Any],
+    partner_gender: str,
+    history: List[Dict[str, str]],
+    user_message: str,
+) -> str:
+    messages = virtual_messages(user_profile, partner_gender, history, user_message)
     try:
-        resp = await openai_client.chat.completions.create(
-            model=CHAT_MODEL,
-            messages=messages,
-            temperature=0.8,
-            max_tokens=180,
+        resp = await openai_governor.call(
+            CHAT_MODEL,
+            estimate_tokens([m["content"] for m in messages]) + 180,
+            lambda: openai_client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                temperature=0.8,
+                max_tokens=180,
+            ),
+            retries=OPENAI_CHAT_RETRIES,
         )
         answer = resp.choices[0].message.content.strip()
         return answer
     except (APIConnectionError, RateLimitError, APIStatusError) as e:
         logger.warning(f"OpenAI chat error: {e}")
-        return "Сейчас я немного занят(а). Попробуйте написать еще раз через минутку."
+        return BUSY_REPLY
     except Exception as e:
         logger.exception(f"OpenAI chat unexpected error: {e}")
-        return "Упс, что-то пошло не так. Попробуйте еще раз."
+        return ERROR_REPLY
+
+async def _chat_stream(messages: List[Dict[str, str]], tokens: int) -> AsyncIterator[str]:
+    # Поток OpenAI читает отдельная задача, и слот регулятора держится только до
+    # конца ответа модели. Медленный потребитель (правки сообщения в Telegram не
+    # чаще VIRTUAL_EDIT_INTERVAL) слот не занимает и получает весь накопленный текст.
+    parts: List[str] = []
+    changed = asyncio.Event()
+
+    async def read() -> None:
+        try:
+            async with openai_governor.slot(CHAT_MODEL, tokens):
+                stream = await openai_client.chat.completions.create(
+                    model=CHAT_MODEL,
+                    messages=messages,
+                    temperature=0.8,
+                    max_tokens=180,
+                    stream=True,
+                )
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        parts.append(delta)
+                        changed.set()
+        finally:
+            changed.set()
+
+    reader = asyncio.create_task(read())
+    sent = 0
+    try:
+        while True:
+            await changed.wait()
+            changed.clear()
+            finished = reader.done()
+            if len(parts) > sent:
+                sent = len(parts)
+                yield "".join(parts)
+            if finished:
+                break
+        reader.result()  # ошибка потока — вызывающему
+    finally:
+        if not reader.done():
+            reader.cancel()
+            await asyncio.gather(reader, return_exceptions=True)
+
+async def virtual_reply_stream(
+    user_profile: Dict[str, Any],
+    partner_gender: str,
+    history: List[Dict[str, str]],
+    user_message: str,
+) -> AsyncIterator[str]:
+    # Потоковый ответ: отдаёт накопленный текст по мере прихода токенов.
+    # При ошибке до первого токена отдаёт текст-заглушку, после — оставляет уже полученное.
+    messages = virtual_messages(user_profile, partner_gender, history, user_message)
+    tokens = estimate_tokens([m["content"] for m in messages]) + 180
+    text = ""
+    for attempt in range(OPENAI_CHAT_RETRIES + 1):
+        try:
+            async for text in _chat_stream(messages, tokens):
+                yield text
+            return
+        except RETRYABLE_ERRORS as e:
+            # Повторяем только пока пользователю ничего не показано
+            if not text and attempt < OPENAI_CHAT_RETRIES:
+                delay = openai_governor.backoff(CHAT_MODEL, e, attempt)
+                logger.warning(f"OpenAI chat stream: повтор #{attempt + 1} ({e})")
+                if delay:
+                    await asyncio.sleep(delay)
+                continue
+            logger.warning(f"OpenAI chat stream error: {e}")
+            if not text:
+                yield BUSY_REPLY
+            return
+        except APIStatusError as e:
+            logger.warning(f"OpenAI chat stream error: {e}")
+            if not text:
+                yield BUSY_REPLY
+            return
+        except Exception as e:
+            logger.exception(f"OpenAI chat stream unexpected error: {e}")
+            if not text:
+                yield ERROR_REPLY
+            return
 
 async def aclose_http_client():
     global _httpx_client
@@ -0,0 +1,360 @@
+#ANN-индекс эмбеддингов (IVF)
+
+import asyncio
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config import (
+    ANN_KMEANS_ITERS,
+    ANN_MIN_PARTITION,
+    ANN_NPROBE,
+    ANN_TRAIN_SAMPLE,
+    logger,
+)
+from db_pool import pool
+from ranking import to_vector
+
+# Коды looking_for внутри индекса
+LF_CODES = {"ANY": 0, "M": 1, "F": 2}
+
+_REQUIRED = ("name", "age", "city", "gender", "description", "photo_file_id")
+_CHUNK = 8192
+
+def _normalize(vec: np.ndarray) -> Optional[np.ndarray]:
+    norm = float(np.linalg.norm(vec))
+    if norm == 0.0:
+        return None
+    return (vec / norm).astype(np.float32)
+
+def kmeans(x: np.ndarray, nlist: int, iters: int = ANN_KMEANS_ITERS, seed: int = 0) -> np.ndarray:
+    # Сферический k-means по нормированным векторам -> центроиды (nlist, dim)
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(x.shape[0], nlist, replace=False)].copy()
+    for _ in range(iters):
+        labels = np.empty(x.shape[0], dtype=np.int64)
+        for start in range(0, x.shape[0], _CHUNK):
+            labels[start:start + _CHUNK] = np.argmax(x[start:start + _CHUNK] @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        counts = np.bincount(labels, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # Пустые кластеры перезапускаем случайными точками
+            sums[empty] = x[rng.choice(x.shape[0], int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+def assign_lists(vecs: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    out = np.empty(vecs.shape[0], dtype=np.int32)
+    for start in range(0, vecs.shape[0], _CHUNK):
+        out[start:start + _CHUNK] = np.argmax(vecs[start:start + _CHUNK] @ centroids.T, axis=1)
+    return out
+
+def _train_ivf(vecs: np.ndarray, alive: np.ndarray, sample_size: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    rows = np.flatnonzero(alive)
+    nlist = int(min(1024, max(8, np.sqrt(rows.shape[0]))))
+    rng = np.random.default_rng(seed)
+    sample = rows if rows.shape[0] <= sample_size else rng.choice(rows, sample_size, replace=False)
+    centroids = kmeans(vecs[sample], min(nlist, sample.shape[0]), seed=seed)
+    return centroids, assign_lists(vecs, centroids)
+
+class IVFPartition:
+    # Векторы одной партиции (город + пол) с метаданными для фильтров.
+    # Пока партиция мала или не обучена — поиск точный по всем строкам.
+
+    def __init__(self, dim: int, capacity: int = 1024):
+        self.dim = dim
+        self._capacity = capacity
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.vecs = np.zeros((capacity, dim), dtype=np.float32)
+        self.ages = np.zeros(capacity, dtype=np.int16)
+        self.lfs = np.zeros(capacity, dtype=np.int8)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.assign = np.full(capacity, -1, dtype=np.int32)
+        self.centroids: Optional[np.ndarray] = None
+        self.trained_size = 0
+        self.training = False
+        self._dirty: Optional[set] = None  # строки, изменённые во время обучения
+        self._pos: Dict[int, int] = {}
+        self._free: List[int] = []
+        self.size = 0  # занятая часть массивов (включая удалённые строки)
+
+    def __len__(self) -> int:
+        return len(self._pos)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._pos
+
+    def _grow(self) -> None:
+        cap = self._capacity * 2
+        for name in ("ids", "ages", "lfs", "alive"):
+            old = getattr(self, name)
+            new = np.zeros(cap, dtype=old.dtype)
+            new[: self.size] = old[: self.size]
+            setattr(self, name, new)
+        vecs = np.zeros((cap, self.dim), dtype=np.float32)
+        vecs[: self.size] = self.vecs[: self.size]
+        assign = np.full(cap, -1, dtype=np.int32)
+        assign[: self.size] = self.assign[: self.size]
+        self.vecs, self.assign, self._capacity = vecs, assign, cap
+
+    def upsert(self, user_id: int, vec: np.ndarray, age: int, looking_for: Optional[str]) -> bool:
+        if vec.shape[0] != self.dim:
+            return False
+        unit = _normalize(vec)
+        if unit is None:
+            self.remove(user_id)
+            return False
+        row = self._pos.get(user_id)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+            else:
+                if self.size == self._capacity:
+                    self._grow()
+                row = self.size
+                self.size += 1
+            self._pos[user_id] = row
+        self.ids[row] = user_id
+        self.vecs[row] = unit
+        self.ages[row] = age or 0
+        self.lfs[row] = LF_CODES.get(looking_for or "ANY", 0)
+        self.alive[row] = True
+        if self.centroids is not None:
+            self.assign[row] = int(np.argmax(self.centroids @ unit))
+        else:
+            self.assign[row] = -1
+        if self._dirty is not None:
+            self._dirty.add(row)
+        return True
+
+    def remove(self, user_id: int) -> None:
+        row = self._pos.pop(user_id, None)
+        if row is None:
+            return
+        self.alive[row] = False
+        self.assign[row] = -1
+        self._free.append(row)
+
+    def needs_training(self, min_size: int = ANN_MIN_PARTITION) -> bool:
+        n = len(self)
+        if self.training or n < min_size:
+            return False
+        return self.centroids is None or n > 2 * self.trained_size
+
+    def _install(self, centroids: np.ndarray, assign: np.ndarray, n: int) -> None:
+        self.assign[:n] = assign[:n]
+        self.assign[:n][~self.alive[:n]] = -1
+        self.centroids = centroids
+        # Строки, добавленные или изменённые во время обучения, раскладываем заново
+        redo = set(range(n, self.size)) | (self._dirty or set())
+        for row in redo:
+            if self.alive[row]:
+                self.assign[row] = int(np.argmax(centroids @ self.vecs[row]))
+        self._dirty = None
+        self.trained_size = len(self)
+
+    def train(self, sample_size: int = ANN_TRAIN_SAMPLE, seed: int = 0) -> None:
+        n = self.size
+        centroids, assign = _train_ivf(self.vecs[:n], self.alive[:n], sample_size, seed)
+        self._install(centroids, assign, n)
+
+    async def train_async(self, sample_size: int = ANN_TRAIN_SAMPLE, seed: int = 0) -> None:
+        # k-means в отдельном потоке; массивы на время обучения не копируются,
+        # а изменённые за это время строки переназначаются в _install
+        self.training = True
+        self._dirty = set()
+        n = self.size
+        try:
+            centroids, assign = await asyncio.to_thread(
+                _train_ivf, self.vecs[:n], self.alive[:n].copy(), sample_size, seed
+            )
+            self._install(centroids, assign, n)
+        finally:
+            self._dirty = None
+            self.training = False
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        age_min: Optional[int] = None,
+        age_max: Optional[int] = None,
+        lf_codes: Optional[Sequence[int]] = None,
+        exclude: Optional[np.ndarray] = None,
+        nprobe: int = ANN_NPROBE,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        n = self.size
+        unit = _normalize(np.asarray(query, dtype=np.float32))
+        if n == 0 or k <= 0 or unit is None or unit.shape[0] != self.dim:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        mask = self.alive[:n].copy()
+        if age_min is not None:
+            mask &= self.ages[:n] >= age_min
+        if age_max is not None:
+            mask &= self.ages[:n] <= age_max
+        if lf_codes is not None:
+            mask &= np.isin(self.lfs[:n], lf_codes)
+        if exclude is not None and exclude.size:
+            mask &= ~np.isin(self.ids[:n], exclude)
+        if self.centroids is not None:
+            lists = np.argsort(-(self.centroids @ unit))
+            assign = self.assign[:n]
+            probe = max(1, nprobe)
+            while True:
+                # Нераспределённые строки (assign = -1) проверяем всегда
+                selected = mask & (np.isin(assign, lists[:probe]) | (assign < 0))
+                if probe >= lists.shape[0] or int(selected.sum()) >= k:
+                    break
+                probe *= 2  # после фильтров кандидатов мало — расширяем поиск
+            mask = selected
+        rows = np.flatnonzero(mask)
+        if rows.shape[0] == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        scores = np.empty(rows.shape[0], dtype=np.float32)
+        for start in range(0, rows.shape[0], _CHUNK):
+            scores[start:start + _CHUNK] = self.vecs[rows[start:start + _CHUNK]] @ unit
+        if k < rows.shape[0]:
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(rows.shape[0])
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return self.ids[rows[best]], scores[best]
+
+class ANNIndex:
+    # Партиции по (город, пол), загружаются из БД при первом поиске
+    # и поддерживаются в актуальном состоянии через upsert_profile.
+
+    def __init__(self, min_partition: int = ANN_MIN_PARTITION):
+        self.min_partition = min_partition
+        self._parts: Dict[Tuple[str, str], IVFPartition] = {}
+        self._where: Dict[int, Tuple[str, str]] = {}
+        self._loading: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._pending: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        self._tasks: set = set()
+
+    def _remove(self, user_id: int) -> None:
+        key = self._where.pop(user_id, None)
+        if key is not None and key in self._parts:
+            self._parts[key].remove(user_id)
+
+    def _apply(self, profile: Dict[str, Any]) -> None:
+        user_id = profile["user_id"]
+        key = (profile.get("city"), profile.get("gender"))
+        vec = to_vector(profile.get("embedding"))
+        if self._where.get(user_id) != key:
+            self._remove(user_id)
+        if vec is None or not all(profile.get(f) for f in _REQUIRED):
+            self._remove(user_id)
+            return
+        part = self._parts.get(key)
+        if part is None:
+            return  # партиция ещё не загружена: подхватится из БД
+        if part.upsert(user_id, vec, profile.get("age"), profile.get("looking_for")):
+            self._where[user_id] = key
+
+    def on_profile_saved(self, profile: Dict[str, Any]) -> None:
+        key = (profile.get("city"), profile.get("gender"))
+        if key in self._loading:
+            # Партиция грузится: применим изменение после загрузки
+            self._pending.setdefault(key, []).append(dict(profile))
+        old = self._where.get(profile["user_id"])
+        if old is not None and old != key and old in self._loading:
+            self._pending.setdefault(old, []).append({"user_id": profile["user_id"]})
+        self._apply(profile)
+
+    async def _load(self, key: Tuple[str, str]) -> Optional[IVFPartition]:
+        city, gender = key
+        part: Optional[IVFPartition] = None
+        async for rows in pool.iterate(
+            """
+            SELECT user_id, age, looking_for, embedding FROM profiles
+            WHERE city = ? AND gender = ?
+              AND name IS NOT NULL AND age IS NOT NULL AND description IS NOT NULL
+              AND photo_file_id IS NOT NULL AND embedding IS NOT NULL
+            """,
+            (city, gender),
+            batch_size=2000,
+        ):
+            for r in rows:
+                vec = to_vector(r["embedding"])
+                if vec is None:
+                    continue
+                if part is None:
+                    part = IVFPartition(int(vec.shape[0]))
+                if part.upsert(r["user_id"], vec, r["age"], r["looking_for"]):
+                    self._where[r["user_id"]] = key
+            await asyncio.sleep(0)
+        return part
+
+    async def partition(self, city: str, gender: str) -> Optional[IVFPartition]:
+        key = (city, gender)
+        if key in self._parts:
+            return self._parts[key]
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key))
+            self._loading[key] = task
+            try:
+                part = await task
+                if part is not None:
+                    self._parts[key] = part
+                    for profile in self._pending.pop(key, []):
+                        if "city" in profile:
+                            self._apply(profile)
+                        elif self._where.get(profile["user_id"]) == key:
+                            self._where.pop(profile["user_id"])
+                            part.remove(profile["user_id"])
+                    logger.info(f"ANN: партиция {city}/{gender} загружена, векторов: {len(part)}")
+            finally:
+                self._loading.pop(key, None)
+                self._pending.pop(key, None)
+        else:
+            await task
+        return self._parts.get(key)
+
+    def _maybe_train(self, part: IVFPartition) -> None:
+        if part.needs_training(self.min_partition):
+            task = asyncio.create_task(part.train_async())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def search(
+        self,
+        me: Dict[str, Any],
+        query: np.ndarray,
+        k: int,
+        age_delta: int,
+        exclude: Iterable[int] = (),
+    ) -> Optional[List[Tuple[int, float]]]:
+        # None — пул слишком мал для ANN, выгоднее точный поиск
+        my_lf = me.get("looking_for") or "ANY"
+        genders = ("M", "F") if my_lf == "ANY" else (my_lf,)
+        parts = []
+        for g in genders:
+            part = await self.partition(me["city"], g)
+            if part is not None:
+                parts.append(part)
+        if sum(len(p) for p in parts) < self.min_partition:
+            return None
+        excl = np.fromiter(exclude, dtype=np.int64)
+        excl = np.append(excl, me["user_id"])
+        lf_codes = (LF_CODES["ANY"], LF_CODES.get(me["gender"], 0))
+        found: List[Tuple[int, float]] = []
+        for part in parts:
+            self._maybe_train(part)
+            ids, scores = part.search(
+                query, k,
+                age_min=me["age"] - age_delta,
+                age_max=me["age"] + age_delta,
+                lf_codes=lf_codes,
+                exclude=excl,
+            )
+            found.extend(zip(ids.tolist(), scores.tolist()))
+        found.sort(key=lambda x: x[1], reverse=True)
+        return found[:k]
+
+ann_index = ANNIndex()
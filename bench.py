@@ -0,0 +1,232 @@
+#Микробенчмарки горячих путей БД и ранжирования
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+from loadgen import CHAT_LINES, LOADGEN_TOKEN, SEED_USER_BASE, describe, fake_embedding, seed_dataset
+
+SCALES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+BENCH_DATA_DIR = "bench_data"  # сгенерированные наборы данных переиспользуются между запусками
+
+Op = Callable[[random.Random], Awaitable[Any]]
+
+def dataset_path(scale: str, dim: int, likes_per_user: int, seed: int) -> str:
+    return os.path.join(BENCH_DATA_DIR, f"{scale}-d{dim}-l{likes_per_user}-s{seed}.sqlite3")
+
+def git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    us = np.asarray(samples) * 1e6
+    mean = float(us.mean())
+    return {
+        "ops": len(samples),
+        "mean_us": mean,
+        "p50_us": float(np.percentile(us, 50)),
+        "p95_us": float(np.percentile(us, 95)),
+        "p99_us": float(np.percentile(us, 99)),
+        "ops_per_sec": 1e6 / mean if mean else 0.0,
+    }
+
+async def measure(op: Op, repeat: int, warmup: int, seed: int, inner: int = 1) -> Dict[str, float]:
+    # inner > 1 — для путей в единицы микросекунд: замеряется пачка вызовов и делится на её размер
+    rng = random.Random(seed)
+    for _ in range(warmup):
+        await op(rng)
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(inner):
+            await op(rng)
+        samples.append((time.perf_counter() - started) / inner)
+    return summarize(samples)
+
+def benchmarks(profiles: int, dim: int) -> Dict[str, Dict[str, Any]]:
+    # Модули бота импортируются после того, как задан DB_PATH
+    import bot
+    from ai_utils import cosine_similarity
+    from db import (
+        count_pending_likers,
+        get_next_pending_liker,
+        get_virtual_state,
+        record_interaction,
+        set_virtual_state,
+        upsert_profile,
+    )
+
+    def any_user(rng: random.Random) -> int:
+        return SEED_USER_BASE + rng.randrange(profiles)
+
+    async def find_candidates(rng: random.Random) -> Any:
+        return await bot.find_candidates(any_user(rng))
+
+    vectors = [fake_embedding(describe(random.Random(i)), dim).tolist() for i in range(64)]
+
+    async def cosine(rng: random.Random) -> Any:
+        return cosine_similarity(vectors[rng.randrange(64)], vectors[rng.randrange(64)])
+
+    async def upsert(rng: random.Random) -> Any:
+        return await upsert_profile(any_user(rng), description=describe(rng))
+
+    async def interaction(rng: random.Random) -> Any:
+        return await record_interaction(any_user(rng), any_user(rng), rng.choice(("like", "dislike")))
+
+    async def count_likers(rng: random.Random) -> Any:
+        return await count_pending_likers(any_user(rng))
+
+    async def next_liker(rng: random.Random) -> Any:
+        return await get_next_pending_liker(any_user(rng))
+
+    async def virtual_round_trip(rng: random.Random) -> Any:
+        # Чтение истории, ответ пользователя и модели, запись — как в virtual_chatting
+        user_id = SEED_USER_BASE + rng.randrange(min(profiles, 200))
+        _, history = await get_virtual_state(user_id)
+        history.append({"role": "user", "content": rng.choice(CHAT_LINES)})
+        history.append({"role": "assistant", "content": describe(rng)})
+        await set_virtual_state(user_id, "F", history[-20:])
+
+    return {
+        "find_candidates": {"op": find_candidates},
+        "cosine_similarity": {"op": cosine, "inner": 100},
+        "upsert_profile": {"op": upsert},
+        "record_interaction": {"op": interaction},
+        "count_pending_likers": {"op": count_likers},
+        "get_next_pending_liker": {"op": next_liker},
+        "virtual_state_round_trip": {"op": virtual_round_trip},
+    }
+
+async def run_suite(args: argparse.Namespace, cached: str, workdir: str) -> Dict[str, Any]:
+    from db_pool import pool
+
+    if not os.path.exists(cached):
+        # Набор генерируется один раз во временный файл и переносится на место целиком
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        pool.path = os.path.join(workdir, "generate.sqlite3")
+        await pool.open()
+        await seed_dataset(SCALES[args.scale], args.likes_per_user, 0.4, args.dim, args.seed)
+        await pool.close()
+        shutil.move(pool.path, cached)
+
+    # Пишущие бенчмарки меняют данные, поэтому каждый прогон идёт на свежей копии
+    pool.path = os.path.join(workdir, "bench.sqlite3")
+    shutil.copyfile(cached, pool.path)
+    await pool.open()
+    try:
+        row = await pool.fetchone("SELECT (SELECT COUNT(*) FROM profiles), (SELECT COUNT(*) FROM interactions)")
+        profiles, interactions = int(row[0]), int(row[1])
+        results = {}
+        for name, spec in benchmarks(profiles, args.dim).items():
+            if args.only and name not in args.only:
+                continue
+            stats = await measure(spec["op"], args.repeat, args.warmup, args.seed, spec.get("inner", 1))
+            results[name] = stats
+            print(f"{name:<26}{stats['p50_us']:>12.1f}{stats['p95_us']:>12.1f}{stats['mean_us']:>12.1f}"
+                  f"{stats['ops_per_sec']:>12.0f}")
+    finally:
+        await pool.close()
+    return {
+        "meta": {
+            "scale": args.scale,
+            "profiles": profiles,
+            "interactions": interactions,
+            "dim": args.dim,
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "created": int(time.time()),
+        },
+        "results": results,
+    }
+
+def cmd_run(args: argparse.Namespace) -> int:
+    cached = os.path.abspath(dataset_path(args.scale, args.dim, args.likes_per_user, args.seed))
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    # Конфиг читает DB_PATH и токен из окружения, а db_pool берёт путь при импорте
+    os.environ["DB_PATH"] = os.path.join(workdir, "bench.sqlite3")
+    os.environ.setdefault("BOT_TOKEN", LOADGEN_TOKEN)
+    print(f"Набор {args.scale}: {cached}")
+    print(f"{'':<26}{'p50 мкс':>12}{'p95 мкс':>12}{'ср. мкс':>12}{'оп/с':>12}")
+    try:
+        report = asyncio.run(run_suite(args, cached, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    out = args.out or f"bench-{args.scale}.json"
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты: {out}")
+    return 0
+
+def cmd_compare(args: argparse.Namespace) -> int:
+    with open(args.baseline, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        cur = json.load(f)
+    for key in ("scale", "dim"):
+        if base["meta"].get(key) != cur["meta"].get(key):
+            print(f"Внимание: {key} отличается ({base['meta'].get(key)} против {cur['meta'].get(key)})")
+    metric = args.metric
+    regressions = []
+    print(f"{'':<26}{'было':>12}{'стало':>12}{'изм.':>9}")
+    for name in sorted(set(base["results"]) | set(cur["results"])):
+        old = base["results"].get(name)
+        new = cur["results"].get(name)
+        if old is None or new is None:
+            print(f"{name:<26}{'—' if old is None else f'{old[metric]:.1f}':>12}{'—' if new is None else f'{new[metric]:.1f}':>12}")
+            continue
+        change = new[metric] / old[metric] - 1.0 if old[metric] else 0.0
+        mark = ""
+        if change > args.threshold:
+            regressions.append(name)
+            mark = "  РЕГРЕССИЯ"
+        print(f"{name:<26}{old[metric]:>12.1f}{new[metric]:>12.1f}{change:>+9.1%}{mark}")
+    if regressions:
+        print(f"Медленнее более чем на {args.threshold:.0%} ({metric}): {', '.join(regressions)}")
+        return 1
+    return 0
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Микробенчмарки db.py и ранжирования с JSON-базлайнами")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="прогнать бенчмарки и сохранить результаты в JSON")
+    run.add_argument("--scale", choices=sorted(SCALES), default="1k", help="размер набора: анкет (оценок — в likes-per-user раз больше)")
+    run.add_argument("--dim", type=int, default=256, help="размерность эмбеддингов")
+    run.add_argument("--likes-per-user", type=int, default=10, help="оценок на анкету")
+    run.add_argument("--repeat", type=int, default=200, help="замеров на бенчмарк")
+    run.add_argument("--warmup", type=int, default=20, help="прогревочных вызовов")
+    run.add_argument("--only", nargs="+", help="только указанные бенчмарки")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--out", default="", help="файл результатов (по умолчанию bench-<scale>.json)")
+    run.set_defaults(func=cmd_run)
+
+    compare = sub.add_parser("compare", help="сравнить с базлайном; код 1 при регрессии")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=0.15, help="допустимое замедление (0.15 = 15%%)")
+    compare.add_argument("--metric", choices=("p50_us", "p95_us", "mean_us"), default="p50_us")
+    compare.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#Бенчмарк ANN: полнота против задержки
+
+import argparse
+import time
+from typing import List
+
+import numpy as np
+
+from ann_index import IVFPartition
+from ranking import EmbeddingStore
+
+def synthetic_embeddings(n: int, dim: int, clusters: int, seed: int) -> np.ndarray:
+    # Кластеризованные данные ближе к реальным эмбеддингам, чем равномерный шум
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, n)
+    return centers[labels] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+
+def percentile_ms(samples: List[float], q: float) -> float:
+    return float(np.percentile(np.asarray(samples) * 1000.0, q))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Полнота и задержка IVF против точного поиска")
+    parser.add_argument("--n", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=30)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    data = synthetic_embeddings(args.n, args.dim, args.clusters, args.seed)
+    queries = synthetic_embeddings(args.queries, args.dim, args.clusters, args.seed + 1)
+    ids = list(range(args.n))
+
+    # Эталон держит все векторы: вытеснение исказило бы recall
+    exact = EmbeddingStore(capacity=args.n, max_rows=args.n)
+    part = IVFPartition(args.dim, capacity=args.n)
+    for i in ids:
+        exact.put(i, data[i])
+        part.upsert(i, data[i], 25, "ANY")
+    assert len(exact) == args.n
+
+    t0 = time.perf_counter()
+    part.train()
+    print(f"n={args.n} dim={args.dim} k={args.k}; обучение IVF ({part.centroids.shape[0]} списков): "
+          f"{time.perf_counter() - t0:.2f} с")
+
+    truth = []
+    lat = []
+    for q in queries:
+        t = time.perf_counter()
+        top, _ = exact.top_k(q, ids, args.k)
+        lat.append(time.perf_counter() - t)
+        truth.append(set(top))
+    print(f"{'точный':>10}  recall=1.000  p50={percentile_ms(lat, 50):7.2f} мс  p95={percentile_ms(lat, 95):7.2f} мс")
+
+    for nprobe in args.nprobe:
+        lat = []
+        hits = 0
+        for q, want in zip(queries, truth):
+            t = time.perf_counter()
+            found, _ = part.search(q, args.k, nprobe=nprobe)
+            lat.append(time.perf_counter() - t)
+            hits += len(want.intersection(found.tolist()))
+        recall = hits / (args.k * len(queries))
+        print(f"nprobe={nprobe:<3}  recall={recall:.3f}  p50={percentile_ms(lat, 50):7.2f} мс  p95={percentile_ms(lat, 95):7.2f} мс")
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,17 @@
 #Основа
 
 import asyncio
-import json
+import time
+from contextlib import aclosing
 from typing import Any, Dict, List, Optional
 
-import aiosqlite
+import numpy as np
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -22,23 +26,48 @@ from aiogram.types import (
 
 from config import (
     AGE_DELTA,
+    ANN_ENABLED,
     CANDIDATES_LIMIT,
-    DB_PATH,
+    RANK_FETCH_BATCH,
+    RANK_FULL_POOL,
+    RANK_POOL_MAX,
+    VIRTUAL_COMPACT_INTERVAL,
+    VIRTUAL_EDIT_INTERVAL,
+    VIRTUAL_STREAMING,
+    BOT_MODE,
     BOT_TOKEN,
+    TELEGRAM_API_URL,
     logger,
 )
 from db import (
+    candidate_filter,
     get_profile,
+    get_profiles,
+    get_seen_set,
     upsert_profile,
     record_interaction,
     has_interaction,
-    count_pending_likers,
     get_next_pending_liker,
     init_db,
     get_virtual_state,
     set_virtual_state,
+    compact_virtual_messages,
 )
-from ai_utils import get_text_embedding, virtual_reply, cosine_similarity
+from db_pool import close_pool, open_pool, pool
+from ai_utils import openai_governor, virtual_reply, virtual_reply_stream
+from embedding_cache import embedding_cache
+from ranking import embedding_store, to_vector
+from candidate_queue import CandidateQueues
+from ann_index import ann_index
+from embedding_worker import embedding_worker
+from user_serial import UserSerialMiddleware
+from fsm_storage import SQLiteStorage
+from profile_cache import profile_cache
+from seen_set import AnySeenSet, seen_index
+from write_batcher import write_batcher
+from metrics import HandlerMetricsMiddleware, TraceMiddleware, registry, start_metrics_server
+from outbox import PRIORITY_NOTIFY, OutboundScheduler
+from like_notifier import LikeNotifier
 
 # =========================
 # Вспомогательные функции
@@ -112,11 +141,11 @@ def virtual_partner_keyboard() -> ReplyKeyboardMarkup:
         resize_keyboard=True,
     )
 
-def profile_inline_kb() -> InlineKeyboardMarkup:
+def profile_inline_kb(target_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="👍 Лайк", callback_data="like"),
-             InlineKeyboardButton(text="👎 Дизлайк", callback_data="dislike")],
+            [InlineKeyboardButton(text="👍 Лайк", callback_data=f"like:{target_id}"),
+             InlineKeyboardButton(text="👎 Дизлайк", callback_data=f"dislike:{target_id}")],
             [InlineKeyboardButton(text="🔎 Моя анкета", callback_data="my_profile")],
             [InlineKeyboardButton(text="⛔️ Стоп", callback_data="stop_search")],
         ]
@@ -182,94 +211,180 @@ class VirtualChatFSM(StatesGroup):
 # Поиск кандидатов (SQL + ранжирование)
 # =========================
 
+async def my_embedding(me: Dict[str, Any]) -> Optional[np.ndarray]:
+    my_emb = to_vector(me.get("embedding"))
+    if my_emb is None and (me.get("description") or "").strip():
+        # Эмбеддинг посчитает фоновый воркер; до этого выдача без ранжирования
+        embedding_worker.kick(me["user_id"])
+    return my_emb
+
+async def rank_full_pool(
+    where: str, params: List[Any], seen: AnySeenSet, my_emb: np.ndarray, limit: int
+) -> List[Dict[str, Any]]:
+    # Этап 1: потоково читаем id и версии подходящих анкет, пока не наберётся
+    # RANK_POOL_MAX ещё не оценённых; эмбеддинги подгружаем только для новых
+    # или изменившихся анкет. Пул не больше матрицы эмбеддингов: иначе подгрузка
+    # вытесняла бы векторы этого же поиска, и ранжировалась бы только часть пула.
+    pool_max = min(RANK_POOL_MAX, embedding_store.max_rows)
+    eligible: List[int] = []
+    stale: List[int] = []
+    async with aclosing(pool.iterate(
+        f"SELECT user_id, updated_at FROM profiles WHERE {where}",
+        params,
+        batch_size=RANK_FETCH_BATCH,
+    )) as batches:
+        async for rows in batches:
+            unseen = seen.unseen([r["user_id"] for r in rows]).tolist()
+            for r, ok in zip(rows, unseen):
+                if not ok:
+                    continue
+                eligible.append(r["user_id"])
+                if not embedding_store.is_fresh(r["user_id"], r["updated_at"]):
+                    stale.append(r["user_id"])
+                if len(eligible) >= pool_max:
+                    break
+            if len(eligible) >= pool_max:
+                break
+    fresh = await get_profiles(stale, columns="user_id, updated_at, embedding") if stale else {}
+    # От begin до top_k нет await: параллельный поиск не вытеснит векторы пула
+    embedding_store.begin(eligible)
+    for uid, row in fresh.items():
+        embedding_store.sync(uid, row["updated_at"], row["embedding"])
+
+    # Этап 2: top-k по всему пулу; анкеты без эмбеддинга добивают выдачу в конце
+    top_ids, _ = embedding_store.top_k(my_emb, eligible, limit)
+    if len(top_ids) < limit:
+        ranked = set(top_ids)
+        for uid in eligible:
+            if uid not in ranked and uid not in embedding_store:
+                top_ids.append(uid)
+                if len(top_ids) >= limit:
+                    break
+    profiles = await get_profiles(top_ids)
+    return [profiles[uid] for uid in top_ids if uid in profiles]
+
+def matches_filter(me: Dict[str, Any], c: Dict[str, Any]) -> bool:
+    # Повторная проверка фильтра для анкет из ANN-индекса (метаданные могли устареть)
+    my_lf = me.get("looking_for") or "ANY"
+    return (
+        is_profile_complete(c)
+        and c["city"] == me["city"]
+        and (my_lf == "ANY" or c["gender"] == my_lf)
+        and (c.get("looking_for") or "ANY") in ("ANY", me["gender"])
+        and abs(c["age"] - me["age"]) <= AGE_DELTA
+    )
+
+async def rank_ann(
+    me: Dict[str, Any], seen: AnySeenSet, my_emb: np.ndarray, limit: int
+) -> Optional[List[Dict[str, Any]]]:
+    exclude = seen.ids()
+    if exclude is not None:
+        found = await ann_index.search(me, my_emb, limit, AGE_DELTA, exclude=exclude)
+    else:
+        # Фильтр Блума не перечисляет id: ищем с запасом, отсеиваем после поиска
+        # и увеличиваем k, только если просмотренные вытеснили почти всю выдачу
+        k = limit * 2
+        while True:
+            found = await ann_index.search(me, my_emb, k, AGE_DELTA)
+            if found is None:
+                break
+            unseen = seen.unseen([uid for uid, _ in found]).tolist()
+            kept = [f for f, ok in zip(found, unseen) if ok]
+            if len(kept) >= limit or len(found) < k or k >= limit + len(seen):
+                found = kept[:limit]
+                break
+            k *= 4
+    if found is None or len(found) < limit:
+        return None  # мелкий пул или мало результатов — точный поиск
+    ids = [uid for uid, _ in found]
+    profiles = await get_profiles(ids)
+    return [profiles[uid] for uid in ids if uid in profiles and matches_filter(me, profiles[uid])]
+
 async def find_candidates(user_id: int, limit: int = CANDIDATES_LIMIT) -> List[Dict[str, Any]]:
     me = await get_profile(user_id)
     if not me or not is_profile_complete(me):
         return []
 
-    my_gender = me["gender"]
-    my_lf = me.get("looking_for") or "ANY"
+    where, params = candidate_filter(me)
+    seen = await get_seen_set(user_id)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        params = [
-            user_id,
-            me["city"],
-            my_lf,
-            my_lf,
-            my_gender,
-            me["age"],
-            AGE_DELTA,
-            user_id,
-            limit,
-        ]
-        sql = """
-        SELECT * FROM profiles
-        WHERE user_id != ?
-          AND city = ?
-          AND (
-                ? = 'ANY' OR gender = ?
-          )
-          AND (
-                looking_for = 'ANY' OR looking_for = ?
-          )
-          AND ABS(age - ?) <= ?
-          AND name IS NOT NULL
-          AND age IS NOT NULL
-          AND city IS NOT NULL
-          AND gender IS NOT NULL
-          AND description IS NOT NULL
-          AND photo_file_id IS NOT NULL
-          AND user_id NOT IN (SELECT target_id FROM interactions WHERE user_id = ?)
-        LIMIT ?
-        """
-        cur = await db.execute(sql, params)
-        rows = await cur.fetchall()
-    candidates = [dict(r) for r in rows]
+    if ANN_ENABLED:
+        try:
+            my_emb = await my_embedding(me)
+            if my_emb is not None:
+                ranked = await rank_ann(me, seen, my_emb, limit)
+                if ranked:
+                    return ranked
+        except Exception as e:
+            logger.exception(f"Ошибка ANN-поиска: {e}")
+
+    if RANK_FULL_POOL:
+        try:
+            my_emb = await my_embedding(me)
+            if my_emb is not None:
+                return await rank_full_pool(where, params, seen, my_emb, limit)
+        except Exception as e:
+            logger.exception(f"Ошибка ранжирования по всему пулу: {e}")
+
+    # Без ранжирования хватает первых limit ещё не оценённых анкет
+    ids: List[int] = []
+    async with aclosing(pool.iterate(
+        f"SELECT user_id FROM profiles WHERE {where}",
+        params,
+        batch_size=max(limit * 4, 100),
+    )) as batches:
+        async for rows in batches:
+            batch = [r["user_id"] for r in rows]
+            ids.extend(uid for uid, ok in zip(batch, seen.unseen(batch).tolist()) if ok)
+            if len(ids) >= limit:
+                del ids[limit:]
+                break
+    profiles = await get_profiles(ids)
+    candidates = [profiles[uid] for uid in ids if uid in profiles]
 
     # Ранжирование по эмбеддингам описаний
     try:
-        my_emb = None
-        if me.get("embedding"):
-            try:
-                my_emb = json.loads(me["embedding"]) if isinstance(me["embedding"], str) else me["embedding"]
-            except Exception:
-                my_emb = None
+        my_emb = await my_embedding(me)
         if my_emb is None:
-            text = (me.get("description") or "").strip()
-            if text:
-                my_emb = await get_text_embedding(text)
-                await upsert_profile(user_id, embedding=my_emb)
-        if my_emb:
-            with_scores = []
-            no_emb = []
-            for c in candidates:
-                emb = None
-                if c.get("embedding"):
-                    try:
-                        emb = json.loads(c["embedding"]) if isinstance(c["embedding"], str) else c["embedding"]
-                    except Exception:
-                        emb = None
-                if emb:
-                    score = cosine_similarity(my_emb, emb)
-                    with_scores.append((score, c))
-                else:
-                    no_emb.append(c)
-            with_scores.sort(key=lambda x: x[0], reverse=True)
-            ranked = [c for _, c in with_scores] + no_emb
-            return ranked
-        else:
             return candidates
+        by_id: Dict[int, Dict[str, Any]] = {}
+        embedding_store.begin([c["user_id"] for c in candidates])
+        for c in candidates:
+            by_id[c["user_id"]] = c
+            embedding_store.sync(c["user_id"], c.get("updated_at"), c.get("embedding"))
+        ranked_ids, _ = embedding_store.rank(my_emb, list(by_id))
+        ranked_set = set(ranked_ids)
+        no_emb = [c for c in candidates if c["user_id"] not in ranked_set]
+        return [by_id[i] for i in ranked_ids] + no_emb
     except Exception as e:
         logger.exception(f"Ошибка ранжирования: {e}")
         return candidates
 
+candidate_queues = CandidateQueues(find_candidates)
+
 # =========================
 # Бот и роутеры
 # =========================
 
-bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+bot = Bot(
+    BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+)
+# Карточки анкет и уведомления уходят через очередь с учётом лимитов Telegram
+outbox = OutboundScheduler(bot)
+fsm_storage = SQLiteStorage()
+dp = Dispatcher(storage=fsm_storage)
+
+# Апдейты одного пользователя обрабатываются по очереди (см. user_serial)
+user_serial = UserSerialMiddleware()
+dp.message.middleware(user_serial)
+dp.callback_query.middleware(user_serial)
+# Время хэндлеров (после очереди пользователя) и спаны апдейтов
+handler_metrics = HandlerMetricsMiddleware()
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+dp.update.outer_middleware(TraceMiddleware())
 
 # =========================
 # Хэндлеры
@@ -405,7 +520,10 @@ async def fsm_photo(message: Message, state: FSMContext):
     photo = message.photo[-1]
     file_id = photo.file_id
     data = await state.get_data()
-    embed = await get_text_embedding(data["description"])
+    old = await get_profile(message.from_user.id)
+    extra: Dict[str, Any] = {}
+    if not old or old.get("description") != data["description"]:
+        extra["embedding"] = None  # эмбеддинг пересчитает фоновый воркер
     await upsert_profile(
         message.from_user.id,
         username=message.from_user.username,
@@ -416,8 +534,9 @@ async def fsm_photo(message: Message, state: FSMContext):
         looking_for=data["looking_for"],
         description=data["description"],
         photo_file_id=file_id,
-        embedding=embed,
+        **extra,
     )
+    embedding_worker.kick(message.from_user.id)
     await state.clear()
     p = await get_profile(message.from_user.id)
     await message.answer_photo(
@@ -558,8 +677,8 @@ async def set_new_value(message: Message, state: FSMContext):
         if not txt:
             await message.answer("Описание не может быть пустым.")
             return
-        emb = await get_text_embedding(txt)
-        await upsert_profile(message.from_user.id, description=txt, embedding=emb)
+        await upsert_profile(message.from_user.id, description=txt, embedding=None)
+        embedding_worker.kick(message.from_user.id)
     else:
         await message.answer("Неизвестное поле.")
         return
@@ -609,32 +728,39 @@ async def start_search(message: Message, state: FSMContext):
     await show_next_candidate(message.chat.id, message.from_user.id)
 
 async def show_next_candidate(chat_id: int, user_id: int):
-    candidates = await find_candidates(user_id, limit=CANDIDATES_LIMIT)
-    if not candidates:
-        await bot.send_message(chat_id, "Пока нет подходящих анкет. Попробуйте позже или измените предпочтения.")
+    me = await get_profile(user_id)
+    c = None
+    if me and is_profile_complete(me):
+        cand_id = await candidate_queues.peek(user_id, me)
+        while cand_id is not None:
+            c = await get_profile(cand_id)
+            if c:
+                break
+            # Анкета удалена, пока стояла в очереди
+            candidate_queues.consume(user_id, cand_id)
+            cand_id = await candidate_queues.peek(user_id, me)
+    if not c:
+        await (await outbox.send_message(chat_id, "Пока нет подходящих анкет. Попробуйте позже или измените предпочтения."))
         return
-    c = candidates[0]
-    await bot.send_photo(
+    await (await outbox.send_photo(
         chat_id=chat_id,
         photo=c["photo_file_id"],
         caption=profile_caption(c),
-        reply_markup=profile_inline_kb(),
+        reply_markup=profile_inline_kb(c["user_id"]),
+    ))
+
+async def notify_user_about_likes(target_user_id: int, n: int):
+    await outbox.send_message(
+        chat_id=target_user_id,
+        text=f"Вашу анкету лайкнул {n} человек",
+        reply_markup=show_likers_kb(),
+        priority=PRIORITY_NOTIFY,
+        durable=True,
     )
 
-async def notify_user_about_likes(target_user_id: int):
-    n = await count_pending_likers(target_user_id)
-    if n <= 0:
-        return
-    try:
-        await bot.send_message(
-            chat_id=target_user_id,
-            text=f"Вашу анкету лайкнул {n} человек",
-            reply_markup=show_likers_kb(),
-        )
-    except Exception as e:
-        logger.warning(f"Не удалось отправить уведомление о лайках пользователю {target_user_id}: {e}")
+like_notifier = LikeNotifier(notify_user_about_likes)
 
-@dp.callback_query(F.data.in_(("like", "dislike")))
+@dp.callback_query(F.data.startswith("like:") | F.data.startswith("dislike:") | F.data.in_(("like", "dislike")))
 async def on_like_dislike(call: CallbackQuery):
     user_id = call.from_user.id
     p = await get_profile(user_id)
@@ -642,34 +768,58 @@ async def on_like_dislike(call: CallbackQuery):
         await call.answer("Сначала создайте анкету.", show_alert=True)
         return
 
-    # Берем актуального первого кандидата из общего поиска
-    candidates = await find_candidates(user_id, limit=1)
-    if not candidates:
+    action, _, target = call.data.partition(":")
+    if target:
+        # id анкеты из кнопки — оценка всегда относится к показанной анкете
+        try:
+            target_id: Optional[int] = int(target)
+        except ValueError:
+            await call.answer("Ошибка.", show_alert=True)
+            return
+    else:
+        # Кнопки старого формата без id: берём текущую анкету из очереди
+        target_id = await candidate_queues.peek(user_id, p)
+    cand = await get_profile(target_id) if target_id is not None else None
+    if not cand:
         await call.answer("Подходящих анкет нет.", show_alert=True)
         try:
             await call.message.edit_reply_markup(reply_markup=None)
         except Exception:
             pass
         return
-    cand = candidates[0]
-    action = "like" if call.data == "like" else "dislike"
+    if await has_interaction(user_id, cand["user_id"]):
+        # Повторное нажатие на уже оценённую анкету
+        await call.answer("Уже сохранено.")
+        try:
+            await call.message.edit_reply_markup(reply_markup=None)
+        except Exception:
+            pass
+        return
+
     await record_interaction(user_id, cand["user_id"], action)
+    candidate_queues.consume(user_id, cand["user_id"])
+
+    # Проверка взаимности; оценка анкеты, которая уже лайкнула пользователя, закрывает её лайк
+    mutual = await has_interaction(cand["user_id"], user_id, "like")
+    if mutual:
+        like_notifier.resolved(user_id)
 
     if action == "like":
-        # Проверка взаимности
-        mutual = await has_interaction(cand["user_id"], user_id, "like")
         if mutual:
             text_for_me = "Вы понравились:\n\n" + profile_caption(cand, include_username=True)
-            await call.message.answer_photo(photo=cand["photo_file_id"], caption=text_for_me)
+            await (await outbox.send_photo(call.message.chat.id, photo=cand["photo_file_id"], caption=text_for_me))
 
             me = await get_profile(user_id)
-            try:
-                text_for_them = "Вы понравились:\n\n" + profile_caption(me, include_username=True)
-                await bot.send_photo(chat_id=cand["user_id"], photo=me["photo_file_id"], caption=text_for_them)
-            except Exception as e:
-                logger.warning(f"Не удалось уведомить вторую сторону о взаимном лайке: {e}")
+            text_for_them = "Вы понравились:\n\n" + profile_caption(me, include_username=True)
+            await outbox.send_photo(
+                cand["user_id"],
+                photo=me["photo_file_id"],
+                caption=text_for_them,
+                priority=PRIORITY_NOTIFY,
+                durable=True,
+            )
         else:
-            await notify_user_about_likes(cand["user_id"])
+            like_notifier.liked(cand["user_id"])
 
     await call.answer("Сохранено.")
     try:
@@ -688,15 +838,15 @@ async def cb_show_likers(call: CallbackQuery):
 async def show_next_liker(chat_id: int, user_id: int):
     liker = await get_next_pending_liker(user_id)
     if not liker:
-        await bot.send_message(chat_id, "Лайкнувших больше нет.", reply_markup=None)
-        await bot.send_message(chat_id, "Перейти к просмотру анкет:", reply_markup=go_to_search_kb())
+        await outbox.send_message(chat_id, "Лайкнувших больше нет.")
+        await (await outbox.send_message(chat_id, "Перейти к просмотру анкет:", reply_markup=go_to_search_kb()))
         return
-    await bot.send_photo(
+    await (await outbox.send_photo(
         chat_id=chat_id,
         photo=liker["photo_file_id"],
         caption=profile_caption(liker),
         reply_markup=likers_inline_kb(liker["user_id"]),
-    )
+    ))
 
 @dp.callback_query(F.data.startswith("liker_like:"))
 async def cb_liker_like(call: CallbackQuery):
@@ -717,18 +867,24 @@ async def cb_liker_like(call: CallbackQuery):
         await show_next_liker(call.message.chat.id, user_id)
         return
 
+    answered = await has_interaction(user_id, liker_id)
     await record_interaction(user_id, liker_id, "like")
+    if not answered:
+        like_notifier.resolved(user_id)
 
     liker_profile = await get_profile(liker_id)
     me = await get_profile(user_id)
     if liker_profile and me:
         text_for_me = "Вы понравились:\n\n" + profile_caption(liker_profile, include_username=True)
-        await call.message.answer_photo(photo=liker_profile["photo_file_id"], caption=text_for_me)
-        try:
-            text_for_them = "Вы понравились:\n\n" + profile_caption(me, include_username=True)
-            await bot.send_photo(chat_id=liker_id, photo=me["photo_file_id"], caption=text_for_them)
-        except Exception as e:
-            logger.warning(f"Не удалось уведомить лайкнувшего о взаимности: {e}")
+        await (await outbox.send_photo(call.message.chat.id, photo=liker_profile["photo_file_id"], caption=text_for_me))
+        text_for_them = "Вы понравились:\n\n" + profile_caption(me, include_username=True)
+        await outbox.send_photo(
+            liker_id,
+            photo=me["photo_file_id"],
+            caption=text_for_them,
+            priority=PRIORITY_NOTIFY,
+            durable=True,
+        )
 
     await call.answer("Лайк!")
     try:
@@ -746,7 +902,10 @@ async def cb_liker_dislike(call: CallbackQuery):
         await call.answer("Ошибка.", show_alert=True)
         return
 
+    pending = await has_interaction(liker_id, user_id, "like") and not await has_interaction(user_id, liker_id)
     await record_interaction(user_id, liker_id, "dislike")
+    if pending:
+        like_notifier.resolved(user_id)
 
     await call.answer("Дизлайк.")
     try:
@@ -821,8 +980,57 @@ async def back_to_menu(message: Message, state: FSMContext):
     await state.clear()
     await message.answer("Меню:", reply_markup=main_menu())
 
-@dp.message(VirtualChatFSM.chatting)
-async def virtual_chatting(message: Message, state: FSMContext):
+async def stream_virtual_answer(
+    message: Message,
+    p: Dict[str, Any],
+    partner_gender: str,
+    history: List[Dict[str, str]],
+    text: str,
+) -> str:
+    # Сразу отправляем заглушку и дописываем её по мере генерации,
+    # правя сообщение не чаще VIRTUAL_EDIT_INTERVAL
+    placeholder = await message.answer("…", reply_markup=virtual_partner_keyboard(), parse_mode=None)
+    shown = "…"
+    answer = ""
+    next_edit = time.monotonic() + VIRTUAL_EDIT_INTERVAL
+
+    async def edit(text: str) -> None:
+        nonlocal shown, next_edit
+        try:
+            await bot.edit_message_text(
+                text=text,
+                chat_id=placeholder.chat.id,
+                message_id=placeholder.message_id,
+                parse_mode=None,
+            )
+            shown = text
+            next_edit = time.monotonic() + VIRTUAL_EDIT_INTERVAL
+        except TelegramRetryAfter as e:
+            next_edit = time.monotonic() + e.retry_after
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                shown = text
+            else:
+                logger.warning(f"Не удалось обновить потоковый ответ: {e}")
+                shown = text  # не повторяем заведомо отклонённую правку
+
+    async for answer in virtual_reply_stream(p, partner_gender, history, text):
+        if time.monotonic() >= next_edit and answer.strip() and answer != shown:
+            await edit(answer)
+    answer = answer.strip() or "…"
+    # Финальная правка обязательна: ждём окно и повторяем после RetryAfter
+    for _ in range(3):
+        if answer == shown:
+            break
+        if time.monotonic() < next_edit:
+            await asyncio.sleep(next_edit - time.monotonic())
+        await edit(answer)
+    return answer
+
+@dp.message(VirtualChatFSM.chatting, flags={"coalesce": True})
+async def virtual_chatting(message: Message, state: FSMContext, coalesced_text: Optional[str] = None):
+    # coalesced_text — сообщения, присланные подряд, пока готовился прошлый ответ
+    text = coalesced_text if coalesced_text is not None else (message.text or "")
     p = await get_profile(message.from_user.id)
     if not p:
         await message.answer("Сначала создайте анкету.")
@@ -832,12 +1040,40 @@ async def virtual_chatting(message: Message, state: FSMContext):
         await message.answer("Сначала выберите виртуального собеседника.")
         await state.set_state(VirtualChatFSM.choose_partner)
         return
-    history.append({"role": "user", "content": (message.text or "").strip()})
-    answer = await virtual_reply(p, partner_gender, history, message.text or "")
+    history.append({"role": "user", "content": text.strip()})
+    if VIRTUAL_STREAMING:
+        answer = await stream_virtual_answer(message, p, partner_gender, history, text)
+    else:
+        answer = await virtual_reply(p, partner_gender, history, text)
     history.append({"role": "assistant", "content": answer})
     history = history[-20:]
     await set_virtual_state(message.from_user.id, partner_gender, history)
-    await message.answer(answer, reply_markup=virtual_partner_keyboard())
+    if not VIRTUAL_STREAMING:
+        await message.answer(answer, reply_markup=virtual_partner_keyboard())
+
+async def housekeeping_periodically() -> None:
+    # Чистка старых сообщений виртуальных чатов и просроченных состояний FSM, статистика кэшей
+    while True:
+        await asyncio.sleep(VIRTUAL_COMPACT_INTERVAL)
+        try:
+            deleted = await compact_virtual_messages()
+            if deleted:
+                logger.info(f"Виртуальные чаты: удалено старых сообщений {deleted}")
+            expired = await fsm_storage.purge_expired()
+            if expired:
+                logger.info(f"FSM: удалено просроченных состояний {expired}")
+            stats = profile_cache.stats()
+            logger.info(
+                f"Кэш анкет: {stats['items']} в памяти, попаданий {stats['hit_rate']:.1%} "
+                f"({stats['hits']}/{stats['hits'] + stats['misses']})"
+            )
+            stats = seen_index.stats()
+            logger.info(
+                f"Просмотренные анкеты: {stats['items']} пользователей, {stats['bytes'] / 1024 / 1024:.1f} МБ, "
+                f"попаданий {stats['hit_rate']:.1%}, вытеснено {stats['evictions']}"
+            )
+        except Exception as e:
+            logger.exception(f"Ошибка периодической чистки: {e}")
 
 # =========================
 # Команды
@@ -855,17 +1091,96 @@ async def cmd_search(message: Message, state: FSMContext):
 # Запуск
 # =========================
 
-async def main():
-    from ai_utils import aclose_http_client
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+_background_tasks: List[asyncio.Task] = []
+_metrics_runner = None
+
+registry.gauge(
+    "bot_cache_hit_ratio",
+    "Доля попаданий в кэш",
+    ("cache",),
+    lambda: {
+        ("profiles",): profile_cache.stats()["hit_rate"],
+        ("seen",): seen_index.stats()["hit_rate"],
+        ("embeddings",): embedding_cache.stats()["hit_rate"],
+        ("fsm",): fsm_storage.stats()["hit_rate"],
+    },
+)
+registry.gauge(
+    "bot_cache_items",
+    "Записей в кэше в памяти",
+    ("cache",),
+    lambda: {
+        ("profiles",): profile_cache.stats()["items"],
+        ("seen",): seen_index.stats()["items"],
+        ("embedding_store",): embedding_store.stats()["items"],
+        ("embeddings",): embedding_cache.stats()["memory_items"],
+        ("fsm",): fsm_storage.stats()["cached"],
+    },
+)
+registry.gauge(
+    "bot_queue_depth",
+    "Длина очередей",
+    ("queue",),
+    lambda: {
+        ("outbox",): outbox.stats()["queued"],
+        ("outbox_sending",): outbox.stats()["sending"],
+        ("openai_waiting",): openai_governor.stats()["waiting"],
+        ("openai_in_flight",): openai_governor.stats()["in_flight"],
+        ("fsm_dirty",): fsm_storage.stats()["dirty"],
+        ("write_batch",): write_batcher.stats()["queued"],
+        ("like_windows",): like_notifier.stats()["windows"],
+    },
+)
+
+@dp.startup()
+async def on_startup():
+    await open_pool()
     await init_db()
-    logger.info("Бот запускается...")
+    embedding_worker.start()
+    await outbox.start()
+    await like_notifier.reconcile()
+    _background_tasks.append(asyncio.create_task(housekeeping_periodically()))
+    global _metrics_runner
+    _metrics_runner = await start_metrics_server()
+
+@dp.shutdown()
+async def on_shutdown():
+    from ai_utils import aclose_http_client
+    global _metrics_runner
+    for task in _background_tasks:
+        task.cancel()
+    _background_tasks.clear()
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
+    await like_notifier.stop()
+    await outbox.stop()
+    await embedding_worker.stop()
+    await write_batcher.stop()
     try:
-        await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
-    finally:
-        try:
-            await aclose_http_client()
-        except Exception as e:
-            logger.warning(f"Ошибка при закрытии HTTP-клиента OpenAI: {e}")
+        await fsm_storage.close()
+    except Exception as e:
+        logger.warning(f"Ошибка при сохранении состояний FSM: {e}")
+    try:
+        await aclose_http_client()
+    except Exception as e:
+        logger.warning(f"Ошибка при закрытии HTTP-клиента OpenAI: {e}")
+    try:
+        await close_pool()
+    except Exception as e:
+        logger.warning(f"Ошибка при закрытии пула БД: {e}")
+
+async def main():
+    logger.info(f"Бот запускается ({BOT_MODE})...")
+    if BOT_MODE == "webhook":
+        from webhook import run_webhook
+        await run_webhook(bot, dp, ALLOWED_UPDATES)
+    else:
+        # Вебхук и getUpdates взаимоисключающие
+        await bot.delete_webhook()
+        await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     try:
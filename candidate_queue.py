@@ -0,0 +1,158 @@
+#Очередь кандидатов на пользователя
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from config import (
+    CANDIDATE_QUEUE_EMPTY_TTL,
+    CANDIDATE_QUEUE_MAX_USERS,
+    CANDIDATE_QUEUE_REFILL_AT,
+    CANDIDATE_QUEUE_TTL,
+    CANDIDATES_LIMIT,
+    logger,
+)
+from db import has_interaction
+
+FetchCandidates = Callable[[int, int], Awaitable[List[Dict[str, Any]]]]
+
+# Поля анкеты, от которых зависит подбор: их изменение сбрасывает очередь
+_FINGERPRINT_FIELDS = ("city", "age", "gender", "looking_for", "description")
+
+def profile_fingerprint(me: Dict[str, Any]) -> Tuple[Any, ...]:
+    # Появление эмбеддинга (его считает фоновый воркер) тоже пересобирает
+    # очередь, чтобы неранжированная выдача сменилась ранжированной
+    return tuple(me.get(k) for k in _FINGERPRINT_FIELDS) + (me.get("embedding") is not None,)
+
+class _Entry:
+    __slots__ = ("ids", "fingerprint", "expires_at", "exhausted", "refill")
+
+    def __init__(self, fingerprint: Tuple[Any, ...]):
+        self.ids: Deque[int] = deque()
+        self.fingerprint = fingerprint
+        self.expires_at = 0.0
+        self.exhausted = False  # последний поиск не дал новых анкет
+        self.refill: Optional[asyncio.Task] = None
+
+class CandidateQueues:
+    # Ранжированная очередь id кандидатов: считается один раз, голова — анкета,
+    # показанная пользователю; после свайпа снимается, при нехватке — фоновая дозагрузка.
+
+    def __init__(
+        self,
+        fetch: FetchCandidates,
+        ttl: float = CANDIDATE_QUEUE_TTL,
+        max_users: int = CANDIDATE_QUEUE_MAX_USERS,
+        refill_at: int = CANDIDATE_QUEUE_REFILL_AT,
+        batch: int = CANDIDATES_LIMIT,
+    ):
+        self._fetch = fetch
+        self.ttl = ttl
+        self.max_users = max_users
+        self.refill_at = refill_at
+        self.batch = batch
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def invalidate(self, user_id: int) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry and entry.refill and not entry.refill.done():
+            entry.refill.cancel()
+
+    def _touch(self, user_id: int, me: Dict[str, Any]) -> _Entry:
+        fp = profile_fingerprint(me)
+        entry = self._entries.get(user_id)
+        if entry is not None and (entry.fingerprint != fp or entry.expires_at <= time.monotonic()):
+            self.invalidate(user_id)
+            entry = None
+        if entry is None:
+            entry = _Entry(fp)
+            self._entries[user_id] = entry
+            while len(self._entries) > self.max_users:
+                old_id = next(iter(self._entries))
+                self.invalidate(old_id)
+        else:
+            self._entries.move_to_end(user_id)
+        return entry
+
+    async def _fill(self, user_id: int, entry: _Entry) -> None:
+        candidates = await self._fetch(user_id, self.batch)
+        if self._entries.get(user_id) is not entry:
+            return  # очередь успели сбросить, пока шёл поиск
+        queued = set(entry.ids)
+        added = 0
+        for c in candidates:
+            if c["user_id"] not in queued:
+                entry.ids.append(c["user_id"])
+                added += 1
+        entry.exhausted = added == 0
+        # Пустую очередь держим недолго, чтобы быстро увидеть новые анкеты
+        entry.expires_at = time.monotonic() + (self.ttl if entry.ids else min(self.ttl, CANDIDATE_QUEUE_EMPTY_TTL))
+
+    def _schedule_refill(self, user_id: int, entry: _Entry) -> None:
+        if entry.exhausted:
+            return
+        if entry.refill is None or entry.refill.done():
+            entry.refill = asyncio.create_task(self._refill_safe(user_id, entry))
+
+    async def _refill_safe(self, user_id: int, entry: _Entry) -> None:
+        try:
+            await self._fill(user_id, entry)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Не удалось дозагрузить очередь кандидатов для {user_id}: {e}")
+
+    async def peek(self, user_id: int, me: Dict[str, Any]) -> Optional[int]:
+        # id анкеты, которую надо показать сейчас (None — подходящих нет)
+        entry = self._touch(user_id, me)
+        if not entry.ids:
+            if entry.refill is None or entry.refill.done():
+                if entry.exhausted:
+                    return None  # пусто и недавно проверяли — ждём истечения TTL
+                await self._fill(user_id, entry)
+            else:
+                try:
+                    await entry.refill
+                except asyncio.CancelledError:
+                    task = asyncio.current_task()
+                    if task is not None and task.cancelling():
+                        raise
+                    # Дозагрузку отменил invalidate (вытеснение из LRU другим
+                    # пользователем или смена анкеты) — собираем очередь заново
+                    entry = self._touch(user_id, me)
+                    await self._fill(user_id, entry)
+            if self._entries.get(user_id) is not entry:
+                return await self._first_unseen(user_id)
+        while entry.ids:
+            head = entry.ids[0]
+            # Анкета могла быть оценена другим путём (например, из списка лайкнувших)
+            if not await has_interaction(user_id, head):
+                break
+            entry.ids.popleft()
+        if len(entry.ids) <= self.refill_at:
+            self._schedule_refill(user_id, entry)
+        return entry.ids[0] if entry.ids else None
+
+    async def _first_unseen(self, user_id: int) -> Optional[int]:
+        # Без очереди: её снова сбросили, пока шёл поиск
+        for c in await self._fetch(user_id, self.batch):
+            if not await has_interaction(user_id, c["user_id"]):
+                return c["user_id"]
+        return None
+
+    def consume(self, user_id: int, target_id: int) -> None:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        try:
+            entry.ids.remove(target_id)
+        except ValueError:
+            pass
+        if not entry.ids:
+            entry.expires_at = min(entry.expires_at, time.monotonic() + CANDIDATE_QUEUE_EMPTY_TTL)
+        if len(entry.ids) <= self.refill_at:
+            self._schedule_refill(user_id, entry)
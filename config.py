@@ -4,20 +4,99 @@ import logging
 import os
 
 # Конфиг из переменных окружения
-BOT_TOKEN = "xxx"
-OPENAI_API_KEY = "xxx"
+BOT_TOKEN = os.getenv("BOT_TOKEN", "xxx")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "xxx")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # свой Bot API сервер или заглушка loadgen.py; пусто — api.telegram.org
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "")  # например http://127.0.0.1:8082/v1; пусто — api.openai.com
 
 if not BOT_TOKEN or BOT_TOKEN == "TELEGRAM_BOT_TOKEN_HERE":
     raise RuntimeError("Укажите реальный BOT_TOKEN в переменной BOT_TOKEN в коде.")
 if not OPENAI_API_KEY or OPENAI_API_KEY == "OPENAI_API_KEY_HERE":
     raise RuntimeError("Укажите реальный OPENAI_API_KEY в переменной OPENAI_API_KEY в коде.")
 
-DB_PATH = "dating_bot.sqlite3"
+BOT_MODE = "polling"  # "polling" или "webhook"
+WEBHOOK_BASE_URL = ""  # публичный https-адрес бота, например https://bot.example.com
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET = ""  # X-Telegram-Bot-Api-Secret-Token; пустая строка — без проверки
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_MAX_CONNECTIONS = 40  # одновременных соединений от Telegram (1-100)
+WEBHOOK_MAX_HANDLERS = 64  # апдейтов, обрабатываемых одновременно
+WEBHOOK_MAX_BACKLOG = 1000  # апдейтов в очереди, после которых отвечаем 503 и Telegram повторит позже
+WEBHOOK_DRAIN_TIMEOUT = 25.0  # сек на завершение начатых апдейтов при остановке
+
+DB_PATH = os.getenv("DB_PATH", "dating_bot.sqlite3")
 AGE_DELTA = 2  # возрастной допуск при поиске (±2 года)
 CANDIDATES_LIMIT = 30  # размер пула кандидатов для подбора
+RANK_FULL_POOL = True  # ранжировать всех подходящих, а не первые CANDIDATES_LIMIT строк
+RANK_POOL_MAX = 50_000  # максимум анкет, ранжируемых за один поиск (не больше EMBED_STORE_MAX_ROWS)
+RANK_FETCH_BATCH = 5000  # размер пачки при потоковом чтении пула
+ANN_ENABLED = False  # приближённый поиск (IVF) для больших городов
+ANN_MIN_PARTITION = 20_000  # ANN включается, когда в пуле больше анкет
+ANN_NPROBE = 16  # сколько IVF-списков просматривать за поиск
+ANN_TRAIN_SAMPLE = 20_000  # размер выборки для обучения центроидов
+ANN_KMEANS_ITERS = 10  # итераций k-means
+CANDIDATE_QUEUE_TTL = 600  # сек, время жизни очереди кандидатов пользователя
+CANDIDATE_QUEUE_EMPTY_TTL = 30  # сек, сколько помнить, что кандидатов нет
+CANDIDATE_QUEUE_MAX_USERS = 10_000  # LRU-лимит очередей в памяти
+CANDIDATE_QUEUE_REFILL_AT = 5  # дозагружать очередь, когда осталось столько анкет
 EMBED_MODEL = "text-embedding-3-small"
 CHAT_MODEL = "gpt-4o-mini"
 OPENAI_TIMEOUT = 30.0  # секунды
+OPENAI_RATE_LIMITS = {  # модель: (запросов в минуту, токенов в минуту) — по лимитам аккаунта
+    CHAT_MODEL: (500, 200_000),
+    EMBED_MODEL: (3000, 1_000_000),
+}
+OPENAI_MAX_INFLIGHT = 16  # одновременных запросов к OpenAI
+OPENAI_BACKGROUND_INFLIGHT = 12  # из них фоновых (эмбеддинги); остальные слоты — только для чата
+OPENAI_INTERACTIVE_RESERVE = 0.1  # доля минутной квоты, недоступная фоновым запросам
+OPENAI_CHAT_RETRIES = 2  # повторов ответа виртуального собеседника при 429/сбое сети
+VIRTUAL_STREAMING = True  # показывать ответ виртуального собеседника по мере генерации
+VIRTUAL_EDIT_INTERVAL = 1.0  # сек между правками сообщения (лимиты Telegram)
+VIRTUAL_HISTORY_KEEP = 20  # сообщений виртуального чата хранится на пользователя
+VIRTUAL_COMPACT_INTERVAL = 3600  # сек между чистками старых сообщений виртуального чата
+FSM_STATE_TTL = 7 * 24 * 3600  # сек; состояние FSM без изменений дольше — сбрасывается
+FSM_CACHE_MAX = 50_000  # состояний FSM в памяти
+FSM_FLUSH_INTERVAL = 1.0  # сек, задержка отложенной записи состояний FSM в БД
+FSM_FLUSH_MAX = 500  # изменений, при которых запись в БД идёт сразу
+OUTBOX_GLOBAL_PER_SEC = 30  # сообщений в секунду от бота всего (лимит Telegram)
+OUTBOX_CHAT_PER_SEC = 1.0  # уведомлений в секунду в один чат (ответы пользователю — только под общий лимит)
+OUTBOX_CHAT_BURST = 3  # сколько уведомлений подряд можно отправить в чат без паузы
+OUTBOX_CONCURRENCY = 8  # одновременных запросов отправки
+OUTBOX_MAX_ATTEMPTS = 5  # попыток при сетевых ошибках и 5xx
+OUTBOX_DRAIN_TIMEOUT = 10.0  # сек на отправку очереди при остановке
+LIKE_NOTIFY_WINDOW = 60  # сек, за которые лайки копятся в одно уведомление
+USER_SERIAL_MAX_USERS = 10_000  # пользователей с очередью апдейтов в памяти
+USER_SERIAL_IDLE_TTL = 300  # сек, после которых свободная очередь пользователя удаляется
+PROFILE_CACHE_MAX = 10_000  # анкет в памяти (с эмбеддингом ~6 КБ каждая)
+SEEN_MODE = "exact"  # просмотренные анкеты: "exact" — массивы id (8 байт на оценку), "bloom" — фильтр Блума
+SEEN_CACHE_MAX_BYTES = 64 * 1024 * 1024  # память под наборы просмотренных анкет (байты)
+SEEN_BLOOM_FP_RATE = 0.01  # доля непросмотренных анкет, которые фильтр Блума ошибочно скроет
+EMBED_BATCH_WINDOW_MS = 10  # окно сбора текстов в один запрос эмбеддингов
+EMBED_BATCH_MAX_ITEMS = 64  # максимум текстов в одном запросе
+EMBED_BATCH_CONCURRENCY = 4  # параллельных запросов эмбеддингов
+EMBED_MAX_RETRIES = 3  # повторов при RateLimit/ошибке соединения
+EMBED_BACKFILL_BATCH = 100  # анкет за одну пачку фонового пересчёта
+EMBED_BACKFILL_PER_MIN = 1000  # предел текстов в минуту для фонового пересчёта
+EMBED_BACKFILL_IDLE = 300  # сек между полными проходами по таблице
+EMBED_CACHE_MAX_BYTES = 64 * 1024 * 1024  # LRU-кэш эмбеддингов в памяти (байты)
+EMBED_CACHE_MAX_ROWS = 200_000  # предел строк кэша эмбеддингов в БД
+EMBED_STORE_MAX_ROWS = 50_000  # векторов в матрице ранжирования в памяти (1536-мерный ≈ 6 КБ); лишние вытесняются
+
+# Пул соединений SQLite
+DB_READ_POOL_SIZE = 4  # число соединений на чтение
+DB_BUSY_TIMEOUT_MS = 5000  # ожидание блокировки БД
+DB_CACHE_SIZE_KB = 16384  # кэш страниц на соединение (КиБ)
+DB_MMAP_SIZE = 256 * 1024 * 1024  # размер memory-mapped I/O (байты)
+WRITE_BATCH_WINDOW_MS = 5  # под нагрузкой записи копятся в одну транзакцию не дольше стольких мс
+WRITE_BATCH_MAX_OPS = 256  # максимум операций записи в одной транзакции
+DB_SLOW_QUERY_MS = 100  # запросы и транзакции дольше — в лог с текстом SQL; 0 — не логировать
+
+# Метрики и трассировка
+METRICS_HOST = "127.0.0.1"  # адрес эндпоинта /metrics (формат Prometheus)
+METRICS_PORT = 9108  # 0 — эндпоинт выключен
+TRACE_UPDATES = False  # писать в лог спаны каждого апдейта (хэндлер, запросы к БД, OpenAI)
+TRACE_SLOW_MS = 0  # при TRACE_UPDATES — только апдейты дольше стольких мс
 
 # Логирование
 logging.basicConfig(level=logging.INFO)
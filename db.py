@@ -1,12 +1,19 @@
 #Управление БД
 
+import asyncio
 import json
 import time
 from typing import Any, Dict, List, Optional, Tuple
 
 import aiosqlite
 
-from config import DB_PATH
+from ann_index import ann_index
+from config import AGE_DELTA, VIRTUAL_HISTORY_KEEP, logger
+from db_pool import pool
+from profile_cache import PROFILE_FIELDS, Profile, profile_cache
+from ranking import embedding_model_prefix, embedding_store, pack_embedding, to_vector
+from seen_set import AnySeenSet, seen_index
+from write_batcher import write_batcher
 
 CREATE_TABLES_SQL = """
 CREATE TABLE IF NOT EXISTS profiles (
@@ -19,7 +26,7 @@ CREATE TABLE IF NOT EXISTS profiles (
     looking_for TEXT, -- 'M' 'F' 'ANY'
     description TEXT,
     photo_file_id TEXT,
-    embedding TEXT, -- JSON of floats
+    embedding BLOB, -- float32, see ranking.pack_embedding (legacy rows: JSON text)
     updated_at INTEGER
 );
 
@@ -34,182 +41,558 @@ CREATE TABLE IF NOT EXISTS interactions (
 CREATE TABLE IF NOT EXISTS virtual_chats (
     user_id INTEGER PRIMARY KEY,
     partner_gender TEXT, -- 'M' or 'F'
-    history TEXT, -- JSON list [{role, content}]
+    history TEXT, -- устарело: сообщения хранятся в virtual_messages
     updated_at INTEGER
 );
 """
 
+# Лайки без ответа, вычисленные по сырой таблице interactions: источник для
+# заполнения и сверки материализованной таблицы pending_likes
+PENDING_FROM_INTERACTIONS_SQL = """
+SELECT i.target_id, i.user_id AS liker_id, i.ts
+FROM interactions i
+WHERE i.action = 'like'
+  AND NOT EXISTS (
+        SELECT 1 FROM interactions x
+        WHERE x.user_id = i.target_id
+          AND x.target_id = i.user_id
+    )
+"""
+
+# Миграции схемы: (версия, SQL). init_db применяет их по порядку поверх
+# CREATE_TABLES_SQL, номер последней применённой хранится в PRAGMA user_version.
+MIGRATIONS: List[Tuple[int, str]] = [
+    (1, """
+    -- count_pending_likers / get_next_pending_liker: фильтр по target_id/action, сортировка по ts
+    CREATE INDEX IF NOT EXISTS idx_interactions_target ON interactions(target_id, action, ts, user_id);
+    -- find_candidates: город, пол, диапазон возраста
+    CREATE INDEX IF NOT EXISTS idx_profiles_search ON profiles(city, gender, age);
+    """),
+    (2, """
+    -- кэш эмбеддингов: (модель, sha256 нормализованного текста) -> float32 BLOB
+    CREATE TABLE IF NOT EXISTS embedding_cache (
+        model TEXT NOT NULL,
+        text_hash BLOB NOT NULL,
+        embedding BLOB NOT NULL,
+        created_at INTEGER,
+        PRIMARY KEY (model, text_hash)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_embedding_cache_created ON embedding_cache(created_at);
+    """),
+    (3, """
+    -- состояние фоновых задач (курсор дозаполнения эмбеддингов и т.п.)
+    CREATE TABLE IF NOT EXISTS worker_state (
+        name TEXT PRIMARY KEY,
+        value TEXT, -- JSON
+        updated_at INTEGER
+    );
+    """),
+    (4, """
+    -- история виртуального чата: одна строка на сообщение, дописывается без перезаписи
+    CREATE TABLE IF NOT EXISTS virtual_messages (
+        user_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT,
+        ts INTEGER,
+        PRIMARY KEY (user_id, seq)
+    ) WITHOUT ROWID;
+    -- перенос старых JSON-историй
+    INSERT OR IGNORE INTO virtual_messages (user_id, seq, role, content, ts)
+        SELECT v.user_id, CAST(j.key AS INTEGER), json_extract(j.value, '$.role'),
+               json_extract(j.value, '$.content'), v.updated_at
+        FROM virtual_chats v, json_each(v.history) j
+        WHERE json_valid(v.history) AND json_extract(j.value, '$.role') IS NOT NULL;
+    UPDATE virtual_chats SET history = NULL WHERE history IS NOT NULL;
+    """),
+    (5, """
+    -- состояния FSM aiogram (fsm_storage.SQLiteStorage)
+    CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY, -- bot:chat:user:thread:business:destiny
+        state TEXT,
+        data TEXT, -- JSON
+        updated_at INTEGER
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at);
+    """),
+    (6, """
+    -- исходящие уведомления, ещё не доставленные в Telegram (outbox.OutboundScheduler)
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        priority INTEGER NOT NULL,
+        method TEXT NOT NULL, -- send_message / send_photo
+        payload TEXT NOT NULL, -- JSON с аргументами метода
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER
+    );
+    """),
+    (7, f"""
+    -- входящие лайки без ответа; ведётся в record_interaction
+    CREATE TABLE IF NOT EXISTS pending_likes (
+        target_id INTEGER NOT NULL,
+        liker_id INTEGER NOT NULL,
+        ts INTEGER,
+        PRIMARY KEY (target_id, liker_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_pending_likes_ts ON pending_likes(target_id, ts, liker_id);
+    INSERT OR REPLACE INTO pending_likes (target_id, liker_id, ts) {PENDING_FROM_INTERACTIONS_SQL};
+    """),
+    (8, """
+    -- входящие лайки читаются из pending_likes; индекс по target_id только замедлял каждую оценку
+    DROP INDEX IF EXISTS idx_interactions_target;
+    """),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Лайки без ответа берутся из pending_likes — диапазон по первичному ключу
+COUNT_PENDING_LIKERS_SQL = """
+SELECT COUNT(*)
+FROM pending_likes
+WHERE target_id = ?
+"""
+
+NEXT_PENDING_LIKER_SQL = """
+SELECT liker_id
+FROM pending_likes
+WHERE target_id = ?
+ORDER BY ts ASC, liker_id ASC
+LIMIT 1
+"""
+
+# Последние N сообщений виртуального чата: обратный проход по (user_id, seq)
+VIRTUAL_HISTORY_SQL = """
+SELECT seq, role, content
+FROM virtual_messages
+WHERE user_id = ?
+ORDER BY seq DESC
+LIMIT ?
+"""
+
 def now_ts() -> int:
     return int(time.time())
 
+def encode_embedding(value: Any) -> Optional[bytes]:
+    # Список/вектор/старый JSON -> компактный float32 BLOB
+    if value is None or isinstance(value, bytes):
+        return value
+    vec = to_vector(value)
+    return pack_embedding(vec) if vec is not None else None
+
+async def get_schema_version() -> int:
+    row = await pool.fetchone("PRAGMA user_version")
+    return int(row[0]) if row else 0
+
 async def init_db() -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.writer() as db:
         await db.executescript(CREATE_TABLES_SQL)
-        await db.commit()
+        async with db.execute("PRAGMA user_version") as cur:
+            version = (await cur.fetchone())[0]
+        for target, sql in MIGRATIONS:
+            if target <= version:
+                continue
+            # Каждая миграция атомарна вместе с записью номера версии
+            await db.executescript(f"BEGIN;\n{sql}\nPRAGMA user_version = {target};\nCOMMIT;")
+            version = target
 
-async def get_profile(user_id: int) -> Optional[Dict[str, Any]]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("SELECT * FROM profiles WHERE user_id = ?", (user_id,))
-        row = await cur.fetchone()
-    return dict(row) if row else None
-
-async def upsert_profile(user_id: int, **kwargs) -> None:
-    existing = await get_profile(user_id)
-    fields = [
-        "username",
-        "name",
-        "age",
-        "city",
-        "gender",
-        "looking_for",
-        "description",
-        "photo_file_id",
-        "embedding",
-        "updated_at",
+def candidate_filter(me: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    # WHERE-условие подбора анкет для пользователя me. Возраст задан диапазоном,
+    # а «любой пол» — через IN, чтобы поиск шёл по индексу idx_profiles_search.
+    # Уже оценённые анкеты отсеиваются после выборки по набору из get_seen_set.
+    my_lf = me.get("looking_for") or "ANY"
+    genders = ("M", "F") if my_lf == "ANY" else (my_lf,)
+    sql = f"""
+    user_id != ?
+      AND city = ?
+      AND gender IN ({",".join("?" * len(genders))})
+      AND (
+            looking_for = 'ANY' OR looking_for = ?
+      )
+      AND age BETWEEN ? AND ?
+      AND name IS NOT NULL
+      AND age IS NOT NULL
+      AND city IS NOT NULL
+      AND gender IS NOT NULL
+      AND description IS NOT NULL
+      AND photo_file_id IS NOT NULL
+    """
+    params = [
+        me["user_id"],
+        me["city"],
+        *genders,
+        me["gender"],
+        me["age"] - AGE_DELTA,
+        me["age"] + AGE_DELTA,
     ]
-    values = {k: kwargs.get(k, (existing or {}).get(k)) for k in fields}
+    return sql, params
+
+async def get_profile(user_id: int) -> Optional[Profile]:
+    profile = profile_cache.get(user_id)
+    if profile is not None:
+        return profile
+    token = profile_cache.begin_load(user_id)
+    profile = None
+    try:
+        row = await pool.fetchone("SELECT * FROM profiles WHERE user_id = ?", (user_id,))
+        profile = Profile(row) if row else None
+    finally:
+        profile_cache.finish_load(user_id, token, profile)
+    return profile
+
+async def get_profiles(user_ids: List[int], columns: str = "*") -> Dict[int, Dict[str, Any]]:
+    # Пакетное чтение анкет по id (кусками, чтобы не упереться в лимит параметров SQLite)
+    result: Dict[int, Dict[str, Any]] = {}
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        marks = ",".join("?" * len(chunk))
+        rows = await pool.fetchall(f"SELECT {columns} FROM profiles WHERE user_id IN ({marks})", chunk)
+        for r in rows:
+            result[r["user_id"]] = dict(r)
+    return result
+
+async def upsert_profile(user_id: int, **kwargs) -> Profile:
+    # Одна команда без предварительного чтения: меняются только переданные поля,
+    # RETURNING отдаёт итоговую строку для кэша и ANN-индекса
+    values = {k: v for k, v in kwargs.items() if k in PROFILE_FIELDS and k not in ("user_id", "updated_at")}
+    if "embedding" in values:
+        values["embedding"] = encode_embedding(values["embedding"])
     values["updated_at"] = now_ts()
+    columns = list(values)
+    updates = ", ".join(f"{c} = excluded.{c}" for c in columns)
+    profile_cache.invalidate(user_id)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        if existing:
-            await db.execute(
-                """
-                UPDATE profiles SET
-                  username = ?, name = ?, age = ?, city = ?, gender = ?,
-                  looking_for = ?, description = ?, photo_file_id = ?,
-                  embedding = ?, updated_at = ?
-                WHERE user_id = ?
-                """,
-                (
-                    values["username"],
-                    values["name"],
-                    values["age"],
-                    values["city"],
-                    values["gender"],
-                    values["looking_for"],
-                    values["description"],
-                    values["photo_file_id"],
-                    json.dumps(values["embedding"]) if isinstance(values["embedding"], list) else values["embedding"],
-                    values["updated_at"],
-                    user_id,
-                ),
+    async def write(db: aiosqlite.Connection) -> Profile:
+        cur = await db.execute(
+            f"""
+            INSERT INTO profiles (user_id, {", ".join(columns)}) VALUES (?{", ?" * len(columns)})
+            ON CONFLICT(user_id) DO UPDATE SET {updates}
+            RETURNING *
+            """,
+            (user_id, *values.values()),
+        )
+        row = await cur.fetchone()
+        await cur.close()
+        return Profile(row)
+
+    # Возврат — после commit пачки, поэтому кэш и индекс получают уже сохранённую строку
+    profile = await write_batcher.submit(write)
+    profile_cache.put(profile)
+    if "embedding" in values:
+        embedding_store.discard(user_id)
+    ann_index.on_profile_saved(profile)
+    return profile
+
+async def migrate_embeddings(batch_size: int = 500, pause: float = 0.05) -> int:
+    # Перевод JSON-эмбеддингов в BLOB короткими транзакциями, чтобы не блокировать бота
+    converted = 0
+    last_id = -1
+    while True:
+        rows = await pool.fetchall(
+            """
+            SELECT user_id, embedding FROM profiles
+            WHERE user_id > ? AND typeof(embedding) = 'text'
+            ORDER BY user_id
+            LIMIT ?
+            """,
+            (last_id, batch_size),
+        )
+        if not rows:
+            break
+        last_id = rows[-1]["user_id"]
+        updates = []
+        for r in rows:
+            # Нечитаемый JSON обнуляем: эмбеддинг будет посчитан заново
+            updates.append((encode_embedding(r["embedding"]), r["user_id"], r["embedding"]))
+        async with pool.writer() as db:
+            # Условие на старое значение: не затираем профиль, обновлённый параллельно
+            await db.executemany(
+                "UPDATE profiles SET embedding = ? WHERE user_id = ? AND embedding = ?",
+                updates,
             )
-        else:
-            await db.execute(
-                """
-                INSERT INTO profiles (user_id, username, name, age, city, gender, looking_for, description, photo_file_id, embedding, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    user_id,
-                    values["username"],
-                    values["name"],
-                    values["age"],
-                    values["city"],
-                    values["gender"],
-                    values["looking_for"],
-                    values["description"],
-                    values["photo_file_id"],
-                    json.dumps(values["embedding"]) if isinstance(values["embedding"], list) else values["embedding"],
-                    values["updated_at"],
-                ),
+        for _, uid, _ in updates:
+            embedding_store.discard(uid)
+            profile_cache.invalidate(uid)
+        converted += len(updates)
+        await asyncio.sleep(pause)
+    return converted
+
+# Эмбеддинг отсутствует или посчитан другой моделью (JSON-строки переводит migrate_embeddings)
+_STALE_EMBEDDING_SQL = """
+description IS NOT NULL AND description != ''
+  AND (embedding IS NULL OR (typeof(embedding) = 'blob' AND substr(embedding, ?, ?) != ?))
+"""
+
+def _stale_params() -> List[Any]:
+    start, prefix = embedding_model_prefix()
+    return [start, len(prefix), prefix]
+
+async def find_stale_embeddings(after_id: int, limit: int) -> List[Dict[str, Any]]:
+    rows = await pool.fetchall(
+        f"""
+        SELECT user_id, description, updated_at FROM profiles
+        WHERE user_id > ? AND {_STALE_EMBEDDING_SQL}
+        ORDER BY user_id
+        LIMIT ?
+        """,
+        [after_id, *_stale_params(), limit],
+    )
+    return [dict(r) for r in rows]
+
+async def find_stale_embeddings_for(user_ids: List[int]) -> List[Dict[str, Any]]:
+    if not user_ids:
+        return []
+    marks = ",".join("?" * len(user_ids))
+    rows = await pool.fetchall(
+        f"""
+        SELECT user_id, description, updated_at FROM profiles
+        WHERE user_id IN ({marks}) AND {_STALE_EMBEDDING_SQL}
+        """,
+        [*user_ids, *_stale_params()],
+    )
+    return [dict(r) for r in rows]
+
+async def count_stale_embeddings() -> int:
+    row = await pool.fetchone(f"SELECT COUNT(*) FROM profiles WHERE {_STALE_EMBEDDING_SQL}", _stale_params())
+    return int(row[0]) if row else 0
+
+async def write_embeddings(items: List[Tuple[int, Any, Any, Optional[str]]]) -> List[int]:
+    # Пакетная запись (user_id, эмбеддинг, updated_at и описание на момент чтения) одной
+    # транзакцией. Анкеты, изменённые после чтения, пропускаются: их подхватит следующий
+    # проход. updated_at хранится с точностью до секунды, поэтому правку описания в ту же
+    # секунду ловит сравнение с самим текстом.
+    written: List[int] = []
+    ts = now_ts()
+    async with pool.writer() as db:
+        for user_id, embedding, seen_updated_at, description in items:
+            cur = await db.execute(
+                "UPDATE profiles SET embedding = ?, updated_at = ? "
+                "WHERE user_id = ? AND updated_at IS ? AND description IS ?",
+                (encode_embedding(embedding), ts, user_id, seen_updated_at, description),
             )
-        await db.commit()
+            if cur.rowcount:
+                written.append(user_id)
+            await cur.close()
+    for user_id in written:
+        embedding_store.discard(user_id)
+        profile_cache.invalidate(user_id)
+    if written:
+        for profile in (await get_profiles(written)).values():
+            ann_index.on_profile_saved(profile)
+    return written
+
+async def get_worker_state(name: str) -> Optional[Dict[str, Any]]:
+    row = await pool.fetchone("SELECT value FROM worker_state WHERE name = ?", (name,))
+    if not row or not row["value"]:
+        return None
+    try:
+        return json.loads(row["value"])
+    except Exception:
+        return None
 
-async def record_interaction(user_id: int, target_id: int, action: str) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
+async def set_worker_state(name: str, value: Dict[str, Any]) -> None:
+    async with pool.writer() as db:
         await db.execute(
-            "INSERT OR REPLACE INTO interactions (user_id, target_id, action, ts) VALUES (?, ?, ?, ?)",
-            (user_id, target_id, action, now_ts()),
+            "INSERT OR REPLACE INTO worker_state (name, value, updated_at) VALUES (?, ?, ?)",
+            (name, json.dumps(value), now_ts()),
         )
-        await db.commit()
 
-async def has_interaction(user_id: int, target_id: int, action: Optional[str] = None) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        if action:
-            cur = await db.execute(
-                "SELECT 1 FROM interactions WHERE user_id = ? AND target_id = ? AND action = ?",
-                (user_id, target_id, action),
+# Оценки, ждущие commit в write_batcher: (user_id, target_id) -> (action, метка записи).
+# has_interaction смотрит сюда раньше БД, поэтому проверка взаимности видит
+# и ещё не сохранённые лайки.
+_pending_interactions: Dict[Tuple[int, int], Tuple[str, object]] = {}
+
+def _log_failed_write(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning(f"Оценка не сохранена: {future.exception()}")
+
+async def record_interaction(user_id: int, target_id: int, action: str, wait: bool = True) -> None:
+    # Вместе с interactions в той же транзакции обновляется pending_likes:
+    # ответ закрывает входящий лайк от target_id, лайк без ответа попадает к target_id.
+    # wait=False — не ждать commit (запись видна через _pending_interactions сразу).
+    ts = now_ts()
+    key = (user_id, target_id)
+    marker = object()
+
+    def forget() -> None:
+        if _pending_interactions.get(key, (None, None))[1] is marker:
+            del _pending_interactions[key]
+
+    def drop_seen(future: asyncio.Future) -> None:
+        # Оценка не сохранилась — набор просмотренных перечитается из БД
+        if future.cancelled() or future.exception() is not None:
+            seen_index.invalidate(user_id)
+
+    async def write(db: aiosqlite.Connection) -> None:
+        await db.execute(
+            "INSERT OR REPLACE INTO interactions (user_id, target_id, action, ts) VALUES (?, ?, ?, ?)",
+            (user_id, target_id, action, ts),
+        )
+        await db.execute("DELETE FROM pending_likes WHERE target_id = ? AND liker_id = ?", (user_id, target_id))
+        if action == "like":
+            await db.execute(
+                """
+                INSERT OR REPLACE INTO pending_likes (target_id, liker_id, ts)
+                SELECT ?, ?, ?
+                WHERE NOT EXISTS (SELECT 1 FROM interactions WHERE user_id = ? AND target_id = ?)
+                """,
+                (target_id, user_id, ts, target_id, user_id),
             )
         else:
-            cur = await db.execute(
-                "SELECT 1 FROM interactions WHERE user_id = ? AND target_id = ?",
-                (user_id, target_id),
-            )
-        row = await cur.fetchone()
-        return row is not None
+            await db.execute("DELETE FROM pending_likes WHERE target_id = ? AND liker_id = ?", (target_id, user_id))
 
-async def count_pending_likers(user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            """
-            SELECT COUNT(*) FROM (
-                SELECT i.user_id
-                FROM interactions i
-                WHERE i.target_id = ?
-                  AND i.action = 'like'
-                  AND NOT EXISTS (
-                        SELECT 1 FROM interactions x
-                        WHERE x.user_id = ?
-                          AND x.target_id = i.user_id
-                    )
-                GROUP BY i.user_id
-            )
-            """,
-            (user_id, user_id),
+    future = write_batcher.enqueue(write, done=forget)
+    # Оверлей заполняется в том же шаге цикла, что и постановка в очередь:
+    # запись ещё не началась, а отклонённая очередью оценка его не засорит
+    _pending_interactions[key] = (action, marker)
+    seen_index.add(user_id, target_id)
+    future.add_done_callback(drop_seen)
+    if wait:
+        await future
+    else:
+        future.add_done_callback(_log_failed_write)
+
+async def has_interaction(user_id: int, target_id: int, action: Optional[str] = None) -> bool:
+    pending = _pending_interactions.get((user_id, target_id))
+    if pending is not None:
+        return action is None or pending[0] == action
+    if action:
+        row = await pool.fetchone(
+            "SELECT 1 FROM interactions WHERE user_id = ? AND target_id = ? AND action = ?",
+            (user_id, target_id, action),
         )
-        row = await cur.fetchone()
-        return int(row[0]) if row else 0
+    else:
+        row = await pool.fetchone(
+            "SELECT 1 FROM interactions WHERE user_id = ? AND target_id = ?",
+            (user_id, target_id),
+        )
+    return row is not None
+
+async def get_seen_set(user_id: int) -> AnySeenSet:
+    # Анкеты, которые пользователь уже оценил, включая ещё не сохранённые оценки
+    seen = seen_index.get(user_id)
+    if seen is not None:
+        return seen
+    token = seen_index.begin_load(user_id)
+    # Несохранённые оценки берутся до чтения: к его началу они либо ещё в очереди,
+    # либо уже в БД; более поздние seen_index копит сам
+    ids = [t for (u, t) in _pending_interactions if u == user_id]
+    rows = await pool.fetchall("SELECT target_id FROM interactions WHERE user_id = ?", (user_id,))
+    ids.extend(r[0] for r in rows)
+    return seen_index.finish_load(user_id, token, ids)
+
+async def count_pending_likers(user_id: int) -> int:
+    row = await pool.fetchone(COUNT_PENDING_LIKERS_SQL, (user_id,))
+    return int(row[0]) if row else 0
+
+async def count_pending_likers_all() -> Dict[int, int]:
+    # Для всех анкет сразу: сколько лайков ждут ответа (нужно только при старте)
+    rows = await pool.fetchall("SELECT target_id, COUNT(*) AS n FROM pending_likes GROUP BY target_id")
+    return {r["target_id"]: r["n"] for r in rows}
 
 async def get_next_pending_liker(user_id: int) -> Optional[Dict[str, Any]]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute(
-            """
-            SELECT i.user_id AS liker_id
-            FROM interactions i
-            WHERE i.target_id = ?
-              AND i.action = 'like'
-              AND NOT EXISTS (
-                    SELECT 1 FROM interactions x
-                    WHERE x.user_id = ?
-                      AND x.target_id = i.user_id
-                )
-            ORDER BY i.ts ASC
-            LIMIT 1
-            """,
-            (user_id, user_id),
-        )
-        row = await cur.fetchone()
-        if not row:
-            return None
-        liker_id = row["liker_id"]
+    row = await pool.fetchone(NEXT_PENDING_LIKER_SQL, (user_id,))
+    if not row:
+        return None
+    liker_id = row["liker_id"]
     liker_profile = await get_profile(liker_id)
     return liker_profile
 
+async def verify_pending_likes(sample: int = 10) -> Dict[str, Any]:
+    # Сверка pending_likes с interactions: чего не хватает и что лишнее
+    async with pool.reader() as db:
+        async with db.execute(
+            f"SELECT target_id, liker_id FROM ({PENDING_FROM_INTERACTIONS_SQL}) "
+            "EXCEPT SELECT target_id, liker_id FROM pending_likes"
+        ) as cur:
+            missing = [tuple(r) for r in await cur.fetchall()]
+        async with db.execute(
+            "SELECT target_id, liker_id FROM pending_likes "
+            f"EXCEPT SELECT target_id, liker_id FROM ({PENDING_FROM_INTERACTIONS_SQL})"
+        ) as cur:
+            extra = [tuple(r) for r in await cur.fetchall()]
+    return {
+        "missing": len(missing),
+        "extra": len(extra),
+        "missing_sample": missing[:sample],
+        "extra_sample": extra[:sample],
+    }
+
+async def rebuild_pending_likes() -> int:
+    async with pool.writer() as db:
+        await db.execute("DELETE FROM pending_likes")
+        await db.execute(f"INSERT INTO pending_likes (target_id, liker_id, ts) {PENDING_FROM_INTERACTIONS_SQL}")
+        async with db.execute("SELECT COUNT(*) FROM pending_likes") as cur:
+            return (await cur.fetchone())[0]
+
 async def get_virtual_state(user_id: int) -> Tuple[Optional[str], List[Dict[str, str]]]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("SELECT partner_gender, history FROM virtual_chats WHERE user_id = ?", (user_id,))
-        row = await cur.fetchone()
-    if not row:
-        return None, []
-    partner_gender = row["partner_gender"]
-    try:
-        history = json.loads(row["history"]) if row["history"] else []
-    except Exception:
-        history = []
-    return partner_gender, history
+    # Последние VIRTUAL_HISTORY_KEEP сообщений — диапазон по первичному ключу (user_id, seq).
+    # Каждое сообщение несёт "seq": set_virtual_state по нему отличает новые сообщения от сохранённых.
+    async with pool.reader() as db:
+        async with db.execute("SELECT partner_gender FROM virtual_chats WHERE user_id = ?", (user_id,)) as cur:
+            row = await cur.fetchone()
+        if not row:
+            return None, []
+        async with db.execute(VIRTUAL_HISTORY_SQL, (user_id, VIRTUAL_HISTORY_KEEP)) as cur:
+            rows = await cur.fetchall()
+    history = [{"role": r["role"], "content": r["content"] or "", "seq": r["seq"]} for r in reversed(rows)]
+    return row["partner_gender"], history
 
 async def set_virtual_state(user_id: int, partner_gender: Optional[str], history: List[Dict[str, str]]):
-    async with aiosqlite.connect(DB_PATH) as db:
+    # Дописывает только сообщения без "seq" (добавленные после get_virtual_state).
+    # История, где нет ни одного сохранённого сообщения, заменяет прежнюю целиком.
+    # Обрезку старых сообщений делает compact_virtual_messages.
+    async with pool.writer() as db:
         if partner_gender is None and not history:
             await db.execute("DELETE FROM virtual_chats WHERE user_id = ?", (user_id,))
+            await db.execute("DELETE FROM virtual_messages WHERE user_id = ?", (user_id,))
+            return
+        ts = now_ts()
+        await db.execute(
+            """
+            INSERT INTO virtual_chats (user_id, partner_gender, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET partner_gender = excluded.partner_gender, updated_at = excluded.updated_at
+            """,
+            (user_id, partner_gender, ts),
+        )
+        fresh = [m for m in history if "seq" not in m]
+        if len(fresh) == len(history):
+            await db.execute("DELETE FROM virtual_messages WHERE user_id = ?", (user_id,))
+            seq = 0
         else:
-            await db.execute(
-                "INSERT OR REPLACE INTO virtual_chats (user_id, partner_gender, history, updated_at) VALUES (?, ?, ?, ?)",
-                (user_id, partner_gender, json.dumps(history, ensure_ascii=False), now_ts()),
+            async with db.execute(
+                "SELECT COALESCE(MAX(seq), -1) + 1 FROM virtual_messages WHERE user_id = ?", (user_id,)
+            ) as cur:
+                seq = (await cur.fetchone())[0]
+        if fresh:
+            await db.executemany(
+                "INSERT INTO virtual_messages (user_id, seq, role, content, ts) VALUES (?, ?, ?, ?, ?)",
+                [(user_id, seq + i, m["role"], m.get("content"), ts) for i, m in enumerate(fresh)],
             )
 
-        await db.commit()
+async def compact_virtual_messages(keep: int = VIRTUAL_HISTORY_KEEP, batch_users: int = 500) -> int:
+    # Оставляет по keep последних сообщений на пользователя; пишет пачками по batch_users,
+    # чтобы не держать блокировку записи долго
+    rows = await pool.fetchall(
+        "SELECT user_id, MAX(seq) AS last_seq FROM virtual_messages GROUP BY user_id HAVING COUNT(*) > ?",
+        (keep,),
+    )
+    deleted = 0
+    for start in range(0, len(rows), batch_users):
+        chunk = rows[start:start + batch_users]
+        async with pool.writer() as db:
+            for r in chunk:
+                cur = await db.execute(
+                    "DELETE FROM virtual_messages WHERE user_id = ? AND seq <= ?",
+                    (r["user_id"], r["last_seq"] - keep),
+                )
+                deleted += max(cur.rowcount, 0)
+                await cur.close()
+    # Сообщения без записи в virtual_chats (чат завершён до миграции и т.п.)
+    async with pool.writer() as db:
+        cur = await db.execute(
+            "DELETE FROM virtual_messages WHERE user_id NOT IN (SELECT user_id FROM virtual_chats)"
+        )
+        deleted += max(cur.rowcount, 0)
+        await cur.close()
+    return deleted
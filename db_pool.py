@@ -0,0 +1,225 @@
+#Пул соединений с БД
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, List, Optional, Sequence
+
+import aiosqlite
+
+from config import (
+    DB_BUSY_TIMEOUT_MS,
+    DB_CACHE_SIZE_KB,
+    DB_MMAP_SIZE,
+    DB_PATH,
+    DB_READ_POOL_SIZE,
+    DB_SLOW_QUERY_MS,
+    logger,
+)
+from metrics import DB_QUERY_SECONDS, DB_SLOW_QUERIES, DB_WAIT_SECONDS, add_span, query_label, short_sql
+
+# Общие настройки для всех соединений
+_COMMON_PRAGMAS = (
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+    f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size = {DB_MMAP_SIZE}",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# Служебные команды транзакции не попадают в лог медленных транзакций
+_TX_CONTROL = ("BEGIN", "SAVEPOINT", "RELEASE", "ROLLBACK", "COMMIT")
+TX_LOG_STATEMENTS = 5  # сколько разных запросов транзакции показывать в логе
+
+class _RecordingConnection:
+    # Соединение писателя внутри транзакции: запоминает первые разные запросы,
+    # чтобы лог медленной транзакции показывал её SQL, а не одно слово TRANSACTION
+
+    def __init__(self, conn: aiosqlite.Connection, statements: List[str]):
+        self._conn = conn
+        self._statements = statements
+
+    def _record(self, sql: str) -> None:
+        if len(self._statements) >= TX_LOG_STATEMENTS or sql.lstrip().upper().startswith(_TX_CONTROL):
+            return
+        if sql not in self._statements:
+            self._statements.append(sql)
+
+    def execute(self, sql: str, *args: Any, **kwargs: Any) -> Any:
+        self._record(sql)
+        return self._conn.execute(sql, *args, **kwargs)
+
+    def executemany(self, sql: str, *args: Any, **kwargs: Any) -> Any:
+        self._record(sql)
+        return self._conn.executemany(sql, *args, **kwargs)
+
+    def executescript(self, sql: str, *args: Any, **kwargs: Any) -> Any:
+        self._record(sql)
+        return self._conn.executescript(sql, *args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+class ConnectionPool:
+    # Одно долгоживущее соединение на запись + несколько соединений на чтение.
+    # В режиме WAL читатели не блокируют писателя и наоборот.
+
+    def __init__(self, path: str, readers: int = DB_READ_POOL_SIZE):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._readers: Optional[asyncio.Queue] = None
+        self._all_readers: List[aiosqlite.Connection] = []
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._closed = False  # close() уже был: ленивое открытие запрещено
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self, read_only: bool) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path)
+        conn.row_factory = aiosqlite.Row
+        for pragma in _COMMON_PRAGMAS:
+            await conn.execute(pragma)
+        if read_only:
+            await conn.execute("PRAGMA query_only = 1")
+        return conn
+
+    async def open(self) -> None:
+        async with self._open_lock:
+            if self.is_open:
+                return
+            self._closed = False
+            writer = await self._connect(read_only=False)
+            # WAL и synchronous=NORMAL: fsync только на чекпоинтах, а не на каждый commit
+            await writer.execute("PRAGMA journal_mode = WAL")
+            await writer.execute("PRAGMA synchronous = NORMAL")
+            readers: asyncio.Queue = asyncio.Queue()
+            for _ in range(self.readers_count):
+                conn = await self._connect(read_only=True)
+                self._all_readers.append(conn)
+                readers.put_nowait(conn)
+            self._readers = readers
+            self._writer = writer
+            logger.info(f"Пул БД открыт: {self.path}, читателей: {self.readers_count}")
+
+    async def close(self) -> None:
+        async with self._open_lock:
+            self._closed = True
+            if not self.is_open:
+                return
+            async with self._write_lock:
+                writer, self._writer = self._writer, None
+                try:
+                    await writer.execute("PRAGMA optimize")
+                except Exception as e:
+                    logger.warning(f"PRAGMA optimize не выполнен: {e}")
+                await writer.close()
+            for conn in self._all_readers:
+                try:
+                    await conn.close()
+                except Exception as e:
+                    logger.warning(f"Ошибка при закрытии соединения БД: {e}")
+            self._all_readers = []
+            self._readers = None
+            logger.info("Пул БД закрыт.")
+
+    async def _ensure_open(self) -> None:
+        # Ленивое открытие: утилиты и скрипты могут вызывать db.* без main().
+        # После close() пул сам не открывается: запоздалая запись (таймер FSM,
+        # уведомления) не должна оставлять соединения после остановки
+        if not self.is_open:
+            if self._closed:
+                raise RuntimeError("Пул БД закрыт")
+            await self.open()
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        # Транзакция на запись: commit при успехе, rollback при исключении
+        await self._ensure_open()
+        waited = time.perf_counter()
+        async with self._write_lock:
+            started = time.perf_counter()
+            DB_WAIT_SECONDS.observe(started - waited, "write")
+            statements: List[str] = []
+            conn = self._writer
+            try:
+                yield _RecordingConnection(conn, statements)
+            except BaseException:
+                await conn.rollback()
+                raise
+            else:
+                await conn.commit()
+            finally:
+                self._observe("TRANSACTION", started, text=f"TRANSACTION: {'; '.join(statements)}")
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        await self._ensure_open()
+        readers = self._readers
+        waited = time.perf_counter()
+        conn = await readers.get()
+        DB_WAIT_SECONDS.observe(time.perf_counter() - waited, "read")
+        try:
+            yield conn
+        finally:
+            readers.put_nowait(conn)
+
+    def _observe(self, sql: str, started: float, duration: Optional[float] = None, text: Optional[str] = None) -> None:
+        # Гистограмма по метке запроса, спан трассировки и лог медленных запросов.
+        # duration — если время SQLite меньше, чем прошло от started (iterate)
+        if duration is None:
+            duration = time.perf_counter() - started
+        label = query_label(sql)
+        DB_QUERY_SECONDS.observe(duration, label)
+        add_span(f"db {label}", started, duration)
+        if DB_SLOW_QUERY_MS and duration * 1000.0 >= DB_SLOW_QUERY_MS:
+            DB_SLOW_QUERIES.inc(label)
+            logger.warning(f"Медленный запрос: {duration * 1000.0:.0f} мс: {short_sql(text or sql)}")
+
+    async def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[aiosqlite.Row]:
+        async with self.reader() as conn:
+            started = time.perf_counter()
+            try:
+                async with conn.execute(sql, params) as cur:
+                    return await cur.fetchone()
+            finally:
+                self._observe(sql, started)
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[aiosqlite.Row]:
+        async with self.reader() as conn:
+            started = time.perf_counter()
+            try:
+                async with conn.execute(sql, params) as cur:
+                    return list(await cur.fetchall())
+            finally:
+                self._observe(sql, started)
+
+    async def iterate(self, sql: str, params: Sequence[Any] = (), batch_size: int = 1000) -> AsyncIterator[List[aiosqlite.Row]]:
+        # Потоковое чтение пачками. Генератор держит читателя до конца обхода,
+        # поэтому вызывающий код должен дочитывать его (или закрывать через aclosing).
+        # Время считается только по ожиданию SQLite, без обработки пачек вызывающим
+        async with self.reader() as conn:
+            busy = 0.0
+            started = time.perf_counter()
+            try:
+                async with conn.execute(sql, params) as cur:
+                    busy += time.perf_counter() - started
+                    while True:
+                        t = time.perf_counter()
+                        rows = await cur.fetchmany(batch_size)
+                        busy += time.perf_counter() - t
+                        if not rows:
+                            break
+                        yield list(rows)
+            finally:
+                self._observe(sql, started, busy)
+
+pool = ConnectionPool(DB_PATH)
+
+async def open_pool() -> None:
+    await pool.open()
+
+async def close_pool() -> None:
+    await pool.close()
@@ -0,0 +1,121 @@
+#Кэш эмбеддингов по хэшу текста
+
+import hashlib
+import re
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from config import EMBED_CACHE_MAX_BYTES, EMBED_CACHE_MAX_ROWS, EMBED_MODEL, logger
+from db_pool import pool
+from ranking import pack_embedding, to_vector
+
+_SPACES = re.compile(r"\s+")
+
+def normalize_text(text: str) -> str:
+    return _SPACES.sub(" ", unicodedata.normalize("NFC", text or "")).strip()
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).digest()
+
+CacheKey = Tuple[str, bytes]
+
+class EmbeddingCache:
+    # LRU в памяти поверх таблицы embedding_cache; ключ — (модель, sha256 нормализованного текста).
+    # В памяти и в БД хранится упакованный float32 BLOB.
+
+    def __init__(self, max_bytes: int = EMBED_CACHE_MAX_BYTES, max_rows: int = EMBED_CACHE_MAX_ROWS):
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self._mem: "OrderedDict[CacheKey, bytes]" = OrderedDict()
+        self._mem_bytes = 0
+        self._rows: Optional[int] = None  # приблизительное число строк в БД
+        self.hits_memory = 0
+        self.hits_db = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits_memory + self.hits_db + self.misses
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_db": self.hits_db,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits_memory + self.hits_db) / total if total else 0.0,
+            "memory_items": len(self._mem),
+            "memory_bytes": self._mem_bytes,
+        }
+
+    def _remember(self, key: CacheKey, blob: bytes) -> None:
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_bytes -= len(old)
+        self._mem[key] = blob
+        self._mem_bytes += len(blob)
+        while self._mem_bytes > self.max_bytes and self._mem:
+            _, dropped = self._mem.popitem(last=False)
+            self._mem_bytes -= len(dropped)
+            self.evictions += 1
+
+    async def get(self, text: str, model: str = EMBED_MODEL) -> Optional[List[float]]:
+        key = (model, text_hash(text))
+        blob = self._mem.get(key)
+        if blob is not None:
+            self._mem.move_to_end(key)
+            self.hits_memory += 1
+        else:
+            row = await pool.fetchone(
+                "SELECT embedding FROM embedding_cache WHERE model = ? AND text_hash = ?",
+                key,
+            )
+            if row is None:
+                self.misses += 1
+                return None
+            blob = bytes(row[0])
+            self._remember(key, blob)
+            self.hits_db += 1
+        vec = to_vector(blob)
+        return vec.tolist() if vec is not None else None
+
+    async def put(self, text: str, embedding: List[float], model: str = EMBED_MODEL) -> None:
+        key = (model, text_hash(text))
+        blob = pack_embedding(embedding, model)
+        self._remember(key, blob)
+        try:
+            async with pool.writer() as db:
+                cur = await db.execute(
+                    "INSERT OR IGNORE INTO embedding_cache (model, text_hash, embedding, created_at) "
+                    "VALUES (?, ?, ?, strftime('%s', 'now'))",
+                    (model, key[1], blob),
+                )
+                inserted = cur.rowcount > 0
+                await cur.close()
+            if inserted:
+                await self._maybe_prune()
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить эмбеддинг в кэш: {e}")
+
+    async def _maybe_prune(self) -> None:
+        if self._rows is None:
+            row = await pool.fetchone("SELECT COUNT(*) FROM embedding_cache")
+            self._rows = int(row[0]) if row else 0
+        else:
+            self._rows += 1
+        # Удаляем самые старые записи пачкой с запасом 10%, чтобы не чистить на каждой вставке
+        if self._rows <= self.max_rows:
+            return
+        excess = self._rows - int(self.max_rows * 0.9)
+        async with pool.writer() as db:
+            await db.execute(
+                """
+                DELETE FROM embedding_cache WHERE (model, text_hash) IN (
+                    SELECT model, text_hash FROM embedding_cache ORDER BY created_at LIMIT ?
+                )
+                """,
+                (excess,),
+            )
+        self._rows -= excess
+        self.evictions += excess
+
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,159 @@
+#Фоновое дозаполнение эмбеддингов
+
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from ai_utils import get_text_embeddings
+from config import (
+    EMBED_BACKFILL_BATCH,
+    EMBED_BACKFILL_IDLE,
+    EMBED_BACKFILL_PER_MIN,
+    EMBED_MODEL,
+    logger,
+)
+from db import (
+    count_stale_embeddings,
+    find_stale_embeddings,
+    find_stale_embeddings_for,
+    get_worker_state,
+    set_worker_state,
+    write_embeddings,
+)
+
+STATE_NAME = "embedding_backfill"
+
+class EmbeddingWorker:
+    # Находит анкеты без эмбеддинга или с эмбеддингом другой модели, считает их
+    # пачками с ограничением скорости и записывает одной транзакцией на пачку.
+    # Курсор (последний user_id) хранится в worker_state, поэтому после
+    # перезапуска обход продолжается с того же места.
+
+    def __init__(
+        self,
+        batch_size: int = EMBED_BACKFILL_BATCH,
+        per_minute: int = EMBED_BACKFILL_PER_MIN,
+        idle: float = EMBED_BACKFILL_IDLE,
+    ):
+        self.batch_size = batch_size
+        self.per_minute = per_minute
+        self.idle = idle
+        self._urgent: Set[int] = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._cursor = -1
+        self.processed = 0
+        self.failed = 0
+        self.remaining: Optional[int] = None
+
+    def progress(self) -> Dict[str, Any]:
+        return {
+            "processed": self.processed,
+            "failed": self.failed,
+            "remaining": self.remaining,
+            "cursor": self._cursor,
+            "queued": len(self._urgent),
+        }
+
+    def kick(self, user_id: Optional[int] = None) -> None:
+        # Анкета сохранена без эмбеддинга: посчитать вне очереди
+        if user_id is not None:
+            self._urgent.add(user_id)
+        self._wakeup.set()
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _load_cursor(self) -> None:
+        state = await get_worker_state(STATE_NAME) or {}
+        # Смена EMBED_MODEL — обход начинается заново
+        self._cursor = int(state.get("cursor", -1)) if state.get("model") == EMBED_MODEL else -1
+
+    async def _save_cursor(self) -> None:
+        await set_worker_state(STATE_NAME, {"model": EMBED_MODEL, "cursor": self._cursor})
+
+    async def _embed_rows(self, rows: List[Dict[str, Any]]) -> int:
+        started = time.monotonic()
+        vectors = await get_text_embeddings([r["description"] for r in rows])
+        items = []
+        for r, vec in zip(rows, vectors):
+            if vec is None:
+                self.failed += 1
+            else:
+                items.append((r["user_id"], vec, r["updated_at"], r["description"]))
+        written = await write_embeddings(items) if items else []
+        self.processed += len(written)
+        # Ограничение скорости: не больше per_minute текстов в минуту
+        budget = len(rows) * 60.0 / self.per_minute
+        pause = budget - (time.monotonic() - started)
+        if pause > 0:
+            await asyncio.sleep(pause)
+        return len(written)
+
+    async def run_urgent(self) -> int:
+        if not self._urgent:
+            return 0
+        ids, self._urgent = list(self._urgent), set()
+        rows = await find_stale_embeddings_for(ids)
+        return await self._embed_rows(rows) if rows else 0
+
+    async def run_pass(self) -> int:
+        # Один проход по таблице от сохранённого курсора до конца
+        await self._load_cursor()
+        self.remaining = await count_stale_embeddings()
+        if self.remaining:
+            logger.info(f"Эмбеддинги: к пересчёту {self.remaining} анкет, курсор {self._cursor}")
+        done = 0
+        while True:
+            await self.run_urgent()
+            rows = await find_stale_embeddings(self._cursor, self.batch_size)
+            if not rows:
+                break
+            done += await self._embed_rows(rows)
+            self._cursor = rows[-1]["user_id"]
+            await self._save_cursor()
+            self.remaining = max(0, (self.remaining or 0) - len(rows))
+            logger.info(
+                f"Эмбеддинги: записано {self.processed}, ошибок {self.failed}, осталось ~{self.remaining}"
+            )
+        # Проход завершён: следующий начнётся с начала таблицы
+        self._cursor = -1
+        await self._save_cursor()
+        return done
+
+    async def _run(self) -> None:
+        # Полный проход — при старте и раз в idle секунд; kick() будит воркер
+        # только для срочных анкет, без сканирования всей таблицы
+        full = True
+        while True:
+            try:
+                if full:
+                    await self.run_pass()
+                else:
+                    await self.run_urgent()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Ошибка фонового пересчёта эмбеддингов: {e}")
+            self._wakeup.clear()
+            if self._urgent:
+                full = False
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.idle)
+                full = False
+            except asyncio.TimeoutError:
+                full = True
+
+embedding_worker = EmbeddingWorker()
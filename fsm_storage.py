@@ -0,0 +1,213 @@
+#Хранилище FSM в SQLite
+
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from config import FSM_CACHE_MAX, FSM_FLUSH_INTERVAL, FSM_FLUSH_MAX, FSM_STATE_TTL, logger
+from db_pool import pool
+
+def storage_key(key: StorageKey) -> str:
+    return ":".join(
+        str(part) if part is not None else ""
+        for part in (key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny)
+    )
+
+class _Record:
+    __slots__ = ("state", "data", "updated_at")
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], updated_at: float):
+        self.state = state
+        self.data = data
+        self.updated_at = updated_at
+
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+class SQLiteStorage(BaseStorage):
+    # Состояния и данные FSM в таблице fsm_states. Чтение идёт из LRU-кэша в памяти,
+    # запись — в кэш и в очередь изменений, которая сбрасывается в БД одной транзакцией
+    # раз в flush_interval секунд (или сразу при flush_max изменениях).
+    # Состояние, не менявшееся дольше ttl секунд, считается сброшенным.
+    # Кэш рассчитан на один процесс бота: другой процесс увидит изменения
+    # только после сброса очереди и вытеснения записи из своего кэша.
+
+    def __init__(
+        self,
+        ttl: float = FSM_STATE_TTL,
+        cache_max: int = FSM_CACHE_MAX,
+        flush_interval: float = FSM_FLUSH_INTERVAL,
+        flush_max: int = FSM_FLUSH_MAX,
+    ):
+        self.ttl = ttl
+        self.cache_max = cache_max
+        self.flush_interval = flush_interval
+        self.flush_max = flush_max
+        self._cache: "OrderedDict[str, _Record]" = OrderedDict()
+        self._dirty: Dict[str, _Record] = {}
+        self._flush_lock = asyncio.Lock()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushing: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "cached": len(self._cache),
+            "dirty": len(self._dirty),
+            "flushes": self.flushes,
+        }
+
+    def _expired(self, record: _Record, now: float) -> bool:
+        return bool(self.ttl) and now - record.updated_at > self.ttl
+
+    def _remember(self, key: str, record: _Record) -> None:
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        self._trim()
+
+    def _trim(self) -> None:
+        # Вытесняем только записи, уже сброшенные в БД
+        if len(self._cache) <= self.cache_max:
+            return
+        for old in list(self._cache):
+            if len(self._cache) <= self.cache_max:
+                break
+            if old not in self._dirty:
+                del self._cache[old]
+
+    async def _load(self, key: StorageKey) -> _Record:
+        skey = storage_key(key)
+        now = time.time()
+        record = self._cache.get(skey)
+        if record is not None:
+            self._cache.move_to_end(skey)
+            self.hits += 1
+        else:
+            self.misses += 1
+            row = await pool.fetchone("SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (skey,))
+            if row is None:
+                record = _Record(None, {}, now)
+            else:
+                try:
+                    data = json.loads(row["data"]) if row["data"] else {}
+                except ValueError:
+                    data = {}
+                record = _Record(row["state"], data, row["updated_at"] or 0)
+            # Пока шло чтение, запись по ключу могла появиться (set_state вне очереди
+            # user_serial или параллельный промах) — она новее прочитанной строки
+            existing = self._dirty.get(skey) or self._cache.get(skey)
+            if existing is not None:
+                record = existing
+                self._cache.move_to_end(skey)
+            else:
+                self._remember(skey, record)
+        if self._expired(record, now) and not record.empty():
+            record = _Record(None, {}, now)
+            self._write(skey, record)
+        return record
+
+    def _write(self, skey: str, record: _Record) -> None:
+        record.updated_at = time.time()
+        self._dirty[skey] = record
+        self._remember(skey, record)
+        if len(self._dirty) >= self.flush_max:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.flush_interval)
+
+    def _schedule(self, delay: float) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self) -> None:
+        self._timer = None
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.create_task(self.flush())
+        else:
+            # Сброс уже идёт — повторим после него
+            self._schedule(self.flush_interval)
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+            # Записи остаются в _dirty до конца транзакции, чтобы кэш не вытеснил
+            # их раньше, чем они окажутся в БД
+            batch = dict(self._dirty)
+            upserts = []
+            deletes = []
+            for skey, record in batch.items():
+                if record.empty():
+                    deletes.append((skey,))
+                else:
+                    upserts.append(
+                        (skey, record.state, json.dumps(record.data, ensure_ascii=False), int(record.updated_at))
+                    )
+            try:
+                async with pool.writer() as db:
+                    if upserts:
+                        await db.executemany(
+                            """
+                            INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                            ON CONFLICT(key) DO UPDATE SET
+                                state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+                            """,
+                            upserts,
+                        )
+                    if deletes:
+                        await db.executemany("DELETE FROM fsm_states WHERE key = ?", deletes)
+            except Exception as e:
+                logger.warning(f"FSM: не удалось сохранить {len(batch)} состояний: {e}")
+                self._schedule(self.flush_interval)
+                return 0
+            for skey, record in batch.items():
+                # Запись, изменённая во время сброса, остаётся в очереди
+                if self._dirty.get(skey) is record:
+                    del self._dirty[skey]
+            self._trim()
+            self.flushes += 1
+            return len(batch)
+
+    async def purge_expired(self) -> int:
+        if not self.ttl:
+            return 0
+        async with pool.writer() as db:
+            cur = await db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (int(time.time() - self.ttl),))
+            deleted = max(cur.rowcount, 0)
+            await cur.close()
+        return deleted
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._load(key)
+        new_state = state.state if isinstance(state, State) else state
+        self._write(storage_key(key), _Record(new_state, record.data, record.updated_at))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        record = await self._load(key)
+        self._write(storage_key(key), _Record(record.state, dict(data), record.updated_at))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._load(key)).data)
+
+    async def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flushing is not None:
+            await asyncio.gather(self._flushing, return_exceptions=True)
+        await self.flush()
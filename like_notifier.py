@@ -0,0 +1,71 @@
+#Сводные уведомления о лайках
+
+import asyncio
+from typing import Awaitable, Callable, Dict
+
+from config import LIKE_NOTIFY_WINDOW, logger
+from db import count_pending_likers_all
+
+class LikeNotifier:
+    # Счётчики «сколько человек ждут ответа» для каждой анкеты держатся в памяти:
+    # лайк увеличивает счётчик, ответ на лайк — уменьшает. Первый лайк запускает
+    # окно в window секунд, по его окончании уходит одно сообщение с итоговым
+    # числом. БД читается только при старте, чтобы восстановить счётчики.
+
+    def __init__(self, send: Callable[[int, int], Awaitable[None]], window: float = LIKE_NOTIFY_WINDOW):
+        self.send = send
+        self.window = window
+        self._pending: Dict[int, int] = {}
+        self._timers: Dict[int, asyncio.TimerHandle] = {}
+        self._tasks: set = set()
+        self.sent = 0
+        self.coalesced = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"windows": len(self._timers), "sent": self.sent, "coalesced": self.coalesced}
+
+    def pending(self, user_id: int) -> int:
+        return self._pending.get(user_id, 0)
+
+    async def reconcile(self) -> None:
+        self._pending = await count_pending_likers_all()
+        logger.info(f"Уведомления о лайках: ждут ответа {len(self._pending)} анкет")
+
+    def liked(self, target_id: int) -> None:
+        self._pending[target_id] = self._pending.get(target_id, 0) + 1
+        if target_id in self._timers:
+            self.coalesced += 1
+            return
+        self._timers[target_id] = asyncio.get_running_loop().call_later(self.window, self._fire, target_id)
+
+    def resolved(self, user_id: int) -> None:
+        # user_id ответил одному из лайкнувших
+        n = self._pending.get(user_id, 0) - 1
+        if n > 0:
+            self._pending[user_id] = n
+        else:
+            self._pending.pop(user_id, None)
+
+    def _fire(self, target_id: int) -> None:
+        self._timers.pop(target_id, None)
+        task = asyncio.create_task(self._notify(target_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _notify(self, target_id: int) -> None:
+        n = self._pending.get(target_id, 0)
+        if n <= 0:
+            return
+        try:
+            await self.send(target_id, n)
+            self.sent += 1
+        except Exception as e:
+            logger.warning(f"Не удалось отправить уведомление о лайках пользователю {target_id}: {e}")
+
+    async def stop(self) -> None:
+        # Незакрытые окна отправляем сразу, чтобы сводка не потерялась при остановке
+        timers, self._timers = self._timers, {}
+        for target_id, handle in timers.items():
+            handle.cancel()
+            self._fire(target_id)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
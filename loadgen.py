@@ -0,0 +1,744 @@
+#Нагрузочный прогон бота на локальных заглушках Telegram и OpenAI
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+# Токен должен проходить проверку формата aiogram
+LOADGEN_TOKEN = "123456:LOADGEN-fake-token-for-local-runs"
+SEED_USER_BASE = 1_000_000
+NEW_USER_BASE = 2_000_000
+END_MARK = "✓"  # последний токен ответа заглушки OpenAI: по нему видно, что ответ показан целиком
+
+CITIES = ["Москва", "Санкт-Петербург", "Казань", "Новосибирск", "Екатеринбург"]
+CITY_WEIGHTS = [0.45, 0.25, 0.12, 0.1, 0.08]
+WORDS = [
+    "путешествия", "книги", "спорт", "кино", "музыка", "горы", "море", "кофе",
+    "кулинария", "фотография", "йога", "бег", "театр", "настолки", "собаки", "кошки",
+    "велосипед", "живопись", "танцы", "программирование", "походы", "сноуборд", "языки", "вино",
+]
+NAMES = ["Анна", "Мария", "Ольга", "Ирина", "Алексей", "Дмитрий", "Иван", "Сергей"]
+CHAT_LINES = [
+    "Привет! Как дела?",
+    "Чем занимаешься вечером?",
+    "Любишь путешествовать?",
+    "Какая музыка нравится?",
+    "Расскажи о себе",
+]
+SCENARIOS = ("swipe", "likers", "chat")
+
+@lru_cache(maxsize=4096)
+def _word_vector(word: str, dim: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+def fake_embedding(text: str, dim: int) -> np.ndarray:
+    # Детерминированный вектор: сумма случайных векторов слов, поэтому
+    # описания с общими словами действительно похожи
+    vec = np.zeros(dim, dtype=np.float32)
+    for word in text.lower().split():
+        vec += _word_vector(word, dim)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm else vec
+
+def describe(rng: random.Random) -> str:
+    return " ".join(rng.sample(WORDS, 5))
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    ms = np.asarray(values) * 1000.0
+    return {
+        "count": len(values),
+        "p50": float(np.percentile(ms, 50)),
+        "p95": float(np.percentile(ms, 95)),
+        "p99": float(np.percentile(ms, 99)),
+    }
+
+# =========================
+# Заглушка OpenAI
+# =========================
+
+class FakeOpenAI:
+    # /v1/embeddings и /v1/chat/completions (обычный и потоковый ответ) с настраиваемой
+    # задержкой; error_rate — доля ответов 429
+
+    def __init__(self, args: argparse.Namespace):
+        self.dim = args.dim
+        self.embed_latency = args.embed_latency
+        self.chat_latency = args.chat_latency
+        self.chat_chunks = args.chat_chunks
+        self.chunk_interval = args.chunk_interval
+        self.error_rate = args.openai_error_rate
+        self.rng = random.Random(args.seed + 1)
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/embeddings", self.embeddings)
+        app.router.add_post("/v1/chat/completions", self.chat)
+        return app
+
+    def _jitter(self, seconds: float) -> float:
+        return seconds * self.rng.uniform(0.5, 1.5)
+
+    def _rate_limited(self) -> Optional[web.Response]:
+        if not self.error_rate or self.rng.random() >= self.error_rate:
+            return None
+        self.calls["429"] += 1
+        return web.json_response(
+            {"error": {"message": "Rate limit reached (loadgen)", "type": "requests", "code": "rate_limit_exceeded"}},
+            status=429,
+            headers={"retry-after-ms": "200"},
+        )
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.calls["embeddings"] += 1
+        limited = self._rate_limited()
+        if limited is not None:
+            return limited
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        self.calls["embedded_texts"] += len(texts)
+        await asyncio.sleep(self._jitter(self.embed_latency))
+        data = []
+        for i, text in enumerate(texts):
+            vec = fake_embedding(text, self.dim)
+            if body.get("encoding_format") == "base64":
+                embedding: Any = base64.b64encode(vec.astype("<f4").tobytes()).decode("ascii")
+            else:
+                embedding = vec.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(t) // 3 + 1 for t in texts)
+        return web.json_response({
+            "object": "list",
+            "data": data,
+            "model": body.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.calls["chat"] += 1
+        limited = self._rate_limited()
+        if limited is not None:
+            return limited
+        await asyncio.sleep(self._jitter(self.chat_latency))
+        words = [self.rng.choice(WORDS) for _ in range(max(self.chat_chunks - 1, 0))] + [END_MARK]
+        created = int(time.time())
+        cid = f"chatcmpl-loadgen-{self.calls['chat']}"
+        if not body.get("stream"):
+            return web.json_response({
+                "id": cid,
+                "object": "chat.completion",
+                "created": created,
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 100, "completion_tokens": len(words), "total_tokens": 100 + len(words)},
+            })
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+
+        async def event(delta: Dict[str, Any], finish: Optional[str] = None) -> None:
+            chunk = {
+                "id": cid,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": body.get("model"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }
+            await resp.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self._jitter(self.chunk_interval))
+            await event({"role": "assistant", "content": word} if i == 0 else {"content": " " + word})
+        await event({}, "stop")
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+# =========================
+# Заглушка Telegram Bot API
+# =========================
+
+def _buttons(call: Dict[str, Any]) -> List[str]:
+    markup = call.get("markup") or {}
+    return [b.get("callback_data", "") for row in markup.get("inline_keyboard", []) for b in row]
+
+def _button(call: Optional[Dict[str, Any]], prefix: str) -> Optional[str]:
+    if call is None:
+        return None
+    for data in _buttons(call):
+        if data.startswith(prefix):
+            return data
+    return None
+
+def any_reply(call: Dict[str, Any]) -> bool:
+    return True
+
+def card_or_empty(call: Dict[str, Any]) -> bool:
+    # Карточка кандидата или «Пока нет подходящих анкет»
+    return _button(call, "like:") is not None or (call["method"] == "sendMessage" and "Пока нет" in call["text"])
+
+def liker_or_done(call: Dict[str, Any]) -> bool:
+    return _button(call, "liker_like:") is not None or _button(call, "go_to_search") is not None
+
+def full_answer(call: Dict[str, Any]) -> bool:
+    return END_MARK in call["text"]
+
+class VirtualUser:
+    def __init__(self, tg: "FakeTelegram", user_id: int, registered: bool, rng: random.Random):
+        self.tg = tg
+        self.user_id = user_id
+        self.registered = registered
+        self.rng = rng
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self._callbacks = 0
+
+    def _user(self) -> Dict[str, Any]:
+        return {"id": self.user_id, "is_bot": False, "first_name": f"user{self.user_id}", "username": f"u{self.user_id}"}
+
+    def _message(self, **extra: Any) -> Dict[str, Any]:
+        return {
+            "message_id": self.tg.next_message_id(self.user_id),
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self._user(),
+            **extra,
+        }
+
+    async def think(self) -> None:
+        if self.tg.args.think > 0:
+            await asyncio.sleep(self.rng.expovariate(1.0 / self.tg.args.think))
+
+    def _drain(self) -> None:
+        # Забываем ответы на прошлые шаги, чтобы не принять их за ответ на новый
+        while not self.inbox.empty():
+            self.inbox.get_nowait()
+
+    def send(self, **update: Any) -> float:
+        self._drain()
+        return self.tg.push_update(update)
+
+    async def expect(self, step: str, match: Callable[[Dict[str, Any]], bool], started: float) -> Optional[Dict[str, Any]]:
+        deadline = started + self.tg.args.reply_timeout
+        while True:
+            try:
+                call = await asyncio.wait_for(self.inbox.get(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                self.tg.timeouts[step] += 1
+                return None
+            if match(call):
+                self.tg.steps[step].append(call["at"] - started)
+                return call
+
+    async def say(self, step: str, text: str, match: Callable[[Dict[str, Any]], bool] = any_reply) -> Optional[Dict[str, Any]]:
+        return await self.expect(step, match, self.send(message=self._message(text=text)))
+
+    async def photo(self, step: str, match: Callable[[Dict[str, Any]], bool]) -> Optional[Dict[str, Any]]:
+        file_id = f"loadgen-photo-{self.user_id}"
+        size = {"file_id": file_id, "file_unique_id": file_id, "width": 640, "height": 640}
+        return await self.expect(step, match, self.send(message=self._message(photo=[size])))
+
+    async def press(
+        self,
+        step: str,
+        data: str,
+        card: Optional[Dict[str, Any]],
+        match: Callable[[Dict[str, Any]], bool],
+    ) -> Optional[Dict[str, Any]]:
+        self._callbacks += 1
+        message = {
+            "message_id": card["message_id"] if card else 0,
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "text": "анкета",
+        }
+        query = {
+            "id": f"{self.user_id}:{self._callbacks}",
+            "from": self._user(),
+            "chat_instance": str(self.user_id),
+            "data": data,
+            "message": message,
+        }
+        return await self.expect(step, match, self.send(callback_query=query))
+
+async def scenario_register(u: VirtualUser) -> None:
+    # Мастер анкеты ProfileFSM от /start до фото
+    rng = u.rng
+    gender = rng.choice(("Мужчина", "Женщина"))
+    steps = [
+        ("start", "/start"),
+        ("menu", "Создать/Редактировать анкету"),
+        ("name", rng.choice(NAMES)),
+        ("age", str(rng.randint(18, 45))),
+        ("city", rng.choices(CITIES, CITY_WEIGHTS)[0]),
+        ("gender", gender),
+        ("looking_for", "Ищу женщин" if gender == "Мужчина" else "Ищу мужчин"),
+        ("description", describe(rng)),
+    ]
+    for step, text in steps:
+        if await u.say(f"register.{step}", text) is None:
+            return
+        await u.think()
+    saved = await u.photo("register.photo", lambda c: c["method"] == "sendPhoto")
+    u.registered = saved is not None
+
+async def scenario_swipe(u: VirtualUser) -> None:
+    # Лента кандидатов: лайк/дизлайк через on_like_dislike
+    card = await u.say("swipe.open", "Поиск анкет", card_or_empty)
+    for _ in range(u.tg.args.swipes):
+        target = _button(card, "like:")
+        if target is None:
+            return
+        await u.think()
+        action = "like" if u.rng.random() < u.tg.args.like_ratio else "dislike"
+        card = await u.press(f"swipe.{action}", f"{action}:{target.split(':', 1)[1]}", card, card_or_empty)
+    if _button(card, "stop_search") is not None:
+        await u.press("swipe.stop", "stop_search", card, any_reply)
+
+async def scenario_likers(u: VirtualUser) -> None:
+    # Ответы тем, кто лайкнул анкету
+    card = await u.press("likers.open", "show_likers", None, liker_or_done)
+    for _ in range(u.tg.args.swipes):
+        liker = _button(card, "liker_like:")
+        if liker is None:
+            return
+        await u.think()
+        liker_id = liker.split(":", 1)[1]
+        action = "liker_like" if u.rng.random() < u.tg.args.like_ratio else "liker_dislike"
+        card = await u.press(f"likers.{action.split('_')[1]}", f"{action}:{liker_id}", card, liker_or_done)
+
+async def scenario_chat(u: VirtualUser) -> None:
+    # Виртуальный собеседник: время до первого ответа бота и до полного ответа модели
+    if await u.say("chat.open", "Виртуальный собеседник") is None:
+        return
+    partner = u.rng.choice(("Виртуальный мужчина", "Виртуальная женщина"))
+    if await u.say("chat.partner", partner) is None:
+        return
+    for _ in range(u.tg.args.chat_messages):
+        await u.think()
+        started = u.send(message=u._message(text=u.rng.choice(CHAT_LINES)))
+        if await u.expect("chat.first_reply", any_reply, started) is None:
+            return
+        if await u.expect("chat.answer", full_answer, started) is None:
+            return
+    await u.say("chat.close", "Закончить виртуальный чат")
+
+SCENARIO_FUNCS = {"swipe": scenario_swipe, "likers": scenario_likers, "chat": scenario_chat}
+
+class FakeTelegram:
+    # Bot API на /bot<token>/<method>: getUpdates отдаёт апдейты виртуальных
+    # пользователей, остальные методы записываются и передаются пользователю-адресату.
+    # Сценарии стартуют с первым getUpdates, то есть когда бот уже запущен.
+
+    def __init__(self, args: argparse.Namespace, openai: FakeOpenAI):
+        self.args = args
+        self.openai = openai
+        self.rng = random.Random(args.seed)
+        self.users: Dict[int, VirtualUser] = {}
+        self.steps: Dict[str, List[float]] = defaultdict(list)
+        self.timeouts: Dict[str, int] = defaultdict(int)
+        self.scenarios: Dict[str, int] = defaultdict(int)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._updates: List[Dict[str, Any]] = []
+        self._has_updates = asyncio.Event()
+        self._next_update_id = 1
+        self._message_ids: Dict[int, int] = defaultdict(int)
+        self._driver: Optional[asyncio.Task] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.api)
+        app.router.add_get("/_loadgen/status", self.status)
+        app.router.add_get("/_loadgen/report", self.report)
+        return app
+
+    def next_message_id(self, chat_id: int) -> int:
+        self._message_ids[chat_id] += 1
+        return self._message_ids[chat_id]
+
+    def push_update(self, update: Dict[str, Any]) -> float:
+        update["update_id"] = self._next_update_id
+        self._next_update_id += 1
+        self._updates.append(update)
+        self._has_updates.set()
+        return time.monotonic()
+
+    async def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        if self._driver is None:
+            self._driver = asyncio.create_task(self.drive())
+        offset = int(params.get("offset") or 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), float(params.get("timeout") or 0) or 0.1)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[: int(params.get("limit") or 100)]
+
+    def _sent(self, chat_id: int, params: Dict[str, Any], **extra: Any) -> Dict[str, Any]:
+        return {
+            "message_id": self.next_message_id(chat_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **extra,
+        }
+
+    def _result(self, method: str, params: Dict[str, Any]) -> Any:
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Loadgen", "username": "loadgen_bot"}
+        if method == "sendMessage":
+            return self._sent(chat_id, params, text=params.get("text", ""))
+        if method == "sendPhoto":
+            photo = params.get("photo")
+            file_id = photo if isinstance(photo, str) else "loadgen-upload"
+            size = {"file_id": file_id, "file_unique_id": file_id, "width": 640, "height": 640}
+            return self._sent(chat_id, params, photo=[size], caption=params.get("caption", ""))
+        if method == "editMessageText" and chat_id is not None:
+            return {
+                "message_id": int(params["message_id"]),
+                "date": int(time.time()),
+                "edit_date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+    async def api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+        result = self._result(method, params)
+        if "chat_id" in params:
+            chat_id = int(params["chat_id"])
+        elif method == "answerCallbackQuery":
+            chat_id = int(str(params.get("callback_query_id", "0")).split(":", 1)[0])
+        else:
+            chat_id = None
+        user = self.users.get(chat_id) if chat_id is not None else None
+        if user is not None:
+            markup = params.get("reply_markup")
+            user.inbox.put_nowait({
+                "method": method,
+                "text": params.get("text") or params.get("caption") or "",
+                "markup": json.loads(markup) if isinstance(markup, str) else None,
+                "message_id": result["message_id"] if isinstance(result, dict) else None,
+                "at": time.monotonic(),
+            })
+        return web.json_response({"ok": True, "result": result}, dumps=lambda o: json.dumps(o, ensure_ascii=False))
+
+    async def drive(self) -> None:
+        args = self.args
+        new_users = int(args.users * args.new_users)
+        seeded = self.rng.sample(range(args.profiles), min(args.users - new_users, args.profiles))
+        for i in range(new_users):
+            uid = NEW_USER_BASE + i
+            self.users[uid] = VirtualUser(self, uid, False, random.Random(args.seed * 7919 + uid))
+        for i in seeded:
+            uid = SEED_USER_BASE + i
+            self.users[uid] = VirtualUser(self, uid, True, random.Random(args.seed * 7919 + uid))
+        weights = [args.mix.get(name, 0.0) for name in SCENARIOS]
+        self.started_at = time.monotonic()
+        deadline = self.started_at + args.duration
+
+        async def run(u: VirtualUser) -> None:
+            await asyncio.sleep(u.rng.uniform(0, args.ramp))
+            while time.monotonic() < deadline:
+                name = "register" if not u.registered else u.rng.choices(SCENARIOS, weights)[0]
+                self.scenarios[name] += 1
+                try:
+                    await (scenario_register(u) if name == "register" else SCENARIO_FUNCS[name](u))
+                except Exception as e:
+                    self.errors[f"{name}: {type(e).__name__}"] += 1
+                await u.think()
+
+        await asyncio.gather(*(run(u) for u in self.users.values()))
+        self.finished_at = time.monotonic()
+
+    async def status(self, request: web.Request) -> web.Response:
+        return web.json_response({"ready": True, "started": self.started_at is not None, "done": self.finished_at is not None})
+
+    async def report(self, request: web.Request) -> web.Response:
+        elapsed = (self.finished_at or time.monotonic()) - (self.started_at or time.monotonic())
+        return web.json_response({
+            "elapsed": elapsed,
+            "users": len(self.users),
+            "updates": self._next_update_id - 1,
+            "scenarios": dict(self.scenarios),
+            "steps": {step: percentiles(v) for step, v in sorted(self.steps.items()) if v},
+            "timeouts": dict(self.timeouts),
+            "errors": dict(self.errors),
+            "telegram_calls": dict(self.calls),
+            "openai_calls": dict(self.openai.calls),
+        })
+
+async def run_fakes(args: argparse.Namespace) -> None:
+    openai = FakeOpenAI(args)
+    telegram = FakeTelegram(args, openai)
+    runners = []
+    for app, port in ((telegram.app(), args.telegram_port), (openai.app(), args.openai_port)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+    print(f"Заглушки: Telegram http://127.0.0.1:{args.telegram_port}, OpenAI http://127.0.0.1:{args.openai_port}/v1")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+def serve_fakes(args: argparse.Namespace) -> None:
+    try:
+        asyncio.run(run_fakes(args))
+    except KeyboardInterrupt:
+        pass
+
+# =========================
+# Бот под нагрузкой
+# =========================
+
+class HandlerTimer:
+    # Внутренний middleware: время работы каждого хэндлера (после очереди user_serial)
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    async def __call__(self, handler: Callable, event: Any, data: Dict[str, Any]) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "?"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors[name] += 1
+            raise
+        finally:
+            self.durations[name].append(time.perf_counter() - started)
+
+async def seed_dataset(
+    profiles: int,
+    likes_per_user: int,
+    like_ratio: float,
+    dim: int,
+    seed: int,
+    chunk: int = 20_000,
+) -> Tuple[int, int]:
+    # Синтетические анкеты и оценки в текущую БД пула; эмбеддинги — та же функция,
+    # что у заглушки OpenAI. Пишется кусками, поэтому годится и для миллиона анкет.
+    from db import init_db, rebuild_pending_likes
+    from db_pool import pool
+    from ranking import pack_embedding
+
+    await init_db()
+    row = await pool.fetchone("SELECT COUNT(*) FROM profiles")
+    if row and row[0]:
+        print(f"В БД уже {row[0]} анкет, генерация пропущена")
+        return row[0], 0
+    rng = random.Random(seed)
+    now = int(time.time())
+    cities = [rng.choices(CITIES, CITY_WEIGHTS)[0] for _ in range(profiles)]
+    by_city: Dict[str, List[int]] = defaultdict(list)
+    for i, city in enumerate(cities):
+        by_city[city].append(SEED_USER_BASE + i)
+
+    async def insert(sql: str, rows: List[Tuple[Any, ...]]) -> None:
+        async with pool.writer() as db:
+            await db.executemany(sql, rows)
+
+    rows: List[Tuple[Any, ...]] = []
+    for i, city in enumerate(cities):
+        uid = SEED_USER_BASE + i
+        gender = rng.choice(("M", "F"))
+        looking_for = rng.choices(("F" if gender == "M" else "M", "ANY"), (0.85, 0.15))[0]
+        desc = describe(rng)
+        rows.append((
+            uid, f"u{uid}", rng.choice(NAMES), rng.randint(18, 45), city, gender, looking_for, desc,
+            f"loadgen-photo-{uid}", pack_embedding(fake_embedding(desc, dim)), now,
+        ))
+        if len(rows) >= chunk or i == profiles - 1:
+            await insert(
+                "INSERT INTO profiles (user_id, username, name, age, city, gender, looking_for, description, "
+                "photo_file_id, embedding, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            rows = []
+
+    interactions = 0
+    for i, city in enumerate(cities):
+        uid, others = SEED_USER_BASE + i, by_city[city]
+        for target in rng.sample(others, min(likes_per_user, len(others))):
+            if target != uid:
+                action = "like" if rng.random() < like_ratio else "dislike"
+                rows.append((uid, target, action, now - rng.randrange(86400)))
+        if len(rows) >= chunk or i == profiles - 1:
+            await insert("INSERT OR IGNORE INTO interactions (user_id, target_id, action, ts) VALUES (?, ?, ?, ?)", rows)
+            interactions += len(rows)
+            rows = []
+    pending = await rebuild_pending_likes()
+    print(f"Сгенерировано анкет: {profiles}, оценок: {interactions}, лайков без ответа: {pending}")
+    return profiles, interactions
+
+async def wait_fakes(args: argparse.Namespace, key: str, timeout: float) -> Dict[str, Any]:
+    url = f"http://127.0.0.1:{args.telegram_port}/_loadgen/status"
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as resp:
+                    status = await resp.json()
+                    if status.get(key):
+                        return status
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"заглушки не ответили ({key})")
+            await asyncio.sleep(0.2)
+
+async def drive_bot(args: argparse.Namespace) -> Dict[str, Any]:
+    # Адреса заглушек и БД конфиг читает из окружения, поэтому бот импортируется только здесь
+    import bot as app
+    from db_pool import close_pool, open_pool
+
+    await open_pool()
+    await seed_dataset(args.profiles, args.likes_per_user, args.like_ratio, args.dim, args.seed)
+    await close_pool()
+
+    timer = HandlerTimer()
+    app.dp.message.middleware(timer)
+    app.dp.callback_query.middleware(timer)
+
+    await wait_fakes(args, "ready", 15)
+    polling = asyncio.create_task(
+        app.dp.start_polling(app.bot, allowed_updates=app.ALLOWED_UPDATES, handle_signals=False)
+    )
+    try:
+        await wait_fakes(args, "done", args.duration + args.ramp + args.reply_timeout * 20 + 60)
+    finally:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{args.telegram_port}/_loadgen/report") as resp:
+                report = await resp.json()
+        await app.dp.stop_polling()
+        await polling
+
+    report["handlers"] = {name: percentiles(v) for name, v in sorted(timer.durations.items())}
+    report["handler_errors"] = dict(timer.errors)
+    report["outbox"] = app.outbox.stats()
+    return report
+
+def print_report(report: Dict[str, Any]) -> None:
+    elapsed = report["elapsed"] or 1e-9
+    handlers = report["handlers"]
+    print(f"\nПрогон: {elapsed:.1f} с, пользователей {report['users']}, апдейтов {report['updates']} "
+          f"({report['updates'] / elapsed:.1f}/с)")
+    swipes = handlers.get("on_like_dislike", {}).get("count", 0)
+    chats = handlers.get("virtual_chatting", {}).get("count", 0)
+    print(f"Свайпы: {swipes / elapsed:.1f}/с, сообщения виртуальному собеседнику: {chats / elapsed:.1f}/с")
+    print(f"Сценарии: {report['scenarios']}")
+
+    def table(title: str, rows: Dict[str, Dict[str, float]]) -> None:
+        print(f"\n{title}")
+        print(f"{'':<28}{'кол-во':>8}{'в сек':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}")
+        for name, s in rows.items():
+            print(f"{name:<28}{s['count']:>8}{s['count'] / elapsed:>8.1f}{s['p50']:>10.1f}{s['p95']:>10.1f}{s['p99']:>10.1f}")
+
+    table("Хэндлеры (время внутри бота):", handlers)
+    table("Шаги сценариев (от апдейта до ответа бота):", report["steps"])
+    for key, title in (
+        ("timeouts", "Нет ответа"),
+        ("errors", "Ошибки сценариев"),
+        ("handler_errors", "Ошибки хэндлеров"),
+    ):
+        if report[key]:
+            print(f"\n{title}: {report[key]}")
+    print(f"\nВызовы Telegram: {report['telegram_calls']}")
+    print(f"Вызовы OpenAI: {report['openai_calls']}")
+    print(f"Очередь отправки: {report['outbox']}")
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"неизвестный сценарий: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на заглушках Telegram и OpenAI")
+    parser.add_argument("--fakes-only", action="store_true",
+                        help="только поднять заглушки (bot.py запускается отдельно с TELEGRAM_API_URL/OPENAI_BASE_URL)")
+    parser.add_argument("--duration", type=float, default=60.0, help="сек, в течение которых стартуют сценарии")
+    parser.add_argument("--ramp", type=float, default=5.0, help="сек, за которые подключаются пользователи")
+    parser.add_argument("--users", type=int, default=200, help="активных виртуальных пользователей")
+    parser.add_argument("--new-users", type=float, default=0.2, help="доля пользователей без анкеты (регистрация)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("swipe=6,likers=2,chat=1"),
+                        help="веса сценариев для пользователей с анкетой")
+    parser.add_argument("--think", type=float, default=1.0, help="сек, среднее время «на подумать» между действиями")
+    parser.add_argument("--swipes", type=int, default=10, help="оценок за один заход в ленту или список лайкнувших")
+    parser.add_argument("--like-ratio", type=float, default=0.4)
+    parser.add_argument("--chat-messages", type=int, default=3, help="сообщений за один виртуальный чат")
+    parser.add_argument("--reply-timeout", type=float, default=30.0, help="сек ожидания ответа бота на шаг")
+    parser.add_argument("--profiles", type=int, default=5000, help="анкет в синтетической БД")
+    parser.add_argument("--likes-per-user", type=int, default=20, help="оценок на анкету в синтетической БД")
+    parser.add_argument("--dim", type=int, default=256, help="размерность эмбеддингов заглушки")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="сек на запрос эмбеддингов")
+    parser.add_argument("--chat-latency", type=float, default=0.4, help="сек до первого токена ответа")
+    parser.add_argument("--chat-chunks", type=int, default=30, help="токенов в ответе")
+    parser.add_argument("--chunk-interval", type=float, default=0.02, help="сек между токенами")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--openai-port", type=int, default=8082)
+    parser.add_argument("--db", default="", help="файл БД (по умолчанию — временный)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default="", help="сохранить отчёт в JSON")
+    args = parser.parse_args()
+
+    if args.fakes_only:
+        serve_fakes(args)
+        return
+
+    os.environ.update(
+        BOT_TOKEN=LOADGEN_TOKEN,
+        OPENAI_API_KEY="sk-loadgen",
+        TELEGRAM_API_URL=f"http://127.0.0.1:{args.telegram_port}",
+        OPENAI_BASE_URL=f"http://127.0.0.1:{args.openai_port}/v1",
+        DB_PATH=args.db or os.path.join(tempfile.mkdtemp(prefix="loadgen-"), "loadgen.sqlite3"),
+    )
+    # Заглушки — в отдельном процессе, чтобы не делить с ботом event loop и GIL
+    fakes = multiprocessing.get_context("spawn").Process(target=serve_fakes, args=(args,), daemon=True)
+    fakes.start()
+    try:
+        report = asyncio.run(drive_bot(args))
+    finally:
+        fakes.terminate()
+        fakes.join()
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#Служебные команды
+
+import argparse
+import asyncio
+import sys
+
+from config import EMBED_BACKFILL_BATCH, EMBED_BACKFILL_PER_MIN, VIRTUAL_HISTORY_KEEP, logger
+from db import (
+    compact_virtual_messages,
+    init_db,
+    migrate_embeddings,
+    rebuild_pending_likes,
+    verify_pending_likes,
+)
+from db_pool import close_pool, open_pool, pool
+from embedding_worker import EmbeddingWorker
+from query_plans import HOT_QUERIES, check_query_plans, explain
+
+async def cmd_migrate_embeddings(args: argparse.Namespace) -> None:
+    converted = await migrate_embeddings(batch_size=args.batch_size, pause=args.pause)
+    logger.info(f"Эмбеддингов переведено в BLOB: {converted}")
+    if args.vacuum:
+        # VACUUM переписывает файл целиком и блокирует запись — запускать вне пиковых часов
+        async with pool.writer() as db:
+            await db.commit()
+            await db.execute("VACUUM")
+        logger.info("VACUUM выполнен.")
+
+async def cmd_check_plans(args: argparse.Namespace) -> None:
+    if args.verbose:
+        for q in HOT_QUERIES:
+            print(f"-- {q.name}")
+            for step in await explain(q.sql, q.params):
+                print(f"   {step}")
+    problems = await check_query_plans()
+    for p in problems:
+        print(f"FAIL {p}")
+    if problems:
+        sys.exit(1)
+    print(f"OK: {len(HOT_QUERIES)} запросов используют индексы")
+
+async def cmd_backfill_embeddings(args: argparse.Namespace) -> None:
+    worker = EmbeddingWorker(batch_size=args.batch_size, per_minute=args.per_minute)
+    await worker.run_pass()
+    logger.info(f"Пересчёт эмбеддингов завершён: {worker.progress()}")
+
+async def cmd_compact_virtual(args: argparse.Namespace) -> None:
+    deleted = await compact_virtual_messages(keep=args.keep)
+    logger.info(f"Удалено старых сообщений виртуальных чатов: {deleted}")
+
+async def cmd_pending_likes(args: argparse.Namespace) -> None:
+    report = await verify_pending_likes()
+    print(f"pending_likes: не хватает {report['missing']}, лишних {report['extra']}")
+    for target_id, liker_id in report["missing_sample"]:
+        print(f"  нет: {liker_id} -> {target_id}")
+    for target_id, liker_id in report["extra_sample"]:
+        print(f"  лишнее: {liker_id} -> {target_id}")
+    if args.rebuild:
+        rows = await rebuild_pending_likes()
+        print(f"pending_likes пересобрана: {rows} строк")
+    elif report["missing"] or report["extra"]:
+        sys.exit(1)
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Служебные команды бота знакомств")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("migrate-embeddings", help="перевести JSON-эмбеддинги в float32 BLOB")
+    p.add_argument("--batch-size", type=int, default=500)
+    p.add_argument("--pause", type=float, default=0.05, help="пауза между пачками, сек")
+    p.add_argument("--vacuum", action="store_true", help="сжать файл БД после миграции")
+    p.set_defaults(func=cmd_migrate_embeddings)
+
+    p = sub.add_parser("backfill-embeddings", help="посчитать недостающие и устаревшие эмбеддинги")
+    p.add_argument("--batch-size", type=int, default=EMBED_BACKFILL_BATCH)
+    p.add_argument("--per-minute", type=int, default=EMBED_BACKFILL_PER_MIN, help="предел текстов в минуту")
+    p.set_defaults(func=cmd_backfill_embeddings)
+
+    p = sub.add_parser("check-plans", help="проверить EXPLAIN QUERY PLAN горячих запросов")
+    p.add_argument("-v", "--verbose", action="store_true", help="печатать планы")
+    p.set_defaults(func=cmd_check_plans)
+
+    p = sub.add_parser("pending-likes", help="сверить pending_likes с interactions")
+    p.add_argument("--rebuild", action="store_true", help="пересобрать таблицу из interactions")
+    p.set_defaults(func=cmd_pending_likes)
+
+    p = sub.add_parser("compact-virtual", help="удалить старые сообщения виртуальных чатов")
+    p.add_argument("--keep", type=int, default=VIRTUAL_HISTORY_KEEP, help="сколько последних сообщений оставить")
+    p.set_defaults(func=cmd_compact_virtual)
+
+    return parser
+
+async def run(args: argparse.Namespace) -> None:
+    await open_pool()
+    try:
+        await init_db()
+        await args.func(args)
+    finally:
+        await close_pool()
+
+if __name__ == "__main__":
+    asyncio.run(run(build_parser().parse_args()))
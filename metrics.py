@@ -0,0 +1,276 @@
+#Метрики и трассировка
+
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from aiohttp import web
+
+from config import METRICS_HOST, METRICS_PORT, TRACE_SLOW_MS, TRACE_UPDATES, logger
+
+Labels = Tuple[str, ...]
+
+# Секунды: от долей миллисекунды (SQLite) до десятков секунд (OpenAI)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # метки -> [счётчики по корзинам..., сумма, количество]
+        self._values: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        data = self._values.get(labels)
+        if data is None:
+            data = self._values[labels] = [0.0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+                break
+        data[-2] += value
+        data[-1] += 1
+
+    def count(self, *labels: str) -> int:
+        data = self._values.get(labels)
+        return int(data[-1]) if data else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, data in sorted(self._values.items()):
+            cumulative = 0.0
+            for bound, n in zip(self.buckets, data):
+                cumulative += n
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {_format_value(cumulative)}")
+            inf = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, inf)} {_format_value(data[-1])}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(data[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {_format_value(data[-1])}")
+        return lines
+
+class Gauge:
+    # Значение снимается в момент запроса /metrics: функция возвращает число
+    # или словарь {значения меток: число}
+    def __init__(self, name: str, help: str, labels: Sequence[str], collect: Callable[[], Union[float, Dict[Labels, float]]]):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.collect()
+        except Exception as e:
+            logger.warning(f"Метрика {self.name} не снята: {e}")
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+
+    def _add(self, metric: Any) -> Any:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str], collect: Callable[[], Any]) -> Gauge:
+        # Повторная регистрация заменяет функцию (например, после пересоздания объекта)
+        gauge = Gauge(name, help, labels, collect)
+        self._metrics[name] = gauge
+        return gauge
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+HANDLER_SECONDS = registry.histogram("bot_handler_seconds", "Время работы хэндлера", ("handler",))
+HANDLER_ERRORS = registry.counter("bot_handler_errors_total", "Исключения в хэндлерах", ("handler", "error"))
+DB_QUERY_SECONDS = registry.histogram("bot_db_query_seconds", "Время запроса к SQLite", ("query",))
+DB_WAIT_SECONDS = registry.histogram("bot_db_pool_wait_seconds", "Ожидание соединения из пула", ("kind",))
+DB_SLOW_QUERIES = registry.counter("bot_db_slow_queries_total", "Запросы дольше DB_SLOW_QUERY_MS", ("query",))
+OPENAI_SECONDS = registry.histogram("bot_openai_request_seconds", "Время запроса к OpenAI (со слотом регулятора)", ("model",))
+OPENAI_WAIT_SECONDS = registry.histogram("bot_openai_queue_seconds", "Ожидание слота регулятора OpenAI", ("model",))
+OPENAI_TOKENS = registry.counter("bot_openai_tokens_total", "Токены OpenAI (по usage или оценке)", ("model",))
+OPENAI_ERRORS = registry.counter("bot_openai_errors_total", "Ошибки запросов к OpenAI", ("model", "error"))
+OPENAI_RETRIES = registry.counter("bot_openai_retries_total", "Повторы запросов к OpenAI", ("model",))
+
+# =========================
+# Трассировка апдейтов
+# =========================
+
+class _Trace:
+    __slots__ = ("update_id", "started", "spans")
+
+    def __init__(self, update_id: int):
+        self.update_id = update_id
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []  # (имя, начало от старта апдейта, длительность)
+
+_current_trace: ContextVar[Optional[_Trace]] = ContextVar("current_trace", default=None)
+
+def add_span(name: str, started: float, duration: float) -> None:
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append((name, started - trace.started, duration))
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(name, started, time.perf_counter() - started)
+
+class TraceMiddleware(BaseMiddleware):
+    # Внешний middleware на dp.update: собирает спаны хэндлера, запросов к БД и OpenAI
+    # в рамках одного апдейта и пишет их одной строкой в лог
+
+    def __init__(self, enabled: bool = TRACE_UPDATES, slow_ms: float = TRACE_SLOW_MS):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not self.enabled:
+            return await handler(event, data)
+        trace = _Trace(getattr(event, "update_id", 0))
+        token = _current_trace.set(trace)
+        try:
+            return await handler(event, data)
+        finally:
+            _current_trace.reset(token)
+            total_ms = (time.perf_counter() - trace.started) * 1000.0
+            if total_ms >= self.slow_ms:
+                spans = "; ".join(f"{name} +{start * 1000:.1f} {dur * 1000:.1f} мс" for name, start, dur in trace.spans)
+                logger.info(f"Трассировка апдейта {trace.update_id}: {total_ms:.1f} мс [{spans}]")
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware: время и ошибки каждого хэндлера (без ожидания в очереди user_serial)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            HANDLER_SECONDS.observe(duration, name)
+            add_span(f"handler {name}", started, duration)
+
+# =========================
+# SQL
+# =========================
+
+_SQL_VERB = re.compile(r"^\s*(\w+)", re.S)
+_SQL_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+([A-Za-z_][A-Za-z0-9_]*)", re.I)
+_SPACES = re.compile(r"\s+")
+
+@lru_cache(maxsize=2048)
+def query_label(sql: str) -> str:
+    # Метка запроса без параметров: «SELECT profiles», «INSERT interactions»
+    verb = _SQL_VERB.match(sql)
+    table = _SQL_TABLE.search(sql)
+    label = verb.group(1).upper() if verb else "SQL"
+    if table and label != "PRAGMA":
+        label += f" {table.group(1)}"
+    return label
+
+def short_sql(sql: str, limit: int = 300) -> str:
+    text = _SPACES.sub(" ", sql).strip()
+    return text if len(text) <= limit else text[:limit] + "…"
+
+# =========================
+# HTTP-эндпоинт
+# =========================
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[web.AppRunner]:
+    if not port:
+        return None
+
+    async def handle(_: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logger.warning(f"Эндпоинт метрик не запущен ({host}:{port}): {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Метрики: http://{host}:{port}/metrics")
+    return runner
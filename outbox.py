@@ -0,0 +1,341 @@
+#Очередь исходящих сообщений
+
+import asyncio
+import heapq
+import itertools
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+)
+from aiogram.types import (
+    ForceReply,
+    InlineKeyboardMarkup,
+    ReplyKeyboardMarkup,
+    ReplyKeyboardRemove,
+)
+
+from ai_utils import TokenBucket
+from config import (
+    OUTBOX_CHAT_BURST,
+    OUTBOX_CHAT_PER_SEC,
+    OUTBOX_CONCURRENCY,
+    OUTBOX_DRAIN_TIMEOUT,
+    OUTBOX_GLOBAL_PER_SEC,
+    OUTBOX_MAX_ATTEMPTS,
+    logger,
+)
+from db_pool import pool
+
+PRIORITY_INTERACTIVE = 0  # ответ пользователю, который сейчас в боте
+PRIORITY_NOTIFY = 1  # уведомления (лайки, взаимность)
+
+_MARKUPS = {cls.__name__: cls for cls in (InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, ForceReply)}
+
+def dump_markup(markup: Any) -> Optional[Dict[str, Any]]:
+    if markup is None:
+        return None
+    return {"type": type(markup).__name__, "data": markup.model_dump(exclude_none=True)}
+
+def load_markup(raw: Optional[Dict[str, Any]]) -> Any:
+    if raw is None:
+        return None
+    return _MARKUPS[raw["type"]].model_validate(raw["data"])
+
+class _Outgoing:
+    __slots__ = ("chat_id", "priority", "method", "payload", "row_id", "attempts", "not_before", "future", "seq")
+
+    def __init__(
+        self,
+        chat_id: int,
+        priority: int,
+        method: str,
+        payload: Dict[str, Any],
+        row_id: Optional[int] = None,
+        attempts: int = 0,
+    ):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.method = method
+        self.payload = payload  # JSON-совместимые аргументы; reply_markup — через dump_markup
+        self.row_id = row_id  # id в таблице outbox, если сообщение должно пережить перезапуск
+        self.attempts = attempts
+        self.not_before = 0.0
+        self.future: Optional[asyncio.Future] = None
+        self.seq: Optional[int] = None
+
+    def kwargs(self) -> Dict[str, Any]:
+        kwargs = dict(self.payload)
+        if "reply_markup" in kwargs:
+            kwargs["reply_markup"] = load_markup(kwargs["reply_markup"])
+        return kwargs
+
+class OutboundScheduler:
+    # Все исходящие сообщения идут через приоритетную очередь: общий лимит
+    # OUTBOX_GLOBAL_PER_SEC, уведомления в каждый чат — не чаще OUTBOX_CHAT_PER_SEC
+    # (с запасом OUTBOX_CHAT_BURST). Ответы пользователю, который сейчас листает
+    # анкеты, идут только под общий лимит и обгоняют уведомления. В один чат
+    # одновременно отправляется одно сообщение, поэтому порядок внутри чата сохраняется.
+    # На 429 сообщение ждёт retry_after и уходит снова; уведомления (durable)
+    # сначала пишутся в таблицу outbox и после перезапуска досылаются.
+
+    def __init__(
+        self,
+        bot: Bot,
+        per_second: float = OUTBOX_GLOBAL_PER_SEC,
+        chat_per_second: float = OUTBOX_CHAT_PER_SEC,
+        chat_burst: int = OUTBOX_CHAT_BURST,
+        concurrency: int = OUTBOX_CONCURRENCY,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        max_chats: int = 10_000,
+    ):
+        self.bot = bot
+        self.chat_per_minute = chat_per_second * 60.0
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.max_chats = max_chats
+        self._global = TokenBucket(per_second * 60.0, burst=per_second)
+        self._chats: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._queue: List[Tuple[int, int, _Outgoing]] = []
+        self._order = itertools.count()
+        self._busy: Set[int] = set()
+        self._sem = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": len(self._queue),
+            "sending": len(self._sending),
+            "sent": self.sent,
+            "retried": self.retried,
+            "dropped": self.dropped,
+        }
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_per_minute, burst=self.chat_burst)
+            # Давно не использованный бак уже полон — его можно просто забыть
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _push(self, item: _Outgoing) -> None:
+        # При повторе сообщение сохраняет своё место в очереди — порядок в чате не меняется
+        if item.seq is None:
+            item.seq = next(self._order)
+        heapq.heappush(self._queue, (item.priority, item.seq, item))
+        self._wakeup.set()
+
+    async def enqueue(
+        self,
+        chat_id: int,
+        method: str,
+        payload: Dict[str, Any],
+        priority: int = PRIORITY_INTERACTIVE,
+        durable: bool = False,
+    ) -> asyncio.Future:
+        # Future завершается отправленным Message или None, если сообщение отброшено
+        item = _Outgoing(chat_id, priority, method, payload)
+        if durable:
+            async with pool.writer() as db:
+                cur = await db.execute(
+                    "INSERT INTO outbox (chat_id, priority, method, payload, created_at) "
+                    "VALUES (?, ?, ?, ?, strftime('%s', 'now'))",
+                    (chat_id, priority, method, json.dumps(payload, ensure_ascii=False)),
+                )
+                item.row_id = cur.lastrowid
+                await cur.close()
+        item.future = asyncio.get_running_loop().create_future()
+        self._push(item)
+        return item.future
+
+    async def send_message(
+        self,
+        chat_id: int,
+        text: str,
+        reply_markup: Any = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        durable: bool = False,
+    ) -> asyncio.Future:
+        payload: Dict[str, Any] = {"text": text}
+        if reply_markup is not None:
+            payload["reply_markup"] = dump_markup(reply_markup)
+        return await self.enqueue(chat_id, "send_message", payload, priority, durable)
+
+    async def send_photo(
+        self,
+        chat_id: int,
+        photo: str,
+        caption: Optional[str] = None,
+        reply_markup: Any = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        durable: bool = False,
+    ) -> asyncio.Future:
+        payload: Dict[str, Any] = {"photo": photo, "caption": caption}
+        if reply_markup is not None:
+            payload["reply_markup"] = dump_markup(reply_markup)
+        return await self.enqueue(chat_id, "send_photo", payload, priority, durable)
+
+    async def load(self) -> int:
+        # Недоставленные до перезапуска уведомления
+        rows = await pool.fetchall("SELECT id, chat_id, priority, method, payload, attempts FROM outbox ORDER BY id")
+        for r in rows:
+            try:
+                payload = json.loads(r["payload"])
+            except ValueError:
+                continue
+            self._push(_Outgoing(r["chat_id"], r["priority"], r["method"], payload, r["id"], r["attempts"]))
+        if rows:
+            logger.info(f"Очередь отправки: восстановлено {len(rows)} сообщений")
+        return len(rows)
+
+    def _next_ready(self) -> Tuple[Optional[_Outgoing], Optional[float]]:
+        # Первое по приоритету сообщение, чей чат свободен и не упёрся в лимит;
+        # иначе — через сколько секунд стоит проверить снова
+        now = time.monotonic()
+        blocked: Set[int] = set()
+        skipped = []
+        picked: Optional[_Outgoing] = None
+        wait: Optional[float] = None
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            item = entry[2]
+            if item.chat_id in self._busy or item.chat_id in blocked:
+                skipped.append(entry)
+                continue
+            delay = item.not_before - now
+            if item.priority != PRIORITY_INTERACTIVE:
+                delay = max(delay, self._chat_bucket(item.chat_id).wait_time(1, 0, now))
+            if delay > 0:
+                # Следующие сообщения этого чата ждут за ним
+                blocked.add(item.chat_id)
+                skipped.append(entry)
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            delay = self._global.wait_time(1, 0, now)
+            if delay > 0:
+                skipped.append(entry)
+                wait = delay if wait is None else min(wait, delay)
+                break
+            picked = item
+            break
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+        return picked, wait
+
+    async def _run(self) -> None:
+        while True:
+            await self._sem.acquire()
+            item, wait = self._next_ready()
+            if item is None:
+                self._sem.release()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._global.take(1)
+            if item.priority != PRIORITY_INTERACTIVE:
+                self._chat_bucket(item.chat_id).take(1)
+            self._busy.add(item.chat_id)
+            task = asyncio.create_task(self._deliver(item))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    def _finish(self, item: _Outgoing, result: Any) -> None:
+        if item.future is not None and not item.future.done():
+            item.future.set_result(result)
+
+    async def _forget(self, item: _Outgoing) -> None:
+        # Ошибка удаления строки — не повод отправлять ещё раз: в худшем случае
+        # уведомление повторится после перезапуска
+        if item.row_id is None:
+            return
+        try:
+            async with pool.writer() as db:
+                await db.execute("DELETE FROM outbox WHERE id = ?", (item.row_id,))
+        except Exception as e:
+            logger.warning(f"Очередь отправки: не удалось удалить сообщение {item.row_id} из outbox: {e}")
+
+    async def _deliver(self, item: _Outgoing) -> None:
+        try:
+            msg = await getattr(self.bot, item.method)(chat_id=item.chat_id, **item.kwargs())
+        except TelegramRetryAfter as e:
+            # Флуд-контроль: ждём сколько сказал Telegram и притормаживаем все отправки
+            self.retried += 1
+            item.not_before = time.monotonic() + e.retry_after
+            self._global.drain()
+            logger.warning(f"Отправка в чат {item.chat_id}: flood wait {e.retry_after} с")
+            self._push(item)
+        except (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound) as e:
+            # Бот заблокирован, чат удалён или сообщение некорректно — повтор не поможет
+            self.dropped += 1
+            logger.warning(f"Сообщение в чат {item.chat_id} не доставлено: {e}")
+            await self._forget(item)
+            self._finish(item, None)
+        except asyncio.CancelledError:
+            self._push(item)
+            raise
+        except Exception as e:
+            item.attempts += 1
+            if item.attempts >= self.max_attempts:
+                self.dropped += 1
+                logger.warning(f"Сообщение в чат {item.chat_id} не доставлено после {item.attempts} попыток: {e}")
+                await self._forget(item)
+                self._finish(item, None)
+            else:
+                self.retried += 1
+                item.not_before = time.monotonic() + min(60.0, 2.0 ** item.attempts)
+                if item.row_id is not None:
+                    async with pool.writer() as db:
+                        await db.execute("UPDATE outbox SET attempts = ? WHERE id = ?", (item.attempts, item.row_id))
+                self._push(item)
+        else:
+            # Вне try отправки: сбой после доставки не должен вызвать повторную отправку
+            self.sent += 1
+            self._finish(item, msg)
+            await self._forget(item)
+        finally:
+            self._busy.discard(item.chat_id)
+            self._sem.release()
+            self._wakeup.set()
+
+    async def start(self) -> None:
+        if self._task is None or self._task.done():
+            await self.load()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = OUTBOX_DRAIN_TIMEOUT) -> None:
+        # Даём очереди доотправиться; неотправленные уведомления остаются в таблице outbox
+        deadline = time.monotonic() + timeout
+        while (self._queue or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for task in list(self._sending):
+            task.cancel()
+        await asyncio.gather(*self._sending, return_exceptions=True)
+        lost = sum(1 for _, _, item in self._queue if item.row_id is None)
+        if lost:
+            logger.warning(f"Очередь отправки: при остановке не отправлено {lost} сообщений")
+        for _, _, item in self._queue:
+            self._finish(item, None)
+        self._queue.clear()
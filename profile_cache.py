@@ -0,0 +1,116 @@
+#Кэш анкет в памяти
+
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Optional
+
+from config import PROFILE_CACHE_MAX
+
+PROFILE_FIELDS = (
+    "user_id",
+    "username",
+    "name",
+    "age",
+    "city",
+    "gender",
+    "looking_for",
+    "description",
+    "photo_file_id",
+    "embedding",
+    "updated_at",
+)
+
+class Profile(Mapping):
+    # Анкета только для чтения: поля в __slots__ вместо словаря на каждый объект.
+    # Доступ как к dict (p["name"], p.get("city"), dict(p)), изменять нельзя —
+    # объект может лежать в кэше и отдаваться нескольким обработчикам сразу.
+    __slots__ = PROFILE_FIELDS
+
+    def __init__(self, row: Any):
+        for field in PROFILE_FIELDS:
+            object.__setattr__(self, field, row[field])
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("Profile только для чтения")
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in PROFILE_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(PROFILE_FIELDS)
+
+    def __len__(self) -> int:
+        return len(PROFILE_FIELDS)
+
+    def __repr__(self) -> str:
+        return f"Profile(user_id={self.user_id}, name={self.name!r})"
+
+class ProfileCache:
+    # LRU горячих анкет. Все записи в profiles идут через db.py: upsert_profile кладёт
+    # в кэш свежую строку (write-through), пакетные UPDATE сбрасывают затронутые id.
+    # Чтение из БД, во время которого анкету успели изменить, в кэш не попадает.
+
+    def __init__(self, max_items: int = PROFILE_CACHE_MAX):
+        self.max_items = max_items
+        self._mem: "OrderedDict[int, Profile]" = OrderedDict()
+        self._loading: Dict[int, object] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / total if total else 0.0,
+            "items": len(self._mem),
+        }
+
+    def get(self, user_id: int) -> Optional[Profile]:
+        profile = self._mem.get(user_id)
+        if profile is None:
+            self.misses += 1
+            return None
+        self._mem.move_to_end(user_id)
+        self.hits += 1
+        return profile
+
+    def begin_load(self, user_id: int) -> object:
+        token = object()
+        self._loading[user_id] = token
+        return token
+
+    def finish_load(self, user_id: int, token: object, profile: Optional[Profile]) -> None:
+        if self._loading.get(user_id) is not token:
+            return  # анкету изменили (или читают заново) — результат мог устареть
+        del self._loading[user_id]
+        if profile is not None:
+            self.put(profile)
+
+    def put(self, profile: Profile) -> None:
+        user_id = profile.user_id
+        self._loading.pop(user_id, None)
+        if not self.max_items:
+            return
+        self._mem[user_id] = profile
+        self._mem.move_to_end(user_id)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id: int) -> None:
+        self._loading.pop(user_id, None)
+        if self._mem.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self._mem.clear()
+        self._loading.clear()
+
+profile_cache = ProfileCache()
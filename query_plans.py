@@ -0,0 +1,84 @@
+#Проверка планов запросов
+
+import re
+from typing import Any, List, NamedTuple, Sequence
+
+from db import (
+    COUNT_PENDING_LIKERS_SQL,
+    NEXT_PENDING_LIKER_SQL,
+    VIRTUAL_HISTORY_SQL,
+    candidate_filter,
+)
+from db_pool import pool
+
+# Полный проход по таблице или сортировка во временном B-дереве
+_FORBIDDEN = re.compile(r"^(SCAN \w+$|SCAN \w+ (?!USING)|USE TEMP B-TREE)")
+
+class HotQuery(NamedTuple):
+    name: str
+    sql: str
+    params: Sequence[Any]
+    indexes: Sequence[str]  # индексы, которые обязаны встретиться в плане
+
+def _candidate_query(looking_for: str) -> HotQuery:
+    me = {"user_id": 1, "city": "Москва", "gender": "M", "looking_for": looking_for, "age": 25}
+    where, params = candidate_filter(me)
+    return HotQuery(
+        f"find_candidates[{looking_for}]",
+        f"SELECT user_id, updated_at FROM profiles WHERE {where}",
+        params,
+        ("idx_profiles_search",),
+    )
+
+HOT_QUERIES: List[HotQuery] = [
+    HotQuery(
+        "get_profile",
+        "SELECT * FROM profiles WHERE user_id = ?",
+        (1,),
+        ("INTEGER PRIMARY KEY",),
+    ),
+    HotQuery(
+        "has_interaction",
+        "SELECT 1 FROM interactions WHERE user_id = ? AND target_id = ? AND action = ?",
+        (1, 2, "like"),
+        ("sqlite_autoindex_interactions_1",),
+    ),
+    HotQuery(
+        "count_pending_likers",
+        COUNT_PENDING_LIKERS_SQL,
+        (1,),
+        ("idx_pending_likes_ts",),
+    ),
+    HotQuery(
+        "get_next_pending_liker",
+        NEXT_PENDING_LIKER_SQL,
+        (1,),
+        ("idx_pending_likes_ts",),
+    ),
+    HotQuery(
+        "get_virtual_state",
+        VIRTUAL_HISTORY_SQL,
+        (1, 20),
+        ("PRIMARY KEY",),
+    ),
+    _candidate_query("F"),
+    _candidate_query("ANY"),
+]
+
+async def explain(sql: str, params: Sequence[Any]) -> List[str]:
+    rows = await pool.fetchall(f"EXPLAIN QUERY PLAN {sql}", params)
+    return [r[3] for r in rows]
+
+async def check_query_plans(queries: Sequence[HotQuery] = HOT_QUERIES) -> List[str]:
+    # Список нарушений; пустой список — все горячие запросы идут по индексам
+    problems: List[str] = []
+    for q in queries:
+        plan = await explain(q.sql, q.params)
+        text = "\n".join(plan)
+        for step in plan:
+            if _FORBIDDEN.match(step.strip()):
+                problems.append(f"{q.name}: {step.strip()}")
+        for index in q.indexes:
+            if index not in text:
+                problems.append(f"{q.name}: в плане нет {index}")
+    return problems
@@ -0,0 +1,274 @@
+#Ранжирование по эмбеддингам
+
+import json
+import struct
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config import EMBED_MODEL, EMBED_STORE_MAX_ROWS
+
+# Бинарный формат эмбеддинга (BLOB):
+#   MAGIC (4 байта) | dim: uint16 | длина имени модели: uint8 | резерв: uint8 |
+#   имя модели (дополнено нулями до кратного 4) | dim * float32 little-endian
+# Данные выровнены по 4 байтам и читаются через numpy.frombuffer без копирования.
+EMBEDDING_MAGIC = b"EMB1"
+_HEADER = struct.Struct("<4sHBB")
+
+_SCORE_CHUNK = 4096  # строк матрицы за одно умножение
+
+def _pad4(n: int) -> int:
+    return (n + 3) & ~3
+
+def pack_embedding(vec: Any, model: str = EMBED_MODEL) -> bytes:
+    arr = np.asarray(vec, dtype="<f4").ravel()
+    name = model.encode("utf-8")[:255]
+    header = _HEADER.pack(EMBEDDING_MAGIC, arr.size, len(name), 0)
+    return header + name.ljust(_pad4(len(name)), b"\0") + arr.tobytes()
+
+def unpack_embedding(raw: Any) -> Tuple[Optional[str], Optional[np.ndarray]]:
+    # BLOB -> (модель, вектор). BLOB без заголовка читается как голый float32.
+    buf = bytes(raw) if isinstance(raw, memoryview) else raw
+    if len(buf) >= _HEADER.size and buf[:4] == EMBEDDING_MAGIC:
+        _, dim, name_len, _ = _HEADER.unpack_from(buf)
+        offset = _HEADER.size + _pad4(name_len)
+        if len(buf) != offset + dim * 4:
+            return None, None
+        model = buf[_HEADER.size:_HEADER.size + name_len].decode("utf-8", "replace")
+        return model, np.frombuffer(buf, dtype="<f4", count=dim, offset=offset)
+    if len(buf) % 4:
+        return None, None
+    return None, np.frombuffer(buf, dtype="<f4")
+
+def embedding_model_prefix(model: str = EMBED_MODEL) -> Tuple[int, bytes]:
+    # (позиция для SQL substr, байты) — по ним в SQL отбираются BLOB другой модели
+    name = model.encode("utf-8")[:255]
+    return _HEADER.size - 1, bytes([len(name), 0]) + name
+
+def to_vector(raw: Any) -> Optional[np.ndarray]:
+    # Эмбеддинг из профиля (BLOB, JSON-строка или список) -> float32-вектор
+    if raw is None:
+        return None
+    if isinstance(raw, (bytes, bytearray, memoryview)):
+        _, vec = unpack_embedding(raw)
+        if vec is None or vec.size == 0:
+            return None
+        return vec
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except Exception:
+            return None
+    try:
+        vec = np.asarray(raw, dtype=np.float32)
+    except (TypeError, ValueError):
+        return None
+    if vec.ndim != 1 or vec.size == 0:
+        return None
+    return vec
+
+class EmbeddingStore:
+    # Эмбеддинги хранятся подряд в одной float32-матрице, нормы посчитаны заранее,
+    # поэтому пачка кандидатов оценивается одним умножением матрицы на вектор.
+    # Матрица растёт до max_rows строк, дальше вытесняются давно не участвовавшие
+    # в ранжировании анкеты (их версия забывается, и при следующем поиске вектор
+    # подгрузится из БД). Анкеты текущего ранжирования (отмеченные begin и
+    # подгруженные после него) не вытесняются. Размерность задаёт первый вектор
+    # текущей модели; вектор текущей модели другой размерности сбрасывает
+    # хранилище целиком.
+
+    def __init__(self, capacity: int = 1024, max_rows: int = EMBED_STORE_MAX_ROWS, model: str = EMBED_MODEL):
+        self.model = model
+        self.max_rows = max(1, max_rows)
+        self._initial_capacity = min(capacity, self.max_rows)
+        self.evictions = 0
+        self.resets = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self.dim: Optional[int] = None
+        self._capacity = self._initial_capacity
+        self._matrix: Optional[np.ndarray] = None
+        self._norms: Optional[np.ndarray] = None
+        self._row_ids: Optional[np.ndarray] = None  # строка -> user_id
+        self._used: Optional[np.ndarray] = None  # строка -> номер последнего ранжирования
+        self._tick = 0
+        self._rows: Dict[int, int] = {}  # user_id -> строка матрицы
+        self._versions: Dict[int, Any] = {}  # user_id -> updated_at профиля
+        self._free: List[int] = []
+        self._size = 0
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._rows
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "items": len(self._rows),
+            "capacity": self._capacity,
+            "bytes": self._matrix.nbytes if self._matrix is not None else 0,
+            "versions": len(self._versions),
+            "evictions": self.evictions,
+            "resets": self.resets,
+        }
+
+    def _allocate(self, dim: int) -> None:
+        self.dim = dim
+        self._matrix = np.zeros((self._capacity, dim), dtype=np.float32)
+        self._norms = np.zeros(self._capacity, dtype=np.float32)
+        self._row_ids = np.zeros(self._capacity, dtype=np.int64)
+        self._used = np.zeros(self._capacity, dtype=np.int64)
+
+    def _grow(self) -> None:
+        new_cap = min(self._capacity * 2, self.max_rows)
+        matrix = np.zeros((new_cap, self.dim), dtype=np.float32)
+        matrix[: self._size] = self._matrix[: self._size]
+        norms = np.zeros(new_cap, dtype=np.float32)
+        norms[: self._size] = self._norms[: self._size]
+        row_ids = np.zeros(new_cap, dtype=np.int64)
+        row_ids[: self._size] = self._row_ids[: self._size]
+        used = np.zeros(new_cap, dtype=np.int64)
+        used[: self._size] = self._used[: self._size]
+        self._matrix, self._norms, self._capacity = matrix, norms, new_cap
+        self._row_ids, self._used = row_ids, used
+
+    def begin(self, user_ids: Sequence[int]) -> None:
+        # Новое ранжирование: его анкеты и векторы, подгруженные до top_k,
+        # получают текущий номер и не вытесняются друг другом
+        self._tick += 1
+        rows = [self._rows[u] for u in user_ids if u in self._rows]
+        if rows:
+            self._used[np.asarray(rows, dtype=np.intp)] = self._tick
+
+    def _evict(self) -> bool:
+        # Освобождаем сразу 1/16 матрицы — давно не ранжированные строки.
+        # False — все строки заняты текущим ранжированием
+        used = self._used[: self._size]
+        cold = np.flatnonzero(used < self._tick)
+        if not len(cold):
+            return False
+        n = min(max(1, self._size // 16), len(cold))
+        victims = cold[np.argpartition(used[cold], n - 1)[:n]]
+        for row in victims.tolist():
+            user_id = int(self._row_ids[row])
+            del self._rows[user_id]
+            self._versions.pop(user_id, None)
+            self._norms[row] = 0.0
+            self._free.append(row)
+        self.evictions += n
+        return True
+
+    def _remember_version(self, user_id: int, version: Any) -> None:
+        self._versions[user_id] = version
+        # Версии анкет без вектора не должны копиться бесконечно
+        if len(self._versions) > 2 * self.max_rows:
+            self._versions = {u: v for u, v in self._versions.items() if u in self._rows}
+
+    def put(self, user_id: int, vec: np.ndarray, version: Any = None, model: Optional[str] = None) -> bool:
+        # model — модель из заголовка BLOB (None у старых форматов без заголовка)
+        if model is not None and model != self.model:
+            # Вектор другой модели несравним с текущими — ждём пересчёта
+            self.discard(user_id)
+            self._remember_version(user_id, version)
+            return False
+        dim = int(vec.shape[0])
+        if self.dim is not None and dim != self.dim and model == self.model:
+            # Сменилась размерность текущей модели: старые векторы больше не нужны
+            self.resets += 1
+            self.reset()
+        if self.dim is None:
+            self._allocate(dim)
+        if dim != self.dim:
+            self.discard(user_id)
+            self._remember_version(user_id, version)
+            return False
+        row = self._rows.get(user_id)
+        if row is None:
+            if not self._free and self._size == self._capacity:
+                if self._capacity < self.max_rows:
+                    self._grow()
+                elif not self._evict():
+                    # Вектор не сохраняем и версию не запоминаем: анкета останется
+                    # устаревшей и подгрузится при следующем поиске
+                    return False
+            if self._free:
+                row = self._free.pop()
+            else:
+                row = self._size
+                self._size += 1
+            self._rows[user_id] = row
+            self._row_ids[row] = user_id
+        self._matrix[row] = vec
+        self._norms[row] = float(np.linalg.norm(vec))
+        self._used[row] = self._tick
+        self._remember_version(user_id, version)
+        return True
+
+    def discard(self, user_id: int) -> None:
+        row = self._rows.pop(user_id, None)
+        self._versions.pop(user_id, None)
+        if row is not None:
+            self._norms[row] = 0.0
+            self._free.append(row)
+
+    def is_fresh(self, user_id: int, version: Any) -> bool:
+        # Версия профиля уже учтена (в том числе «эмбеддинга нет»)
+        return user_id in self._versions and self._versions[user_id] == version
+
+    def sync(self, user_id: int, version: Any, raw: Any) -> bool:
+        # Разбираем эмбеддинг только если профиль изменился с прошлого раза
+        if self.is_fresh(user_id, version):
+            return user_id in self._rows
+        model = None
+        if isinstance(raw, (bytes, bytearray, memoryview)):
+            model, vec = unpack_embedding(raw)
+            if vec is not None and vec.size == 0:
+                vec = None
+        else:
+            vec = to_vector(raw)
+        if vec is None:
+            self.discard(user_id)
+            self._remember_version(user_id, version)
+            return False
+        return self.put(user_id, vec, version, model)
+
+    def _scores(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # Косинусы по кускам: не копируем всю выборку матрицы разом
+        scores = np.empty(rows.shape[0], dtype=np.float32)
+        qnorm = np.float32(np.linalg.norm(query))
+        for start in range(0, rows.shape[0], _SCORE_CHUNK):
+            part = rows[start:start + _SCORE_CHUNK]
+            chunk = self._matrix[part] @ query
+            denom = self._norms[part] * qnorm
+            np.divide(chunk, denom, out=chunk, where=denom > 0)
+            chunk[denom <= 0] = 0.0
+            scores[start:start + part.shape[0]] = chunk
+        return scores
+
+    def top_k(self, query_vec: Any, candidate_ids: Sequence[int], k: Optional[int] = None) -> Tuple[List[int], np.ndarray]:
+        # k лучших кандидатов по косинусной близости (все, если k не задан), по убыванию.
+        # Кандидаты без эмбеддинга в результат не попадают.
+        query = to_vector(query_vec)
+        if query is None or self.dim is None or query.shape[0] != self.dim:
+            return [], np.empty(0, dtype=np.float32)
+        ids = [i for i in candidate_ids if i in self._rows]
+        if not ids or k == 0:
+            return [], np.empty(0, dtype=np.float32)
+        rows = np.fromiter((self._rows[i] for i in ids), dtype=np.intp, count=len(ids))
+        self._tick += 1
+        self._used[rows] = self._tick
+        scores = self._scores(rows, query)
+        if k is not None and k < len(ids):
+            best = np.argpartition(-scores, k - 1)[:k]
+            best.sort()  # при равных очках сохраняем исходный порядок кандидатов
+        else:
+            best = np.arange(len(ids))
+        order = best[np.argsort(-scores[best], kind="stable")]
+        return [ids[j] for j in order], scores[order]
+
+    def rank(self, query_vec: Any, candidate_ids: Sequence[int]) -> Tuple[List[int], np.ndarray]:
+        return self.top_k(query_vec, candidate_ids)
+
+embedding_store = EmbeddingStore()
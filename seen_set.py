@@ -0,0 +1,232 @@
+#Просмотренные анкеты пользователей в памяти
+
+import math
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from config import SEEN_BLOOM_FP_RATE, SEEN_CACHE_MAX_BYTES, SEEN_MODE
+
+MERGE_AT = 64  # свежих id, после которых они вливаются в отсортированный массив
+BLOOM_MIN_CAPACITY = 256  # минимальная ёмкость фильтра Блума (элементов)
+
+def _as_ids(ids: Union[Sequence[int], np.ndarray]) -> np.ndarray:
+    return np.asarray(ids, dtype=np.int64).reshape(-1)
+
+class SeenSet:
+    # Точный набор: отсортированный int64-массив (8 байт на оценку) и маленькое
+    # множество свежих id, которые периодически вливаются в массив.
+    # Проверка пачки кандидатов — один searchsorted по массиву.
+
+    exact = True
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self._ids = np.unique(np.fromiter(ids, dtype=np.int64))
+        self._recent: set = set()
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._recent)
+
+    @property
+    def nbytes(self) -> int:
+        return 8 * len(self)  # свежие id считаются по размеру после слияния
+
+    def add(self, target_id: int) -> None:
+        if target_id in self:
+            return
+        self._recent.add(target_id)
+        if len(self._recent) >= MERGE_AT:
+            self._merge()
+
+    def _merge(self) -> None:
+        if self._recent:
+            self._ids = np.union1d(self._ids, np.fromiter(self._recent, dtype=np.int64))
+            self._recent.clear()
+
+    def __contains__(self, target_id: int) -> bool:
+        if target_id in self._recent:
+            return True
+        i = int(np.searchsorted(self._ids, target_id))
+        return i < len(self._ids) and int(self._ids[i]) == target_id
+
+    def unseen(self, ids: Union[Sequence[int], np.ndarray]) -> np.ndarray:
+        # Маска «ещё не оценена» для пачки id
+        arr = _as_ids(ids)
+        if len(self._ids):
+            pos = np.searchsorted(self._ids, arr)
+            mask = self._ids[np.minimum(pos, len(self._ids) - 1)] != arr
+        else:
+            mask = np.ones(len(arr), dtype=bool)
+        if self._recent:
+            mask &= ~np.isin(arr, np.fromiter(self._recent, dtype=np.int64))
+        return mask
+
+    def ids(self) -> Optional[np.ndarray]:
+        self._merge()
+        return self._ids
+
+class BloomSeenSet:
+    # Фильтр Блума: ~1.2 байта на элемент ёмкости при 1% ложных срабатываний.
+    # Просмотренная анкета никогда не покажется снова, но небольшая доля
+    # непросмотренных будет пропущена. Ёмкость берётся с запасом; переполненный
+    # фильтр помечается saturated, и индекс пересобирает его из БД.
+
+    exact = False
+
+    def __init__(self, ids: Iterable[int] = (), fp_rate: float = SEEN_BLOOM_FP_RATE):
+        arr = np.unique(np.fromiter(ids, dtype=np.int64))
+        self.capacity = max(BLOOM_MIN_CAPACITY, 2 * len(arr))
+        self.bits = max(64, math.ceil(-self.capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / self.capacity * math.log(2)))
+        self._bitmap = np.zeros((self.bits + 7) // 8, dtype=np.uint8)
+        self._count = 0
+        self._add_many(arr)
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def nbytes(self) -> int:
+        return self._bitmap.nbytes
+
+    @property
+    def saturated(self) -> bool:
+        return self._count > self.capacity
+
+    def _positions(self, arr: np.ndarray) -> np.ndarray:
+        # Двойное хеширование от перемешанного 64-битного id (splitmix64)
+        x = arr.astype(np.uint64)
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+        h1 = x & np.uint64(0xFFFFFFFF)
+        h2 = (x >> np.uint64(32)) | np.uint64(1)
+        steps = np.arange(self.hashes, dtype=np.uint64)
+        return (h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(self.bits)
+
+    def _add_many(self, arr: np.ndarray) -> None:
+        if not len(arr):
+            return
+        pos = self._positions(arr).ravel()
+        np.bitwise_or.at(self._bitmap, (pos >> np.uint64(3)).astype(np.int64), (1 << (pos & np.uint64(7))).astype(np.uint8))
+        self._count += len(arr)
+
+    def add(self, target_id: int) -> None:
+        if target_id not in self:
+            self._add_many(_as_ids([target_id]))
+
+    def __contains__(self, target_id: int) -> bool:
+        return not self.unseen([target_id])[0]
+
+    def unseen(self, ids: Union[Sequence[int], np.ndarray]) -> np.ndarray:
+        arr = _as_ids(ids)
+        if not len(arr):
+            return np.ones(0, dtype=bool)
+        pos = self._positions(arr)
+        bits = (self._bitmap[(pos >> np.uint64(3)).astype(np.int64)] >> (pos & np.uint64(7)).astype(np.uint8)) & 1
+        return ~bits.all(axis=1)
+
+    def ids(self) -> Optional[np.ndarray]:
+        return None  # список id фильтр не хранит
+
+AnySeenSet = Union[SeenSet, BloomSeenSet]
+
+class SeenIndex:
+    # LRU наборов просмотренных анкет с ограничением по памяти. Набор загружается
+    # из interactions при первом подборе, дальше record_interaction дописывает
+    # в него новые оценки. Оценки, пришедшие во время загрузки, не теряются:
+    # они копятся и вливаются в загруженный набор.
+
+    def __init__(self, mode: str = SEEN_MODE, max_bytes: int = SEEN_CACHE_MAX_BYTES):
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self._mem: "OrderedDict[int, AnySeenSet]" = OrderedDict()
+        self._loading: Dict[int, Tuple[object, List[int]]] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / total if total else 0.0,
+            "items": len(self._mem),
+            "bytes": self._bytes,
+        }
+
+    def build(self, ids: Iterable[int]) -> AnySeenSet:
+        return BloomSeenSet(ids) if self.mode == "bloom" else SeenSet(ids)
+
+    def get(self, user_id: int) -> Optional[AnySeenSet]:
+        seen = self._mem.get(user_id)
+        if seen is None or getattr(seen, "saturated", False):
+            if seen is not None:
+                self._drop(user_id)  # фильтр переполнен — пересобрать с большей ёмкостью
+            self.misses += 1
+            return None
+        self._mem.move_to_end(user_id)
+        self.hits += 1
+        return seen
+
+    def begin_load(self, user_id: int) -> object:
+        token = object()
+        self._loading[user_id] = (token, [])
+        return token
+
+    def finish_load(self, user_id: int, token: object, ids: List[int]) -> AnySeenSet:
+        loading = self._loading.get(user_id)
+        if loading is None or loading[0] is not token:
+            # Набор сбросили во время чтения: отдаём результат, но не кэшируем
+            return self.build(ids)
+        del self._loading[user_id]
+        seen = self.build(ids + loading[1])
+        self._put(user_id, seen)
+        return seen
+
+    def _put(self, user_id: int, seen: AnySeenSet) -> None:
+        self._drop(user_id)
+        if not self.max_bytes:
+            return
+        self._mem[user_id] = seen
+        self._bytes += seen.nbytes
+        while self._bytes > self.max_bytes and len(self._mem) > 1:
+            old_id, _ = next(iter(self._mem.items()))
+            self._drop(old_id)
+            self.evictions += 1
+
+    def _drop(self, user_id: int) -> Optional[AnySeenSet]:
+        seen = self._mem.pop(user_id, None)
+        if seen is not None:
+            self._bytes -= seen.nbytes
+        return seen
+
+    def add(self, user_id: int, target_id: int) -> None:
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            loading[1].append(target_id)
+        seen = self._mem.get(user_id)
+        if seen is not None:
+            before = seen.nbytes
+            seen.add(target_id)
+            self._bytes += seen.nbytes - before
+
+    def invalidate(self, user_id: int) -> None:
+        self._loading.pop(user_id, None)
+        if self._drop(user_id) is not None:
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self._mem.clear()
+        self._loading.clear()
+        self._bytes = 0
+
+seen_index = SeenIndex()
@@ -0,0 +1,53 @@
+#Общие фикстуры тестов
+
+import asyncio
+import os
+import sys
+import tempfile
+from typing import Any, Awaitable, Callable
+
+import pytest
+
+# Модули бота лежат в корне репозитория; конфиг читает токен и путь к БД из окружения при импорте
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-token-for-unit-tests-only")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="scmatch-tests-"), "unused.sqlite3"))
+
+def reset_singletons(path: str) -> None:
+    # Синглтоны модулей держат asyncio-примитивы и кэши прошлого теста:
+    # у каждого теста свой event loop и своя БД
+    import db
+    from db_pool import pool
+    from profile_cache import profile_cache
+    from ranking import embedding_store
+    from seen_set import seen_index
+    from write_batcher import write_batcher
+
+    pool.__init__(path)
+    write_batcher.__init__()
+    profile_cache.clear()
+    seen_index.clear()
+    embedding_store.reset()
+    db._pending_interactions.clear()
+
+@pytest.fixture
+def run_db(tmp_path) -> Callable[[Callable[[], Awaitable[Any]]], Any]:
+    # run_db(scenario): свежая БД после init_db, сценарий в новом event loop, затем остановка записи и пула
+    def run(scenario: Callable[[], Awaitable[Any]]) -> Any:
+        from db import init_db
+        from db_pool import pool
+        from write_batcher import write_batcher
+
+        async def main() -> Any:
+            reset_singletons(str(tmp_path / "test.sqlite3"))
+            await pool.open()
+            try:
+                await init_db()
+                return await scenario()
+            finally:
+                await write_batcher.stop()
+                await pool.close()
+
+        return asyncio.run(main())
+
+    return run
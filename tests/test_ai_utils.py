@@ -0,0 +1,130 @@
+#Эмбеддинги пачками, регулятор запросов и потоковый ответ OpenAI
+
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import AuthenticationError, BadRequestError
+
+import ai_utils
+from ai_utils import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, EmbeddingBatcher, OpenAIGovernor
+
+def api_error(cls, status: int):
+    response = httpx.Response(status, request=httpx.Request("POST", "https://api.openai.com/v1/embeddings"))
+    return cls(f"error {status}", response=response, body=None)
+
+def fake_requests(batcher: EmbeddingBatcher, error=None):
+    # Запрос падает, если в пачке есть «плохой» текст (или всегда, если задана ошибка)
+    calls = []
+
+    async def request(texts):
+        calls.append(list(texts))
+        if error is not None:
+            raise error
+        if any(t.startswith("bad") for t in texts):
+            raise api_error(BadRequestError, 400)
+        return [[float(len(t))] for t in texts]
+
+    batcher._request = request
+    return calls
+
+def test_bad_text_is_isolated_by_bisection():
+    async def scenario():
+        batcher = EmbeddingBatcher()
+        calls = fake_requests(batcher)
+        texts = ["a", "bb", "bad", "cccc", "ddddd", "eeeeee", "fffffff", "gggggggg"]
+        return calls, await batcher._request_isolated(texts)
+
+    calls, results = asyncio.run(scenario())
+    assert isinstance(results[2], BadRequestError)
+    assert [r for i, r in enumerate(results) if i != 2] == [[1.0], [2.0], [4.0], [5.0], [6.0], [7.0], [8.0]]
+    assert len(calls) <= 7  # log2(8) уровней, а не запрос на каждый текст
+
+@pytest.mark.parametrize("error", [api_error(AuthenticationError, 401), RuntimeError("timeout")])
+def test_other_errors_fail_whole_batch_without_bisection(error):
+    async def scenario():
+        batcher = EmbeddingBatcher()
+        calls = fake_requests(batcher, error)
+        return calls, await batcher._request_isolated(["a", "b", "c", "d"])
+
+    calls, results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert results == [error] * 4
+
+def test_concurrent_embeds_share_one_request():
+    async def scenario():
+        batcher = EmbeddingBatcher(window_ms=20)
+        calls = fake_requests(batcher)
+        vectors = await asyncio.gather(*(batcher.embed(t) for t in ["a", "bb", "a", "ccc"]))
+        await asyncio.gather(*batcher._tasks)
+        return calls, vectors
+
+    calls, vectors = asyncio.run(scenario())
+    assert calls == [["a", "bb", "ccc"]]
+    assert vectors == [[1.0], [2.0], [1.0], [3.0]]
+
+def test_governor_serves_interactive_first():
+    async def scenario():
+        governor = OpenAIGovernor(limits={"m": (10_000, 10_000_000)}, max_inflight=1, background_inflight=1)
+        order = []
+        hold = asyncio.Event()
+
+        async def use(name, priority):
+            async with governor.slot("m", 10, priority):
+                order.append(name)
+                if name == "first":
+                    await hold.wait()
+
+        first = asyncio.create_task(use("first", PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+        waiting = [
+            asyncio.create_task(use("background", PRIORITY_BACKGROUND)),
+            asyncio.create_task(use("chat", PRIORITY_INTERACTIVE)),
+        ]
+        await asyncio.sleep(0.01)
+        assert governor.stats()["waiting"] == 2
+        hold.set()
+        await asyncio.gather(first, *waiting)
+        return order, governor.stats()
+
+    order, stats = asyncio.run(scenario())
+    assert order == ["first", "chat", "background"]
+    assert stats["in_flight"] == 0 and stats["granted"] == 3
+
+class FakeStream:
+    def __init__(self, deltas):
+        self.deltas = deltas
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        for delta in self.deltas:
+            await asyncio.sleep(0)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+
+def test_stream_releases_slot_before_slow_consumer_finishes(monkeypatch):
+    async def scenario():
+        governor = OpenAIGovernor()
+
+        async def create(**kwargs):
+            assert kwargs["stream"] is True
+            return FakeStream(["При", "вет", "!"])
+
+        monkeypatch.setattr(ai_utils, "openai_governor", governor)
+        monkeypatch.setattr(
+            ai_utils, "openai_client", SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        )
+        texts = []
+        in_flight = []
+        async for text in ai_utils._chat_stream([{"role": "user", "content": "hi"}], 100):
+            texts.append(text)
+            # Потребитель медленный: правка сообщения в Telegram
+            await asyncio.sleep(0.05)
+            in_flight.append(governor.stats()["in_flight"])
+        return texts, in_flight
+
+    texts, in_flight = asyncio.run(scenario())
+    assert texts[-1] == "Привет!"
+    assert in_flight[-1] == 0
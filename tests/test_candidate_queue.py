@@ -0,0 +1,94 @@
+#Очередь кандидатов
+
+import asyncio
+import time
+
+import pytest
+
+import candidate_queue
+from candidate_queue import CandidateQueues
+
+ME = {"city": "X", "age": 25}
+
+@pytest.fixture
+def rated(monkeypatch):
+    # Оценки без БД: has_interaction смотрит в множество пар (кто, кого)
+    pairs = set()
+
+    async def has_interaction(user_id, target_id):
+        return (user_id, target_id) in pairs
+
+    monkeypatch.setattr(candidate_queue, "has_interaction", has_interaction)
+    return pairs
+
+def make_fetch(delay=0.0, calls=None):
+    async def fetch(user_id, limit):
+        if calls is not None:
+            calls.append(user_id)
+        await asyncio.sleep(delay)
+        return [{"user_id": user_id * 100 + i} for i in range(3)]
+
+    return fetch
+
+def test_queue_is_reused_and_skips_rated(rated):
+    async def scenario():
+        calls = []
+        queues = CandidateQueues(make_fetch(calls=calls), refill_at=0)
+        assert await queues.peek(1, ME) == 100
+        assert await queues.peek(1, ME) == 100
+        queues.consume(1, 100)
+        rated.add((1, 101))  # оценена другим путём
+        assert await queues.peek(1, ME) == 102
+        assert calls == [1]
+        # Смена анкеты пересобирает очередь
+        assert await queues.peek(1, {**ME, "city": "Y"}) == 100
+        assert calls == [1, 1]
+
+    asyncio.run(scenario())
+
+def start_refill(queues, user_id):
+    # Пустая свежая очередь с идущей фоновой дозагрузкой
+    entry = queues._touch(user_id, ME)
+    entry.expires_at = time.monotonic() + 60
+    queues._schedule_refill(user_id, entry)
+
+def test_refill_cancelled_by_eviction_is_retried(rated):
+    async def scenario():
+        queues = CandidateQueues(make_fetch(delay=0.05), max_users=1)
+        start_refill(queues, 1)
+
+        async def evict():
+            await asyncio.sleep(0.01)
+            queues._touch(2, ME)  # вытесняет пользователя 1 и отменяет его дозагрузку
+
+        head, _ = await asyncio.gather(queues.peek(1, ME), evict())
+        return head
+
+    assert asyncio.run(scenario()) == 100
+
+def test_caller_cancellation_propagates(rated):
+    async def scenario():
+        queues = CandidateQueues(make_fetch(delay=0.05))
+        start_refill(queues, 1)
+        task = asyncio.create_task(queues.peek(1, ME))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+
+def test_exhausted_queue_waits_for_ttl(rated):
+    async def scenario():
+        calls = []
+
+        async def fetch(user_id, limit):
+            calls.append(user_id)
+            return []
+
+        queues = CandidateQueues(fetch)
+        assert await queues.peek(1, ME) is None
+        assert await queues.peek(1, ME) is None
+        assert calls == [1]
+
+    asyncio.run(scenario())
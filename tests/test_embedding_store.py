@@ -0,0 +1,86 @@
+#Хранилище эмбеддингов для ранжирования
+
+import numpy as np
+
+from ranking import EmbeddingStore, pack_embedding
+
+def vec(*values):
+    return np.asarray(values, dtype=np.float32)
+
+def test_top_k_orders_by_cosine():
+    store = EmbeddingStore()
+    store.put(1, vec(1, 0), version=1)
+    store.put(2, vec(1, 1), version=1)
+    store.put(3, vec(0, 1), version=1)
+    ids, scores = store.top_k(vec(1, 0), [3, 2, 1, 4], k=2)
+    assert ids == [1, 2]
+    assert np.allclose(scores, [1.0, np.sqrt(0.5)])
+    # Без k — все кандидаты с эмбеддингом
+    assert store.rank(vec(1, 0), [3, 2, 1, 4])[0] == [1, 2, 3]
+
+def test_store_is_bounded_and_evicts_least_recently_ranked():
+    store = EmbeddingStore(capacity=4, max_rows=32)
+    for user_id in range(32):
+        store.put(user_id, vec(1, user_id), version=user_id)
+    hot = list(range(16, 32))
+    store.top_k(vec(1, 0), hot)
+    for user_id in range(100, 104):
+        store.put(user_id, vec(0, 1), version=0)
+    stats = store.stats()
+    assert stats["capacity"] == 32 and stats["items"] <= 32
+    assert stats["evictions"] >= 4
+    assert all(user_id in store for user_id in hot)
+    assert all(user_id in store for user_id in range(100, 104))
+    # Вытесненный вектор забыт вместе с версией и подгрузится из БД
+    evicted = [u for u in range(16) if u not in store]
+    assert evicted and not store.is_fresh(evicted[0], evicted[0])
+
+def test_versions_of_profiles_without_vectors_are_trimmed():
+    store = EmbeddingStore(max_rows=8)
+    store.put(1, vec(1, 0), version=1)
+    for user_id in range(2, 40):
+        store.sync(user_id, version=1, raw=None)
+    assert store.stats()["versions"] <= 2 * 8 + 1
+    assert store.is_fresh(1, 1)
+
+def test_sync_skips_unchanged_profiles():
+    store = EmbeddingStore()
+    assert store.sync(1, 10, pack_embedding([1.0, 0.0]))
+    assert store.sync(1, 10, b"garbage")  # версия та же — BLOB не разбирается
+    assert not store.sync(1, 11, None)
+    assert 1 not in store and store.is_fresh(1, 11)
+
+def test_vectors_of_other_model_are_ignored():
+    store = EmbeddingStore(model="new-model")
+    assert store.sync(1, 1, pack_embedding([1.0, 0.0], model="new-model"))
+    assert not store.sync(2, 1, pack_embedding([1.0, 0.0, 0.0], model="old-model"))
+    assert 2 not in store and store.dim == 2 and store.stats()["resets"] == 0
+
+def test_dimension_change_of_current_model_resets_store():
+    store = EmbeddingStore(model="m")
+    store.sync(1, 1, pack_embedding([1.0, 0.0], model="m"))
+    store.sync(2, 1, pack_embedding([0.0, 1.0], model="m"))
+    assert store.sync(3, 1, pack_embedding([1.0, 0.0, 0.0], model="m"))
+    assert store.dim == 3
+    assert 1 not in store and 2 not in store and 3 in store
+    assert store.stats()["resets"] == 1
+    # Старые векторы перечитаются при следующей синхронизации
+    assert not store.is_fresh(1, 1)
+
+def test_rows_of_current_ranking_are_not_evicted():
+    store = EmbeddingStore(capacity=16, max_rows=16)
+    for user_id in range(1000, 1008):
+        store.put(user_id, vec(0, 1), version=1)  # анкеты другого города
+    pool = list(range(24))
+    store.begin(pool)
+    kept = [store.put(user_id, vec(1, user_id), version=1) for user_id in pool]
+    # Сначала вытесняются чужие строки, строки этого ранжирования — никогда
+    assert all(u not in store for u in range(1000, 1008))
+    assert sum(kept) == 16 and all(kept[:16]) and not any(kept[16:])
+    assert all(store.is_fresh(u, 1) for u in pool[:16])
+    assert not any(store.is_fresh(u, 1) for u in pool[16:])
+    ids, _ = store.top_k(vec(1, 0), pool)
+    assert sorted(ids) == pool[:16]
+    # Следующее ранжирование может вытеснить строки прошлого
+    store.begin([])
+    assert store.put(50, vec(1, 1), version=1)
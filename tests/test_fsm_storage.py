@@ -0,0 +1,92 @@
+#Хранилище состояний FSM
+
+import asyncio
+import time
+
+from aiogram.fsm.storage.base import StorageKey
+
+import fsm_storage
+from db_pool import pool
+from fsm_storage import SQLiteStorage
+
+KEY = StorageKey(bot_id=1, chat_id=2, user_id=2)
+
+def test_state_survives_restart(run_db):
+    async def scenario():
+        storage = SQLiteStorage(flush_interval=60)
+        await storage.set_state(KEY, "Form:name")
+        await storage.set_data(KEY, {"name": "Аня"})
+        assert storage.stats()["dirty"] == 1
+        await storage.close()
+        assert storage.stats()["dirty"] == 0
+        fresh = SQLiteStorage()
+        assert await fresh.get_state(KEY) == "Form:name"
+        assert await fresh.get_data(KEY) == {"name": "Аня"}
+        # Сброс состояния удаляет строку
+        await fresh.set_state(KEY, None)
+        await fresh.set_data(KEY, {})
+        await fresh.close()
+        return await pool.fetchone("SELECT COUNT(*) AS n FROM fsm_states")
+
+    assert run_db(scenario)["n"] == 0
+
+def test_write_during_cold_read_is_not_lost(run_db, monkeypatch):
+    async def scenario():
+        storage = SQLiteStorage(flush_interval=60)
+        real = pool.fetchone
+        calls = []
+
+        async def slow_fetchone(sql, params=()):
+            # Медленным делаем только первое чтение: запись успевает пройти целиком
+            calls.append(sql)
+            if len(calls) == 1:
+                await asyncio.sleep(0.05)
+            return await real(sql, params)
+
+        monkeypatch.setattr(fsm_storage.pool, "fetchone", slow_fetchone)
+
+        async def write():
+            await asyncio.sleep(0.01)
+            await storage.set_state(KEY, "Form:age")
+
+        # Промах кэша читает пустую строку, пока параллельно пишется новое состояние
+        read, _ = await asyncio.gather(storage.get_state(KEY), write())
+        after = await storage.get_state(KEY)
+        monkeypatch.undo()
+        await storage.close()
+        return read, after
+
+    read, after = run_db(scenario)
+    assert read in (None, "Form:age")
+    assert after == "Form:age"
+
+def test_expired_state_is_reset(run_db):
+    async def scenario():
+        storage = SQLiteStorage(ttl=60, flush_interval=60)
+        await storage.set_state(KEY, "Form:city")
+        await storage.close()
+        async with pool.writer() as conn:
+            await conn.execute("UPDATE fsm_states SET updated_at = ?", (int(time.time()) - 3600,))
+        fresh = SQLiteStorage(ttl=60)
+        state = await fresh.get_state(KEY)
+        await fresh.close()
+        return state, await pool.fetchone("SELECT COUNT(*) AS n FROM fsm_states")
+
+    state, row = run_db(scenario)
+    assert state is None
+    assert row["n"] == 0
+
+def test_cache_keeps_unflushed_records(run_db):
+    async def scenario():
+        storage = SQLiteStorage(cache_max=2, flush_interval=60, flush_max=100)
+        for user_id in range(5):
+            await storage.set_state(StorageKey(bot_id=1, chat_id=user_id, user_id=user_id), f"S:{user_id}")
+        # Несохранённые записи не вытесняются, даже сверх лимита кэша
+        assert storage.stats()["cached"] == 5
+        await storage.flush()
+        await storage.get_state(KEY)
+        stats = storage.stats()
+        await storage.close()
+        return stats
+
+    assert run_db(scenario)["cached"] <= 2
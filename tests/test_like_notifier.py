@@ -0,0 +1,64 @@
+#Сводные уведомления о лайках
+
+import asyncio
+
+import db
+from like_notifier import LikeNotifier
+
+def test_likes_in_window_make_one_notification():
+    async def scenario():
+        sent = []
+
+        async def send(user_id, n):
+            sent.append((user_id, n))
+
+        notifier = LikeNotifier(send, window=0.05)
+        for _ in range(3):
+            notifier.liked(1)
+        notifier.liked(2)
+        notifier.resolved(2)  # ответил до конца окна — уведомлять не о чем
+        await asyncio.sleep(0.1)
+        await notifier.stop()
+        return sent, notifier.stats()
+
+    sent, stats = asyncio.run(scenario())
+    assert sent == [(1, 3)]
+    assert stats["coalesced"] == 2 and stats["sent"] == 1
+
+def test_stop_flushes_open_windows():
+    async def scenario():
+        sent = []
+
+        async def send(user_id, n):
+            sent.append((user_id, n))
+
+        notifier = LikeNotifier(send, window=60)
+        notifier.liked(1)
+        await notifier.stop()
+        return sent
+
+    assert asyncio.run(scenario()) == [(1, 1)]
+
+def test_failed_send_is_logged_not_raised():
+    async def scenario():
+        async def send(user_id, n):
+            raise RuntimeError("бот заблокирован")
+
+        notifier = LikeNotifier(send, window=0)
+        notifier.liked(1)
+        await asyncio.sleep(0.01)
+        await notifier.stop()
+        return notifier.stats()["sent"]
+
+    assert asyncio.run(scenario()) == 0
+
+def test_reconcile_restores_counters_from_db(run_db):
+    async def scenario():
+        for liker in (2, 3):
+            await db.record_interaction(liker, 1, "like")
+        await db.record_interaction(1, 3, "dislike")
+        notifier = LikeNotifier(lambda user_id, n: None)
+        await notifier.reconcile()
+        return notifier.pending(1), notifier.pending(2)
+
+    assert run_db(scenario) == (1, 0)
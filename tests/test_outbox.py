@@ -0,0 +1,105 @@
+#Очередь исходящих сообщений
+
+import asyncio
+import time
+
+import outbox
+from db_pool import pool
+from outbox import PRIORITY_INTERACTIVE, PRIORITY_NOTIFY, OutboundScheduler
+
+class FakeBot:
+    def __init__(self, fail_times: int = 0):
+        self.sent = []
+        self.fail_times = fail_times
+
+    async def send_message(self, chat_id, **kwargs):
+        if self.fail_times:
+            self.fail_times -= 1
+            raise RuntimeError("сеть недоступна")
+        self.sent.append((chat_id, kwargs["text"], time.monotonic()))
+        return kwargs["text"]
+
+async def outbox_rows() -> int:
+    return (await pool.fetchone("SELECT COUNT(*) AS n FROM outbox"))["n"]
+
+def test_interactive_replies_skip_chat_limit(run_db):
+    async def scenario():
+        bot = FakeBot()
+        scheduler = OutboundScheduler(bot, per_second=100, chat_per_second=1, chat_burst=1)
+        await scheduler.start()
+        started = time.monotonic()
+        replies = [await scheduler.send_message(1, f"r{i}") for i in range(5)]
+        assert await asyncio.wait_for(asyncio.gather(*replies), timeout=5) == [f"r{i}" for i in range(5)]
+        interactive = time.monotonic() - started
+        # Уведомления в тот же чат идут под лимитом чата: вторым — не раньше чем через секунду
+        notes = [await scheduler.send_message(2, f"n{i}", priority=PRIORITY_NOTIFY) for i in range(2)]
+        await asyncio.wait_for(asyncio.gather(*notes), timeout=5)
+        await scheduler.stop(timeout=1)
+        times = [t for chat, _, t in bot.sent if chat == 2]
+        return interactive, times[1] - times[0], [text for chat, text, _ in bot.sent if chat == 1]
+
+    interactive, notify_gap, order = run_db(scenario)
+    assert interactive < 0.5
+    assert notify_gap >= 0.9
+    assert order == [f"r{i}" for i in range(5)]
+
+def test_durable_message_removed_after_send(run_db):
+    async def scenario():
+        bot = FakeBot()
+        scheduler = OutboundScheduler(bot)
+        await scheduler.start()
+        future = await scheduler.send_message(1, "match", priority=PRIORITY_NOTIFY, durable=True)
+        assert await asyncio.wait_for(future, timeout=5) == "match"
+        await scheduler.stop(timeout=1)
+        return len(bot.sent), await outbox_rows()
+
+    assert run_db(scenario) == (1, 0)
+
+def test_undelivered_message_restored_after_restart(run_db):
+    async def scenario():
+        await OutboundScheduler(FakeBot()).send_message(1, "match", priority=PRIORITY_NOTIFY, durable=True)
+        bot = FakeBot()
+        scheduler = OutboundScheduler(bot)
+        await scheduler.start()
+        await scheduler.stop(timeout=1)
+        return [text for _, text, _ in bot.sent], await outbox_rows()
+
+    assert run_db(scenario) == (["match"], 0)
+
+def test_failed_delete_does_not_resend(run_db, monkeypatch):
+    async def scenario():
+        bot = FakeBot()
+        scheduler = OutboundScheduler(bot)
+        await scheduler.start()
+
+        class BrokenPool:
+            # Строка в outbox записана, а удалить её после отправки не выходит
+            def writer(self):
+                raise RuntimeError("БД недоступна")
+
+        future = await scheduler.send_message(1, "match", priority=PRIORITY_NOTIFY, durable=True)
+        monkeypatch.setattr(outbox, "pool", BrokenPool())
+        assert await asyncio.wait_for(future, timeout=5) == "match"
+        await asyncio.sleep(0.1)
+        await scheduler.stop(timeout=1)
+        monkeypatch.undo()
+        return [text for _, text, _ in bot.sent], scheduler.stats()
+
+    sent, stats = run_db(scenario)
+    assert sent == ["match"]
+    assert stats["sent"] == 1 and stats["retried"] == 0
+
+def test_transient_error_is_retried(run_db):
+    async def scenario():
+        bot = FakeBot(fail_times=1)
+        scheduler = OutboundScheduler(bot)
+        await scheduler.start()
+        future = await scheduler.send_message(1, "hi", priority=PRIORITY_INTERACTIVE)
+        # Первая попытка падает, повтор — через 2 с
+        result = await asyncio.wait_for(future, timeout=5)
+        await scheduler.stop(timeout=1)
+        return result, scheduler.stats()
+
+    result, stats = run_db(scenario)
+    assert result == "hi"
+    assert stats["retried"] == 1 and stats["sent"] == 1
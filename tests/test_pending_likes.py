@@ -0,0 +1,86 @@
+#Таблица лайков без ответа
+
+import asyncio
+import random
+
+import db
+from db_pool import pool
+
+async def make_profile(user_id: int) -> None:
+    await db.upsert_profile(user_id, name=f"u{user_id}", age=25, city="X", gender="F", looking_for="ANY",
+                            description="d", photo_file_id="p")
+
+def test_like_waits_until_answered(run_db):
+    async def scenario():
+        await make_profile(1)
+        await db.record_interaction(1, 2, "like")
+        assert await db.count_pending_likers(2) == 1
+        assert (await db.get_next_pending_liker(2))["user_id"] == 1
+        # Ответ (любой) закрывает входящий лайк
+        await db.record_interaction(2, 1, "dislike")
+        assert await db.count_pending_likers(2) == 0
+        assert await db.get_next_pending_liker(2) is None
+
+    run_db(scenario)
+
+def test_mutual_like_is_not_pending(run_db):
+    async def scenario():
+        await db.record_interaction(1, 2, "like")
+        await db.record_interaction(2, 1, "like")
+        assert await db.count_pending_likers(1) == 0
+        assert await db.count_pending_likers(2) == 0
+
+    run_db(scenario)
+
+def test_like_after_answer_is_not_pending(run_db):
+    async def scenario():
+        # 2 уже оценил 1, поэтому лайк от 1 ответа не ждёт
+        await db.record_interaction(2, 1, "dislike")
+        await db.record_interaction(1, 2, "like")
+        assert await db.count_pending_likers(2) == 0
+
+    run_db(scenario)
+
+def test_changed_mind_removes_pending(run_db):
+    async def scenario():
+        await db.record_interaction(1, 2, "like")
+        await db.record_interaction(1, 2, "dislike")
+        assert await db.count_pending_likers(2) == 0
+
+    run_db(scenario)
+
+def test_oldest_liker_first(run_db):
+    async def scenario():
+        for liker in (5, 3, 4):
+            await make_profile(liker)
+        async with pool.writer() as conn:
+            for liker, ts in ((5, 300), (3, 100), (4, 200)):
+                await conn.execute("INSERT INTO pending_likes (target_id, liker_id, ts) VALUES (9, ?, ?)", (liker, ts))
+        assert (await db.get_next_pending_liker(9))["user_id"] == 3
+        assert await db.count_pending_likers_all() == {9: 3}
+
+    run_db(scenario)
+
+def test_random_history_matches_interactions(run_db):
+    async def scenario():
+        rng = random.Random(7)
+        users = range(1, 30)
+        ops = [(rng.choice(users), rng.choice(users), rng.choice(("like", "like", "dislike"))) for _ in range(400)]
+        ops = [op for op in ops if op[0] != op[1]]
+        # Часть пачками через write_batcher, часть по одной
+        await asyncio.gather(*(db.record_interaction(*op) for op in ops[:200]))
+        for op in ops[200:]:
+            await db.record_interaction(*op)
+        report = await db.verify_pending_likes()
+        assert report["missing"] == 0 and report["extra"] == 0, report
+
+        async with pool.writer() as conn:
+            await conn.execute("DELETE FROM pending_likes WHERE target_id = (SELECT MIN(target_id) FROM pending_likes)")
+            await conn.execute("INSERT OR REPLACE INTO pending_likes (target_id, liker_id, ts) VALUES (999, 998, 0)")
+        report = await db.verify_pending_likes()
+        assert report["missing"] > 0 and report["extra"] == 1
+        await db.rebuild_pending_likes()
+        report = await db.verify_pending_likes()
+        assert report["missing"] == 0 and report["extra"] == 0
+
+    run_db(scenario)
@@ -0,0 +1,19 @@
+#Планы горячих запросов
+
+import pytest
+
+from query_plans import _FORBIDDEN, HOT_QUERIES, explain
+
+@pytest.mark.parametrize("query", HOT_QUERIES, ids=lambda q: q.name)
+def test_hot_query_uses_indexes(run_db, query):
+    async def scenario():
+        return await explain(query.sql, query.params)
+
+    plan = run_db(scenario)
+    assert plan, "пустой план"
+    for step in plan:
+        assert not _FORBIDDEN.match(step.strip()), f"{query.name}: {step}"
+        assert "USE TEMP B-TREE" not in step, f"{query.name}: {step}"
+    text = "\n".join(plan)
+    for index in query.indexes:
+        assert index in text, f"{query.name}: нет {index} в плане:\n{text}"
@@ -0,0 +1,52 @@
+#Ранжирование всего пула подходящих анкет
+
+import numpy as np
+
+import db
+from db_pool import pool
+from ranking import EmbeddingStore, pack_embedding
+
+ME = dict(name="me", age=25, city="X", gender="M", looking_for="F", description="d", photo_file_id="p")
+
+async def create_pool(n: int) -> None:
+    await db.upsert_profile(1, **ME)
+    async with pool.writer() as conn:
+        for i in range(n):
+            uid = 100 + i
+            await conn.execute(
+                "INSERT INTO profiles (user_id, name, age, city, gender, looking_for, description, photo_file_id, "
+                "embedding, updated_at) VALUES (?, ?, 25, 'X', 'F', 'M', 'd', 'p', ?, 1)",
+                (uid, f"c{i}", pack_embedding([1.0, i / n])),
+            )
+
+def test_pool_larger_than_store_is_ranked_whole(run_db, monkeypatch):
+    import bot
+
+    store = EmbeddingStore(capacity=16, max_rows=100)
+    monkeypatch.setattr(bot, "embedding_store", store)
+    fetched = []
+    real_get_profiles = bot.get_profiles
+
+    async def get_profiles(user_ids, columns="*"):
+        if "embedding" in columns:
+            fetched.append(len(user_ids))
+        return await real_get_profiles(user_ids, columns)
+
+    monkeypatch.setattr(bot, "get_profiles", get_profiles)
+    query = np.asarray([0.0, 1.0], dtype=np.float32)
+
+    async def scenario():
+        await create_pool(300)
+        me = await db.get_profile(1)
+        where, params = bot.candidate_filter(me)
+        seen = await db.get_seen_set(1)
+        first = [c["user_id"] for c in await bot.rank_full_pool(where, params, seen, query, 10)]
+        second = [c["user_id"] for c in await bot.rank_full_pool(where, params, seen, query, 10)]
+        return first, second
+
+    first, second = run_db(scenario)
+    # Пул урезан до размера хранилища, и каждая его анкета попала в ранжирование
+    assert len(store) == 100 and store.stats()["evictions"] == 0
+    assert fetched == [100]  # повторный поиск не читает эмбеддинги из БД
+    ids, _ = store.rank(query, list(range(100, 400)))
+    assert first == second == ids[:10]
@@ -0,0 +1,134 @@
+#Наборы просмотренных анкет
+
+import random
+
+import pytest
+
+import db
+from seen_set import BloomSeenSet, SeenIndex, SeenSet, seen_index
+
+@pytest.fixture(params=[SeenSet, BloomSeenSet], ids=["exact", "bloom"])
+def seen_cls(request):
+    return request.param
+
+def test_membership_and_batch_mask(seen_cls):
+    rng = random.Random(1)
+    ids = rng.sample(range(10 ** 9), 4000)
+    seen = seen_cls(ids[:2000])
+    for uid in ids[2000:2100]:
+        seen.add(uid)
+    rated, fresh = ids[:2100], ids[2100:]
+    # Оценённая анкета никогда не считается новой (у фильтра Блума тоже)
+    assert all(uid in seen for uid in rated)
+    assert not seen.unseen(rated).any()
+    mask = seen.unseen(fresh)
+    if seen_cls is SeenSet:
+        assert mask.all()
+        assert not any(uid in seen for uid in fresh)
+    else:
+        assert 1.0 - mask.mean() < 0.03
+    assert seen.unseen([]).shape == (0,)
+
+def test_exact_set_merges_recent_ids():
+    seen = SeenSet([5, 1])
+    for uid in range(100, 200):
+        seen.add(uid)
+    seen.add(5)
+    assert len(seen) == 102
+    assert seen.ids().tolist() == sorted([1, 5, *range(100, 200)])
+    assert seen.unseen([1, 2, 150, 250]).tolist() == [False, True, False, True]
+
+def test_bloom_filter_saturates_and_is_rebuilt():
+    index = SeenIndex(mode="bloom")
+    token = index.begin_load(1)
+    seen = index.finish_load(1, token, [])
+    for uid in range(seen.capacity + 1):
+        index.add(1, uid)
+    assert seen.saturated
+    assert index.get(1) is None  # переполненный фильтр пересобирается из БД
+
+def test_adds_during_load_are_kept():
+    index = SeenIndex()
+    token = index.begin_load(1)
+    index.add(1, 99)
+    seen = index.finish_load(1, token, [1, 2])
+    assert 99 in seen and 2 in seen
+    assert index.get(1) is seen
+
+def test_invalidated_load_is_not_cached():
+    index = SeenIndex()
+    token = index.begin_load(1)
+    index.invalidate(1)
+    seen = index.finish_load(1, token, [1])
+    assert 1 in seen
+    assert index.get(1) is None
+
+def test_memory_bound_evicts_least_recent():
+    index = SeenIndex(max_bytes=8 * 150)
+    for user_id in (1, 2):
+        index.finish_load(user_id, index.begin_load(user_id), list(range(70)))
+    index.get(1)
+    index.finish_load(3, index.begin_load(3), list(range(70)))
+    assert index.get(2) is None
+    assert index.get(1) is not None and index.get(3) is not None
+    assert index.stats()["bytes"] <= 8 * 150
+
+async def _complete_profiles(n: int) -> None:
+    await db.upsert_profile(1, name="me", age=25, city="X", gender="M", looking_for="F", description="d", photo_file_id="p")
+    for i in range(n):
+        await db.upsert_profile(100 + i, name=f"c{i}", age=25, city="X", gender="F", looking_for="M",
+                                description="d", photo_file_id="p")
+
+@pytest.mark.parametrize("mode", ["exact", "bloom"])
+def test_find_candidates_skips_rated_profiles(run_db, mode):
+    import bot
+
+    async def scenario():
+        seen_index.mode = mode
+        try:
+            await _complete_profiles(60)
+            first = [c["user_id"] for c in await bot.find_candidates(1, limit=20)]
+            assert len(first) == 20
+            # Несохранённые оценки (wait=False) отсекаются так же, как сохранённые
+            for uid in first[:10]:
+                await db.record_interaction(1, uid, "dislike", wait=False)
+            for uid in first[10:]:
+                await db.record_interaction(1, uid, "like")
+            second = [c["user_id"] for c in await bot.find_candidates(1, limit=20)]
+            assert len(second) == 20
+            assert not set(first) & set(second)
+            # После сброса кэша набор загружается из БД вместе с очередью записи
+            seen_index.clear()
+            third = [c["user_id"] for c in await bot.find_candidates(1, limit=100)]
+            assert not set(third) & set(first)
+            assert len(third) == 40
+        finally:
+            seen_index.mode = "exact"
+
+    run_db(scenario)
+
+def test_find_candidates_streams_past_many_rated(run_db):
+    import bot
+
+    async def scenario():
+        await _complete_profiles(300)
+        for uid in range(100, 395):
+            await db.record_interaction(1, uid, "dislike", wait=False)
+        found = [c["user_id"] for c in await bot.find_candidates(1, limit=10)]
+        assert sorted(found) == list(range(395, 400))
+
+    run_db(scenario)
+
+def test_failed_write_drops_cached_seen_set(run_db):
+    from db_pool import pool
+
+    async def scenario():
+        seen = await db.get_seen_set(1)
+        async with pool.writer() as conn:
+            await conn.execute("DROP TABLE pending_likes")
+        with pytest.raises(Exception):
+            await db.record_interaction(1, 2, "like")
+        assert seen_index.get(1) is None
+        assert 2 not in await db.get_seen_set(1)
+
+    run_db(scenario)
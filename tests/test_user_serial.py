@@ -0,0 +1,78 @@
+#Последовательная обработка апдейтов одного пользователя
+
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.types import Message
+
+from user_serial import UserSerialMiddleware
+
+def context(user_id: int, coalesce: bool = False):
+    return {"event_from_user": SimpleNamespace(id=user_id), "handler": SimpleNamespace(flags={"coalesce": coalesce})}
+
+def test_updates_of_one_user_run_in_order():
+    async def scenario():
+        middleware = UserSerialMiddleware()
+        log = []
+
+        async def handler(event, data):
+            log.append(("start", event.text))
+            await asyncio.sleep(0.01)
+            log.append(("end", event.text))
+
+        await asyncio.gather(*(middleware(handler, Message.model_construct(text=str(i)), context(1)) for i in range(3)))
+        return log
+
+    log = asyncio.run(scenario())
+    assert log == [(step, str(i)) for i in range(3) for step in ("start", "end")]
+
+def test_different_users_run_concurrently():
+    async def scenario():
+        middleware = UserSerialMiddleware()
+        running = []
+        peak = []
+
+        async def handler(event, data):
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+        await asyncio.gather(*(middleware(handler, Message.model_construct(text="x"), context(i)) for i in range(3)))
+        return max(peak)
+
+    assert asyncio.run(scenario()) == 3
+
+def test_messages_during_handler_are_coalesced():
+    async def scenario():
+        middleware = UserSerialMiddleware()
+        calls = []
+
+        async def handler(event, data):
+            calls.append(data["coalesced_text"])
+            await asyncio.sleep(0.02)
+
+        first = asyncio.create_task(middleware(handler, Message.model_construct(text="привет"), context(1, True)))
+        await asyncio.sleep(0.005)
+        await asyncio.gather(
+            first,
+            *(middleware(handler, Message.model_construct(text=t), context(1, True)) for t in ("как", "дела")),
+        )
+        return calls, middleware.coalesced
+
+    calls, coalesced = asyncio.run(scenario())
+    assert calls == ["привет", "как\nдела"]
+    assert coalesced == 1
+
+def test_idle_slots_are_bounded():
+    async def scenario():
+        middleware = UserSerialMiddleware(max_users=4)
+
+        async def handler(event, data):
+            return None
+
+        for user_id in range(10):
+            await middleware(handler, Message.model_construct(text="x"), context(user_id))
+        return len(middleware)
+
+    assert asyncio.run(scenario()) <= 4
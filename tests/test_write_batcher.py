@@ -0,0 +1,95 @@
+#Групповая запись и оверлей несохранённых оценок
+
+import asyncio
+
+import pytest
+
+import db
+from db_pool import pool
+from write_batcher import WriteBatcher, write_batcher
+
+def test_unsaved_rating_visible_before_commit(run_db):
+    async def scenario():
+        await db.record_interaction(1, 2, "like", wait=False)
+        # Запись ещё в очереди, но проверка взаимности и повторного показа её видит
+        assert (1, 2) in db._pending_interactions
+        assert await db.has_interaction(1, 2)
+        assert await db.has_interaction(1, 2, "like")
+        assert not await db.has_interaction(1, 2, "dislike")
+        row = await pool.fetchone("SELECT 1 FROM interactions WHERE user_id = 1 AND target_id = 2")
+        assert row is None
+        await write_batcher.stop()
+        assert db._pending_interactions == {}
+        row = await pool.fetchone("SELECT action FROM interactions WHERE user_id = 1 AND target_id = 2")
+        assert row["action"] == "like"
+
+    run_db(scenario)
+
+def test_later_rating_wins_in_overlay(run_db):
+    async def scenario():
+        await db.record_interaction(1, 2, "like", wait=False)
+        await db.record_interaction(1, 2, "dislike", wait=False)
+        assert await db.has_interaction(1, 2, "dislike")
+        await write_batcher.stop()
+        assert db._pending_interactions == {}
+        assert await db.has_interaction(1, 2, "dislike")
+
+    run_db(scenario)
+
+def test_failed_write_leaves_no_overlay(run_db):
+    async def scenario():
+        async with pool.writer() as conn:
+            await conn.execute("DROP TABLE pending_likes")
+        with pytest.raises(Exception):
+            await db.record_interaction(1, 2, "like")
+        assert db._pending_interactions == {}
+        assert not await db.has_interaction(1, 2)
+
+    run_db(scenario)
+
+def test_concurrent_writes_share_transactions(run_db):
+    async def scenario():
+        await asyncio.gather(*(db.record_interaction(1, 100 + i, "like") for i in range(200)))
+        stats = write_batcher.stats()
+        assert stats["ops"] == 200
+        assert stats["batches"] < 200
+        row = await pool.fetchone("SELECT COUNT(*) FROM interactions WHERE user_id = 1")
+        assert row[0] == 200
+
+    run_db(scenario)
+
+def test_failing_op_does_not_roll_back_neighbours(run_db):
+    async def scenario():
+        batcher = WriteBatcher(window_ms=50, max_ops=16)
+
+        def insert(value):
+            async def op(conn):
+                await conn.execute("INSERT INTO worker_state (name, value) VALUES (?, '{}')", (value,))
+            return op
+
+        async def broken(conn):
+            await conn.execute("INSERT INTO no_such_table VALUES (1)")
+
+        # Первая запись уходит сразу, остальные копятся в одну пачку
+        results = await asyncio.gather(
+            batcher.submit(insert("a")),
+            batcher.submit(insert("b")),
+            batcher.submit(broken),
+            batcher.submit(insert("c")),
+            return_exceptions=True,
+        )
+        await batcher.stop()
+        assert isinstance(results[2], Exception)
+        rows = await pool.fetchall("SELECT name FROM worker_state ORDER BY name")
+        assert [r["name"] for r in rows] == ["a", "b", "c"]
+
+    run_db(scenario)
+
+def test_enqueue_after_stop_is_rejected(run_db):
+    async def scenario():
+        await write_batcher.stop()
+        with pytest.raises(RuntimeError):
+            await db.record_interaction(1, 2, "like")
+        assert db._pending_interactions == {}
+
+    run_db(scenario)
@@ -0,0 +1,32 @@
+#Запись эмбеддингов фоновым воркером
+
+import db
+from db_pool import pool
+
+async def embedding_of(user_id: int):
+    return (await pool.fetchone("SELECT embedding FROM profiles WHERE user_id = ?", (user_id,)))["embedding"]
+
+def test_embedding_is_written_for_unchanged_profile(run_db):
+    async def scenario():
+        await db.upsert_profile(1, name="a", description="люблю горы")
+        (row,) = await db.find_stale_embeddings_for([1])
+        written = await db.write_embeddings([(1, [1.0, 0.0], row["updated_at"], row["description"])])
+        return written, await embedding_of(1), await db.find_stale_embeddings_for([1])
+
+    written, embedding, stale = run_db(scenario)
+    assert written == [1] and embedding is not None and stale == []
+
+def test_description_edited_in_same_second_is_not_overwritten(run_db):
+    async def scenario():
+        await db.upsert_profile(1, name="a", description="люблю горы")
+        (row,) = await db.find_stale_embeddings_for([1])
+        await db.upsert_profile(1, description="люблю море")
+        # Правка в ту же секунду: updated_at не изменился
+        async with pool.writer() as conn:
+            await conn.execute("UPDATE profiles SET updated_at = ? WHERE user_id = 1", (row["updated_at"],))
+        written = await db.write_embeddings([(1, [1.0, 0.0], row["updated_at"], row["description"])])
+        return written, await embedding_of(1), await db.find_stale_embeddings_for([1])
+
+    written, embedding, stale = run_db(scenario)
+    assert written == [] and embedding is None
+    assert [r["description"] for r in stale] == ["люблю море"]
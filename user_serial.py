@@ -0,0 +1,93 @@
+#Последовательная обработка апдейтов одного пользователя
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message, TelegramObject
+
+from config import USER_SERIAL_IDLE_TTL, USER_SERIAL_MAX_USERS
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+class _UserSlot:
+    __slots__ = ("lock", "pending", "users", "last_used")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending: Optional[List[str]] = None  # тексты, ждущие общего повторного запроса
+        self.users = 0  # апдейтов, которые сейчас держат или ждут слот
+        self.last_used = time.monotonic()
+
+class UserSerialMiddleware(BaseMiddleware):
+    # Внутренний middleware: хэндлеры одного пользователя выполняются строго по очереди.
+    # Для хэндлеров с флагом coalesce сообщения, пришедшие, пока предыдущее
+    # обрабатывается, склеиваются в один следующий вызов: хэндлер получает
+    # coalesced_text, а остальные апдейты пачки не вызывают его вовсе.
+    # Свободные слоты живут idle_ttl секунд, всего их не больше max_users
+    # (занятые слоты не вытесняются).
+
+    def __init__(self, max_users: int = USER_SERIAL_MAX_USERS, idle_ttl: float = USER_SERIAL_IDLE_TTL):
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self._slots: "OrderedDict[int, _UserSlot]" = OrderedDict()
+        self._next_sweep = 0.0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _slot(self, user_id: int) -> _UserSlot:
+        slot = self._slots.get(user_id)
+        if slot is None:
+            self._evict(reserve=1)
+            slot = self._slots[user_id] = _UserSlot()
+        else:
+            self._slots.move_to_end(user_id)
+        return slot
+
+    def _evict(self, reserve: int = 0) -> None:
+        now = time.monotonic()
+        over = len(self._slots) + reserve - self.max_users
+        if over <= 0 and now < self._next_sweep:
+            return
+        self._next_sweep = now + self.idle_ttl / 2
+        # Обход от самых давних; занятые слоты пропускаем
+        for user_id in list(self._slots):
+            slot = self._slots[user_id]
+            if slot.users:
+                continue
+            if over > 0 or now - slot.last_used > self.idle_ttl:
+                del self._slots[user_id]
+                over -= 1
+            else:
+                break
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        slot = self._slot(user.id)
+        slot.users += 1
+        try:
+            text = event.text if isinstance(event, Message) else None
+            if text is None or not get_flag(data, "coalesce"):
+                async with slot.lock:
+                    return await handler(event, data)
+            if slot.pending is not None:
+                # Уже есть ожидающий вызов — текст уйдёт вместе с ним
+                slot.pending.append(text)
+                self.coalesced += 1
+                return None
+            if slot.lock.locked():
+                slot.pending = [text]
+            async with slot.lock:
+                texts, slot.pending = slot.pending or [text], None
+                data["coalesced_text"] = "\n".join(texts)
+                return await handler(event, data)
+        finally:
+            slot.users -= 1
+            slot.last_used = time.monotonic()
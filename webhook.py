@@ -0,0 +1,117 @@
+#Режим вебхука
+
+import asyncio
+import signal
+from typing import Any, Dict, List
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import (
+    WEBHOOK_BASE_URL,
+    WEBHOOK_DRAIN_TIMEOUT,
+    WEBHOOK_HOST,
+    WEBHOOK_MAX_BACKLOG,
+    WEBHOOK_MAX_CONNECTIONS,
+    WEBHOOK_MAX_HANDLERS,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    logger,
+)
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    # Telegram получает ответ сразу, апдейты обрабатываются в фоне — не больше
+    # max_handlers одновременно. Если очередь переполнена или идёт остановка,
+    # отвечаем 503: Telegram сам повторит доставку позже.
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        max_handlers: int = WEBHOOK_MAX_HANDLERS,
+        max_backlog: int = WEBHOOK_MAX_BACKLOG,
+        **kwargs: Any,
+    ):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._sem = asyncio.Semaphore(max_handlers)
+        self.max_backlog = max_backlog
+        self.accepting = True
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def _background_feed_update(self, bot: Bot, update: Dict[str, Any]) -> None:
+        async with self._sem:
+            try:
+                await super()._background_feed_update(bot, update)
+            except Exception as e:
+                logger.warning(f"Ошибка обработки апдейта {update.get('update_id')}: {e}")
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.accepting or self.in_flight >= self.max_backlog:
+            return web.Response(status=503, text="busy")
+        return await super().handle(request)
+
+    async def drain(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT) -> None:
+        # Новых апдейтов не берём, начатые дорабатываем, зависшие отменяем по таймауту
+        self.accepting = False
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        logger.info(f"Вебхук: ждём завершения {len(tasks)} апдейтов")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logger.warning(f"Вебхук: отменено незавершённых апдейтов: {len(pending)}")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+def build_app(bot: Bot, dp: Dispatcher, allowed_updates: List[str]) -> web.Application:
+    app = web.Application()
+    handler = BoundedRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET or None)
+
+    async def register_webhook(_: web.Application) -> None:
+        await bot.set_webhook(
+            WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=allowed_updates,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info(f"Вебхук зарегистрирован: {WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+    async def drain(_: web.Application) -> None:
+        await handler.drain()
+
+    # Порядок остановки: дорабатываем апдейты -> dp.shutdown (воркеры, OpenAI, пул БД)
+    # -> закрываем HTTP-сессию бота
+    app.on_shutdown.append(drain)
+    setup_application(app, dp, bot=bot)
+    handler.register(app, path=WEBHOOK_PATH)
+    if WEBHOOK_BASE_URL:
+        app.on_startup.append(register_webhook)
+    app["webhook_handler"] = handler
+    return app
+
+async def run_webhook(bot: Bot, dp: Dispatcher, allowed_updates: List[str]) -> None:
+    app = build_app(bot, dp, allowed_updates)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    try:
+        await stop.wait()
+        logger.info("Получен сигнал остановки")
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,101 @@
+#Локальная проверка вебхука синтетическими апдейтами
+
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+from typing import Any, Dict, List
+
+import aiohttp
+import numpy as np
+
+from config import WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET
+
+TEXTS = ["Поиск анкет", "Посмотреть мою анкету", "Помощь", "Привет!", "/my"]
+
+def message_update(update_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text,
+        },
+    }
+
+def callback_update(update_id: int, user_id: int, data: str) -> Dict[str, Any]:
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+                "text": "анкета",
+            },
+        },
+    }
+
+def synthetic_updates(count: int, users: int, callbacks: float, seed: int) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    updates = []
+    for update_id in range(1, count + 1):
+        user_id = 100_000 + rng.randrange(users)
+        if rng.random() < callbacks:
+            target = 100_000 + rng.randrange(users)
+            updates.append(callback_update(update_id, user_id, f"{rng.choice(('like', 'dislike'))}:{target}"))
+        else:
+            updates.append(message_update(update_id, user_id, rng.choice(TEXTS)))
+    return updates
+
+async def post_all(url: str, secret: str, updates: List[Dict[str, Any]], concurrency: int) -> None:
+    sem = asyncio.Semaphore(concurrency)
+    statuses: Counter = Counter()
+    latencies: List[float] = []
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+
+    async def post(session: aiohttp.ClientSession, update: Dict[str, Any]) -> None:
+        async with sem:
+            started = time.perf_counter()
+            try:
+                async with session.post(url, json=update, headers=headers) as resp:
+                    await resp.read()
+                    statuses[resp.status] += 1
+            except aiohttp.ClientError as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(post(session, u) for u in updates))
+    elapsed = time.perf_counter() - started
+    ms = np.asarray(latencies) * 1000.0
+    print(f"апдейтов: {len(updates)} за {elapsed:.2f} с ({len(updates) / elapsed:.0f}/с)")
+    print(f"ответы: {dict(statuses)}")
+    print(f"задержка ответа: p50={np.percentile(ms, 50):.1f} мс  p95={np.percentile(ms, 95):.1f} мс  "
+          f"p99={np.percentile(ms, 99):.1f} мс")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Отправить синтетические Update на локальный вебхук")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=WEBHOOK_SECRET)
+    parser.add_argument("-n", "--updates", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("-c", "--concurrency", type=int, default=40, help="как max_connections у Telegram")
+    parser.add_argument("--callbacks", type=float, default=0.3, help="доля callback-апдейтов (лайки)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    updates = synthetic_updates(args.updates, args.users, args.callbacks, args.seed)
+    asyncio.run(post_all(args.url, args.secret, updates, args.concurrency))
+
+if __name__ == "__main__":
+    main()
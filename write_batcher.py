@@ -0,0 +1,172 @@
+#Групповая запись в БД
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import aiosqlite
+
+from config import WRITE_BATCH_MAX_OPS, WRITE_BATCH_WINDOW_MS, logger
+from db_pool import pool
+from metrics import registry
+
+WriteOp = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+WRITE_BATCH_SIZE = registry.histogram(
+    "bot_db_write_batch_ops",
+    "Операций записи в одной транзакции",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512),
+)
+
+class _Write:
+    __slots__ = ("op", "future", "done")
+
+    def __init__(self, op: WriteOp, future: asyncio.Future, done: Optional[Callable[[], None]]):
+        self.op = op
+        self.future = future
+        self.done = done
+
+class WriteBatcher:
+    # Мелкие записи (оценки, анкеты) копятся в очереди, и одна задача применяет их
+    # одной транзакцией: один commit на пачку вместо commit на каждый свайп.
+    # Каждая операция идёт в своём SAVEPOINT, поэтому ошибка одной не откатывает соседние.
+    # Future операции завершается только после commit, так что дождавшийся её
+    # вызывающий уже читает свою запись.
+    # Пока база свободна, одиночная запись уходит сразу; под нагрузкой пачка
+    # добирается до max_ops или window_ms.
+
+    def __init__(self, window_ms: float = WRITE_BATCH_WINDOW_MS, max_ops: int = WRITE_BATCH_MAX_OPS):
+        self.window = window_ms / 1000.0
+        self.max_ops = max_ops
+        self._queue: List[_Write] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loaded = False
+        self._stopping = False
+        self._closed = False
+        self.batches = 0
+        self.ops = 0
+        self.failed = 0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queued": len(self._queue),
+            "batches": self.batches,
+            "ops": self.ops,
+            "failed": self.failed,
+            "avg_batch": self.ops / self.batches if self.batches else 0.0,
+        }
+
+    def _ensure_task(self) -> None:
+        # Задача запускается при первой записи: db.* вызывают и утилиты без main().
+        # После stop() запись отклоняется, а не перезапускает задачу
+        if self._closed:
+            raise RuntimeError("Групповая запись остановлена")
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def enqueue(self, op: WriteOp, done: Optional[Callable[[], None]] = None) -> asyncio.Future:
+        # done вызывается после завершения транзакции — и при успехе, и при ошибке
+        self._ensure_task()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append(_Write(op, future, done))
+        if len(self._queue) == 1 or len(self._queue) >= self.max_ops:
+            self._wakeup.set()
+        return future
+
+    async def submit(self, op: WriteOp) -> Any:
+        return await self.enqueue(op)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                if self._stopping:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if self._loaded and self.window > 0 and not self._stopping:
+                deadline = loop.time() + self.window
+                while len(self._queue) < self.max_ops:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+            batch, self._queue = self._queue[: self.max_ops], self._queue[self.max_ops:]
+            await self._flush(batch)
+            # Пока шёл commit, набежали новые записи — значит, есть нагрузка
+            self._loaded = len(batch) > 1 or bool(self._queue)
+
+    async def _flush(self, batch: List[_Write]) -> None:
+        results: List[Any] = []
+        errors: List[Optional[BaseException]] = []
+        try:
+            async with pool.writer() as db:
+                if len(batch) == 1:
+                    # Одиночной записи SAVEPOINT не нужен: при ошибке откатывается вся транзакция
+                    try:
+                        results.append(await batch[0].op(db))
+                        errors.append(None)
+                    except Exception as e:
+                        await db.rollback()
+                        results.append(None)
+                        errors.append(e)
+                else:
+                    await db.execute("BEGIN")
+                    for write in batch:
+                        await db.execute("SAVEPOINT write_batch")
+                        try:
+                            results.append(await write.op(db))
+                            errors.append(None)
+                        except Exception as e:
+                            await db.execute("ROLLBACK TO write_batch")
+                            results.append(None)
+                            errors.append(e)
+                        await db.execute("RELEASE write_batch")
+        except BaseException as e:
+            # commit не прошёл: ошибка у всех операций пачки
+            logger.warning(f"Групповая запись: транзакция из {len(batch)} операций не сохранена: {e}")
+            self.failed += len(batch)
+            for write in batch:
+                self._finish(write, None, e if isinstance(e, Exception) else RuntimeError("запись прервана"))
+            if not isinstance(e, Exception):
+                raise
+            return
+        self.batches += 1
+        self.ops += len(batch)
+        WRITE_BATCH_SIZE.observe(len(batch))
+        for write, result, error in zip(batch, results, errors):
+            if error is not None:
+                self.failed += 1
+            self._finish(write, result, error)
+
+    def _finish(self, write: _Write, result: Any, error: Optional[BaseException]) -> None:
+        if write.done is not None:
+            try:
+                write.done()
+            except Exception as e:
+                logger.warning(f"Групповая запись: ошибка в обработчике завершения: {e}")
+        if write.future.done():
+            return
+        if error is not None:
+            write.future.set_exception(error)
+        else:
+            write.future.set_result(result)
+
+    async def stop(self) -> None:
+        # Задача дописывает всю очередь и завершается
+        self._closed = True
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+write_batcher = WriteBatcher()